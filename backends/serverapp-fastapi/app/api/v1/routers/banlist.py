@@ -9,6 +9,8 @@ from tortoise.exceptions import OperationalError
 from app.models.common import ListResponse
 from app.models.db.banlists import Banlists
 from app.models.db.users import Users
+from app.utils.banlist_cache import banlists
+from app.utils.banned_ratings import banned_ratings
 from app.utils.wrapper import ApiException, Wrapper, wrap
 
 router = APIRouter()
@@ -84,12 +86,7 @@ async def is_user_banlist(request: Request, banned_username: str):
     else:
         raise ApiException(500, 2002, "This user no longer exists!")
 
-    banned = (
-        await Banlists.filter(
-            banned_user_id=banned_user_id, user_id=user_id, delete_date=None
-        ).first()
-        is not None
-    )
+    banned = str(banned_user_id) in await banlists.get(user_id)
 
     return wrap({"banned": banned})
 
@@ -119,6 +116,9 @@ async def add_to_banlist(request: Request, banned_username: str):
         banned_user_id=banned_user_id, user_id=user_id
     )
 
+    already_banned = (
+        exists_in_banlist is not None and exists_in_banlist.delete_date is None
+    )
     if exists_in_banlist is not None:
         try:
             exists_in_banlist.delete_date = None
@@ -131,6 +131,11 @@ async def add_to_banlist(request: Request, banned_username: str):
         except OperationalError:
             raise ApiException(401, 2041, "You cannot ban that person.")
 
+    # write through to the banlist cache and the banned rating deltas
+    await banlists.refresh(user_id)
+    if not already_banned:
+        await banned_ratings.ban_changed(user_id)
+
     return wrap({})
 
 
@@ -156,6 +161,7 @@ async def delete_from_banlist(request: Request, banned_username: str):
     )
 
     if exists_in_banlist is not None:
+        was_banned = exists_in_banlist.delete_date is None
         try:
             exists_in_banlist.delete_date = datetime.now()
             await exists_in_banlist.save()
@@ -166,4 +172,9 @@ async def delete_from_banlist(request: Request, banned_username: str):
             401, 2043, "You haven't added this user to your banlist yet."
         )
 
+    # write through to the banlist cache and the banned rating deltas
+    await banlists.refresh(user_id)
+    if was_banned:
+        await banned_ratings.ban_changed(user_id)
+
     return wrap({})
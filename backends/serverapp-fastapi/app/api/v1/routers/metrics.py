@@ -0,0 +1,23 @@
+from typing import Dict
+
+from fastapi import APIRouter
+
+from app.core.config import settings
+from app.utils.metrics import metrics
+from app.utils.wrapper import ApiException, Wrapper, wrap
+
+router = APIRouter()
+override_prefix = None
+override_prefix_all = None
+
+"""
+This API controller exposes the in-process metrics of the worker serving the
+request, such as the search indexer's queue depth and lag.
+"""
+
+
+@router.get("/", tags=["metrics"], response_model=Wrapper[Dict[str, float]])
+async def get_metrics():
+    if not settings.METRICS_ENABLED:
+        raise ApiException(404, 2800, "Metrics are not enabled.")
+    return wrap(metrics.snapshot())
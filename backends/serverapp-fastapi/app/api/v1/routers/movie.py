@@ -1,24 +1,37 @@
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Request, Response
 from humps import camelize
-from pydantic import BaseModel
+from pydantic import BaseModel, conint, constr
 from tortoise.exceptions import IntegrityError, OperationalError
 from tortoise.transactions import in_transaction
 
-from app.models.db.banlists import Banlists
-from app.models.db.funny_votes import FunnyVotes
-from app.models.db.helpful_votes import HelpfulVotes
+from app.core.rating_counters import rating_counters
+from app.core.search_indexer import search_indexer
 from app.models.db.movies import Movies
-from app.models.db.positions import Positions
 from app.models.db.ratings import Ratings
 from app.models.db.reviews import Reviews
-from app.models.db.spoiler_votes import SpoilerVotes
+from app.utils.banlist_cache import banlists
+from app.utils.banned_ratings import banned_ratings
+from app.utils.cursor import query_fingerprint
+from app.utils.etag import etag_matches, make_etag
+from app.utils.movie_details import CREW_SIZE, list_crew, movie_details
+from app.utils.movie_tiles import movie_tiles
 from app.utils.ratings import calc_average_rating
+from app.utils.unique_id import id as unique_id
+from app.utils.unique_id import to_uuid
 from app.utils.wrapper import ApiException, Wrapper, wrap
 
-from .review import ListReviewResponse, ReviewCreateDate, ReviewRequest, ReviewResponse
+from .review import (
+    ListReviewResponse,
+    ReviewCreateDate,
+    ReviewRequest,
+    delete_review,
+    page_reviews,
+    to_review_responses,
+    upsert_review,
+)
 
 router = APIRouter()
 override_prefix = None
@@ -62,12 +75,19 @@ class MovieResponse(BaseModel):
     num_votes: int
     average_rating: float
     crew: List[CrewMember]
+    num_crew: int
 
     class Config:
         alias_generator = camelize
         allow_population_by_field_name = True
 
 
+# a page of a movie's crew, in billing order
+class ListCrewResponse(BaseModel):
+    items: List[CrewMember]
+    total: int
+
+
 # represents a user's movie rating
 class RatingResponse(BaseModel):
     id: str
@@ -84,19 +104,15 @@ class AverageRatingResponse(BaseModel):
 async def get_average_rating(movie_id: str, request: Request) -> Wrapper[dict]:
     user_id = request.session.get("user_id")
 
-    # gets the relevant movie object
+    # gets the cached movie detail, which holds the rating aggregates
     try:
-        movie = (
-            await Movies.filter(movie_id=movie_id, delete_date=None)
-            .prefetch_related("genres")
-            .first()
-        )
+        detail = await movie_details.get(movie_id)
     except OperationalError:
         raise ApiException(
             401, 2070, "There was a problem fetching that movie's ratings."
         )
 
-    if movie is None:
+    if detail is None:
         raise ApiException(404, 2060, "That movie doesn't exist.")
 
     # passes the count and cumulative rating to our utility which produces the correct
@@ -105,64 +121,87 @@ async def get_average_rating(movie_id: str, request: Request) -> Wrapper[dict]:
         {
             "average": (
                 await calc_average_rating(
-                    movie.cumulative_rating, movie.num_votes, user_id, movie_id
+                    detail["cumulative_rating"], detail["num_votes"], user_id, movie_id
                 )
             )["average_rating"]
         }
     )
 
 
-# gets the detailed movie object
+# gets the detailed movie object. The viewer independent part is cached, see
+# app/utils/movie_details.py, and the response carries an ETag so that clients
+# can revalidate it with If-None-Match. Only the top `crew_limit` billed crew
+# members are included, see get_movie_crew() for the full crew
 @router.get("/{movie_id}", tags=["movies"], response_model=Wrapper[MovieResponse])
-async def get_movie(movie_id: str, request: Request):
+async def get_movie(
+    movie_id: str,
+    request: Request,
+    response: Response,
+    crew_limit: conint(ge=0, le=CREW_SIZE) = 10,
+):
     user_id = request.session.get("user_id")
     try:
-        movie = await Movies.filter(movie_id=movie_id, delete_date=None).first()
+        detail = await movie_details.get(movie_id)
     except OperationalError:
         raise ApiException(401, 2501, "An exception occurred")
 
-    if movie is None:
+    if detail is None:
         raise ApiException(404, 2100, "That movie doesn't exist")
 
-    # collect genres
-    genres = [genre.name for genre in await movie.genres]
-
-    # gets all people who worked on the film and then creates a
-    # crew object for each
-    crew = [
-        CrewMember(
-            id=str(p.person_id),
-            name=p.person.name,
-            position=p.position,
-            image=p.person.image,
-        )
-        for p in await Positions.filter(movie_id=movie_id).prefetch_related("person")
-    ]
-
     # get rating, with banned list taken into account
     rating = await calc_average_rating(
-        movie.cumulative_rating, movie.num_votes, user_id, movie_id
+        detail["cumulative_rating"], detail["num_votes"], user_id, movie_id
     )
 
     # final movie detail to return
     movie_detail = MovieResponse(
-        id=str(movie.movie_id),
-        title=movie.title,
-        release_date=str(movie.release_date),
-        release_year=str(movie.release_date.year),
-        description=movie.description,
-        image_url=movie.image,
-        trailers=movie.trailer,
-        num_reviews=movie.num_reviews,
+        id=detail["movie_id"],
+        title=detail["title"],
+        release_date=detail["release_date"],
+        release_year=detail["release_year"],
+        description=detail["description"],
+        image_url=detail["image"],
+        trailers=detail["trailers"],
+        num_reviews=detail["num_reviews"],
         num_votes=rating["num_votes"],
         average_rating=rating["average_rating"],
-        genres=genres,
-        crew=crew,
+        genres=detail["genres"],
+        crew=detail["crew"][:crew_limit],
+        num_crew=detail["num_crew"],
     )
 
+    # the response depends on the viewer's banlist, so it may only be
+    # cached by the client, which must revalidate it
+    headers = {
+        "ETag": make_etag(movie_detail.json()),
+        "Cache-Control": "private, no-cache",
+    }
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
     return wrap(movie_detail)
 
 
+# gets a page of the movie's crew, in billing order
+@router.get(
+    "/{movie_id}/crew", tags=["movies"], response_model=Wrapper[ListCrewResponse]
+)
+async def get_movie_crew(
+    movie_id: str,
+    page: conint(gt=0) = 1,
+    per_page: conint(gt=0, le=100) = 50,
+):
+    try:
+        detail = await movie_details.get(movie_id)
+        if detail is None:
+            raise ApiException(404, 2100, "That movie doesn't exist")
+        crew = await list_crew(movie_id, (page - 1) * per_page, per_page)
+    except OperationalError:
+        raise ApiException(401, 2501, "An exception occurred")
+
+    return wrap({"items": crew, "total": detail["num_crew"]})
+
+
 # REVIEW RELATED START
 
 # gets all reviews for a movie
@@ -175,6 +214,8 @@ async def get_movie_reviews(
     page: int = 0,
     per_page: int = 0,
     me: Optional[bool] = False,
+    cursor: Optional[str] = None,
+    sort: Optional[constr(regex=r"^(?:new|top)$")] = "new",  # noqa: F722
 ):
     # handle pagination parameters
     if per_page >= 42:
@@ -186,87 +227,30 @@ async def get_movie_reviews(
 
     # Return the review for current user only (for this movie)
     if me:
-        reviews = [
-            ReviewResponse(
-                review_id=str(r.review_id),
-                user_id=str(r.user_id),
-                username=r.user.username,
-                movie_id=str(r.movie_id),
-                movie_title=str(r.movie.title),
-                movie_year=str(r.movie.release_date),
-                create_date=str(r.create_date),
-                description=r.description,
-                contains_spoiler=r.contains_spoiler,
-                rating=r.rating.rating,
-                num_helpful=r.num_helpful,
-                num_funny=r.num_funny,
-                num_spoiler=r.num_spoiler,
-                flagged_helpful=await r.helpful_votes.filter(
-                    user_id=user_id, delete_date=None
-                ).count(),
-                flagged_funny=await r.funny_votes.filter(
-                    user_id=user_id, delete_date=None
-                ).count(),
-                flagged_spoiler=await r.spoiler_votes.filter(
-                    user_id=user_id, delete_date=None
-                ).count(),
-            )
-            for r in await Reviews.filter(
-                movie_id=movie_id, delete_date=None, user_id=user_id
-            )
-            .order_by("-create_date")
-            .offset((page - 1) * per_page)
-            .limit(per_page)
-            .prefetch_related(
-                "rating", "helpful_votes", "funny_votes", "spoiler_votes", "user", "movie"
-            )
-        ]
+        query = Reviews.filter(movie_id=movie_id, delete_date=None, user_id=user_id)
     # Return the review for all other users (for this movie)
     else:
         exclude_list = []
         if user_id is not None:
             exclude_list.append(user_id)
-            ban_list = await Banlists.filter(user_id=user_id, delete_date=None).values(
-                "banned_user_id"
-            )
-            for item in ban_list:
-                exclude_list.append(str(item["banned_user_id"]))
-
-        reviews = [
-            ReviewResponse(
-                review_id=str(r.review_id),
-                user_id=str(r.user_id),
-                username=r.user.username,
-                movie_id=str(r.movie_id),
-                movie_title=str(r.movie.title),
-                movie_year=str(r.movie.release_date),
-                create_date=str(r.create_date),
-                description=r.description,
-                contains_spoiler=r.contains_spoiler,
-                rating=r.rating.rating,
-                num_helpful=r.num_helpful,
-                num_funny=r.num_funny,
-                num_spoiler=r.num_spoiler,
-                flagged_helpful=await r.helpful_votes.filter(
-                    user_id=user_id, delete_date=None
-                ).count(),
-                flagged_funny=await r.funny_votes.filter(
-                    user_id=user_id, delete_date=None
-                ).count(),
-                flagged_spoiler=await r.spoiler_votes.filter(
-                    user_id=user_id, delete_date=None
-                ).count(),
-            )
-            for r in await Reviews.filter(movie_id=movie_id, delete_date=None)
-            .exclude(user_id__in=exclude_list)
-            .order_by("-create_date")
-            .offset((page - 1) * per_page)
-            .limit(per_page)
-            .prefetch_related(
-                "rating", "helpful_votes", "funny_votes", "spoiler_votes", "user", "movie"
-            )
-        ]
-    return wrap({"items": reviews})
+            exclude_list.extend(await banlists.get(user_id))
+        query = Reviews.filter(movie_id=movie_id, delete_date=None).exclude(
+            user_id__in=exclude_list
+        )
+
+    # Pass `cursor` (empty for the first page) for cursor pagination, and
+    # sort=top for the most helpful reviews first
+    sort = sort or "new"
+    rows, next_cursor = await page_reviews(
+        query,
+        page,
+        per_page,
+        cursor,
+        query_fingerprint("movie/reviews", movie_id, me, user_id, per_page, sort),
+        sort,
+    )
+    reviews = await to_review_responses(rows, user_id)
+    return wrap({"items": reviews, "cursor": next_cursor})
 
 
 # adds or modifies a review
@@ -291,41 +275,21 @@ async def create_update_user_review(
     if not user_id:
         raise ApiException(401, 2001, "You are not logged in!")
 
-    # attempt to add review to db
+    # attempt to add review to db, counting it on the movie if it is new
     try:
-        async with in_transaction():
-            rating = await (
-                Ratings.get_or_create(
-                    user_id=user_id,
-                    movie_id=movie_id,
-                )
-            )
-            create_date = datetime.now()
-            if await Reviews.filter(user_id=user_id, movie_id=movie_id):
-                await Reviews.filter(user_id=user_id, movie_id=movie_id).update(
-                    rating_id=rating[0].rating_id,
-                    delete_date=None,
-                    create_date=create_date,
-                    description=review.description,
-                    contains_spoiler=review.contains_spoiler,
-                )
-            else:
-                await Reviews(
-                    user_id=user_id,
-                    movie_id=movie_id,
-                    create_date=create_date,
-                    rating_id=rating[0].rating_id,
-                    description=review.description,
-                    contains_spoiler=review.contains_spoiler,
-                    delete_date=None,
-                ).save()
-            num_reviews = await Reviews.filter(
-                movie_id=movie_id, delete_date=None
-            ).count()
-            await Movies.filter(movie_id=movie_id).update(num_reviews=num_reviews)
+        rating = await Ratings.get_or_create(user_id=user_id, movie_id=movie_id)
+        create_date, _ = await upsert_review(
+            user_id,
+            movie_id,
+            rating[0].rating_id,
+            review.description,
+            review.contains_spoiler,
+        )
     except OperationalError:
         raise ApiException(500, 2080, "An exception occurred")
 
+    await movie_tiles.invalidate([movie_id])
+    await movie_details.invalidate([movie_id])
     return wrap({"create_date": create_date})
 
 
@@ -336,33 +300,14 @@ async def delete_user_review(movie_id: str, request: Request):
     if not user_id:
         raise ApiException(401, 2001, "You are not logged in!")
 
-    # attempt to remove from db
+    # attempt to remove from db, with its votes, uncounting it on the movie
     try:
-        async with in_transaction():
-            review = await Reviews.get_or_create(user_id=user_id, movie_id=movie_id)
-            await Reviews.filter(
-                user_id=user_id,
-                movie_id=movie_id,
-            ).update(delete_date=datetime.now())
-
-            await HelpfulVotes.filter(review_id=review[0].review_id).update(
-                delete_date=datetime.now()
-            )
-            await FunnyVotes.filter(review_id=review[0].review_id).update(
-                delete_date=datetime.now()
-            )
-            await SpoilerVotes.filter(review_id=review[0].review_id).update(
-                delete_date=datetime.now()
-            )
-
-            num_reviews = await Reviews.filter(
-                movie_id=movie_id, delete_date=None
-            ).count()
-            await Movies.filter(movie_id=movie_id).update(num_reviews=num_reviews)
-
+        await delete_review(user_id, movie_id)
     except OperationalError:
         raise ApiException(500, 2501, "An exception occurred")
 
+    await movie_tiles.invalidate([movie_id])
+    await movie_details.invalidate([movie_id])
     return wrap({})
 
 
@@ -381,54 +326,110 @@ async def rate_movie(request: Request, movie_id: str, rating: float):
         raise ApiException(500, 2073, "Invalid rating.")
 
     # attempt to add rating to db
+    await banned_ratings.rating_changing(user_id)
     try:
-        async with in_transaction():
-            existing_rating = await Ratings.get_or_none(
-                user_id=user_id, movie_id=movie_id
-            )
-            if existing_rating:
-                old_rating = existing_rating.rating
-                if existing_rating.delete_date:
-                    existing_rating.delete_date = None
-                    existing_rating.rating = rating
-                    await update_cumulative_rating(movie_id, rating)
-                else:
-                    existing_rating.rating = rating
-                    await update_cumulative_rating(movie_id, rating, old_rating)
-                await existing_rating.save(update_fields=["rating", "delete_date"])
-            else:
-                await Ratings.create(user_id=user_id, movie_id=movie_id, rating=rating)
-                await update_cumulative_rating(movie_id, rating)
-            current_rating = await Ratings.get(user_id=user_id, movie_id=movie_id)
-            await update_review_rating(user_id, movie_id, current_rating)
-    except OperationalError:
-        raise ApiException(500, 2072, "Could not rate movie.")
-    except IntegrityError:
+        rating_id, previous_rating = await upsert_rating(user_id, movie_id, rating)
+    except (OperationalError, IntegrityError):
+        await banned_ratings.rating_changed(user_id, movie_id, None, None)
         raise ApiException(500, 2072, "Could not rate movie.")
+    await banned_ratings.rating_changed(user_id, movie_id, previous_rating, rating)
+
+    await movie_tiles.invalidate([movie_id])
+    await movie_details.invalidate([movie_id])
+    search_indexer.mark_dirty(movie_id, user_id)
+    return wrap({"id": rating_id, "rating": rating})
+
 
-    return wrap({"id": str(current_rating.rating_id), "rating": current_rating.rating})
+# how often upsert_rating starts over when a concurrent first rating of the same
+# movie by the same user was inserted between its read and its upsert
+UPSERT_RATING_ATTEMPTS = 3
+
+
+class RatingInsertRace(Exception):
+    pass
+
+
+async def upsert_rating(
+    user_id: str, movie_id: str, rating: float
+) -> Tuple[str, Optional[float]]:
+    """
+    Saves the rating of a user for a movie in one transaction: it locks and reads
+    the user's rating row, then a single statement upserts the rating, points the
+    user's review at it and, unless the counters are written behind, updates the
+    movie's cumulative rating and num votes.
+    Whether the rating is new is decided by the upsert itself. If it updated a row
+    that was not there to lock, another request inserted it concurrently, and the
+    transaction is rolled back and started over.
+    Returns the rating id and the rating it replaced, None if it is a new one.
+    """
+    ctes = [
+        "rated AS (INSERT INTO ratings (rating_id, user_id, movie_id, rating, "
+        "create_date) VALUES ($3, $1, $2, $4, now()) "
+        "ON CONFLICT (user_id, movie_id) "
+        "DO UPDATE SET rating = EXCLUDED.rating, delete_date = NULL "
+        "RETURNING rating_id, (xmax = 0) AS inserted)",
+        "relinked AS (UPDATE reviews SET rating_id = rated.rating_id FROM rated "
+        "WHERE reviews.user_id = $1 AND reviews.movie_id = $2 "
+        "AND reviews.delete_date IS NULL)",
+    ]
+    if not rating_counters.enabled:
+        ctes.append(
+            "counted AS (UPDATE movies SET "
+            "cumulative_rating = cumulative_rating + $4 "
+            "- coalesce($5::float8, 0), "
+            "num_votes = num_votes + (CASE WHEN $5 IS NULL THEN 1 ELSE 0 END) "
+            "WHERE movie_id = $2 AND delete_date IS NULL)"
+        )
+    for attempt in range(UPSERT_RATING_ATTEMPTS):
+        try:
+            async with in_transaction() as conn:
+                # the row is locked even if it was deleted, so that concurrent
+                # ratings of the same movie by the user are applied one by one
+                locked = await conn.execute_query_dict(
+                    "SELECT rating, delete_date FROM ratings WHERE user_id = $1 "
+                    "AND movie_id = $2 FOR UPDATE",
+                    [user_id, movie_id],
+                )
+                previous_rating = None
+                if locked and locked[0]["delete_date"] is None:
+                    previous_rating = locked[0]["rating"]
+                values = [user_id, movie_id, to_uuid(unique_id()), rating]
+                if not rating_counters.enabled:
+                    values.append(previous_rating)
+                row = (
+                    await conn.execute_query_dict(
+                        "WITH {} SELECT rating_id, inserted FROM rated".format(
+                            ", ".join(ctes)
+                        ),
+                        values,
+                    )
+                )[0]
+                if not locked and not row["inserted"]:
+                    raise RatingInsertRace()
+            break
+        except RatingInsertRace:
+            if attempt == UPSERT_RATING_ATTEMPTS - 1:
+                raise OperationalError("Concurrent ratings kept conflicting")
+    if rating_counters.enabled:
+        await update_cumulative_rating(movie_id, rating, previous_rating)
+    return str(row["rating_id"]), previous_rating
 
 
 async def update_cumulative_rating(
-    movie_id: str, new_rating: float, old_rating: float = None
+    movie_id: str, new_rating: Optional[float], old_rating: Optional[float] = None
 ):
     """
-    Updates a given movie's cumulative rating and num votes fields.
-    If no old rating is provided, rating is assumed to a new or a deleted.
-    In case of a deleted rating, ensure that new_rating is a negative floating value.
+    Updates a given movie's cumulative rating and num votes fields, once the
+    rating has been saved. The change is written behind, see
+    app/core/rating_counters.py.
+    If no old rating is provided, the rating is assumed to be new. In case of a
+    deleted rating, new_rating is None.
     """
-    try:
-        async with in_transaction():
-            movie = await Movies.get_or_none(movie_id=movie_id, delete_date=None)
-            if movie:
-                if old_rating:
-                    movie.cumulative_rating += new_rating - old_rating
-                else:
-                    movie.num_votes += 1 if new_rating >= 0 else -1
-                    movie.cumulative_rating += new_rating
-                await movie.save(update_fields=["cumulative_rating", "num_votes"])
-    except OperationalError:
-        raise OperationalError
+    await rating_counters.record(
+        movie_id,
+        (new_rating or 0.0) - (old_rating or 0.0),
+        (new_rating is not None) - (old_rating is not None),
+    )
 
 
 async def update_review_rating(
@@ -460,6 +461,7 @@ async def delete_rating(request: Request, movie_id: str) -> Wrapper[dict]:
         raise ApiException(500, 2001, "You are not logged in!")
     rating_id = ""
     rating = None
+    await banned_ratings.rating_changing(user_id)
     try:
         async with in_transaction():
             existing_rating = await Ratings.get_or_none(
@@ -470,13 +472,17 @@ async def delete_rating(request: Request, movie_id: str) -> Wrapper[dict]:
                 rating = existing_rating.rating
                 existing_rating.delete_date = datetime.now()
                 await existing_rating.save(update_fields=["delete_date"])
-                await update_cumulative_rating(movie_id, -rating)
                 await update_review_rating(user_id, movie_id)
-    except OperationalError:
-        raise ApiException(500, 2071, "Could not find or delete rating")
-    except IntegrityError:
+    except (OperationalError, IntegrityError):
+        await banned_ratings.rating_changed(user_id, movie_id, None, None)
         raise ApiException(500, 2071, "Could not find or delete rating")
+    await banned_ratings.rating_changed(user_id, movie_id, rating, None)
 
+    if rating_id:
+        await update_cumulative_rating(movie_id, None, rating)
+        await movie_tiles.invalidate([movie_id])
+        await movie_details.invalidate([movie_id])
+        search_indexer.mark_dirty(movie_id, user_id)
     return wrap({"id": str(rating_id), "rating": rating})
 
 
@@ -3,25 +3,25 @@ Contains the API endpoints relating to Search and Recommendations
 """
 
 import math
-import re
 from datetime import datetime
 from random import choices
 from typing import Dict, List, Optional
 
 from dateutil.relativedelta import relativedelta
-from elasticsearch import RequestsHttpConnection, Urllib3HttpConnection
-from elasticsearch_dsl import Q, Search, connections
 from fastapi import APIRouter, Query, Request
 from humps import camelize
 from pydantic import BaseModel, conint, constr
 from tortoise.functions import Count
 
 from app.core.config import settings
-from app.models.db.banlists import Banlists
 from app.models.db.movies import Movies
 from app.models.db.ratings import Ratings
-from app.utils.dict_storage.redis import RedisDictStorageDriver
+from app.utils.banlist_cache import banlists
+from app.utils.cursor import decode_cursor, encode_cursor, query_fingerprint
+from app.utils.dict_storage.sharded import redis_dict_storage
+from app.utils.movie_tiles import movie_tiles, tile_average_rating
 from app.utils.recommender import load_movie_set, predict_on_movie, predict_on_user
+from app.utils.search_engines import SearchEngineBase, SearchHit, get_search_engine
 from app.utils.wrapper import ApiException, Wrapper, wrap
 
 router = APIRouter()
@@ -30,7 +30,7 @@ override_prefix_all = None
 
 search_cache_driver = None
 recommendation_cache_driver = None
-elasticsearch = None
+search_engine = None
 
 
 class FilterResponse(BaseModel):
@@ -82,12 +82,12 @@ async def init_search_cache_driver():
     """Initialise Redis connection for storing search history on startup."""
     global search_cache_driver
     if not search_cache_driver:
-        search_cache_driver = RedisDictStorageDriver(
+        search_cache_driver = redis_dict_storage(
+            settings.REDIS_SHARD_URIS or [settings.REDIS_URI],
             key_prefix="search:",
             key_filter=r"[^a-zA-Z0-9_-]+",
             ttl=settings.REDIS_SEARCH_TTL,
             renew_on_ttl=settings.REDIS_SEARCH_TTL,
-            redis_uri=settings.REDIS_URI,
             redis_pool_min=settings.REDIS_POOL_MIN,
             redis_pool_max=settings.REDIS_POOL_MAX,
         )
@@ -100,12 +100,12 @@ async def init_recommendation_cache_driver():
     """Initialise Redis connection for storing recommendation history on startup."""
     global recommendation_cache_driver
     if not recommendation_cache_driver:
-        recommendation_cache_driver = RedisDictStorageDriver(
+        recommendation_cache_driver = redis_dict_storage(
+            settings.REDIS_SHARD_URIS or [settings.REDIS_URI],
             key_prefix="recommendations:",
             key_filter=r"[^a-zA-Z0-9_-]+",
             ttl=settings.REDIS_SEARCH_TTL,
             renew_on_ttl=settings.REDIS_SEARCH_TTL,
-            redis_uri=settings.REDIS_URI,
             redis_pool_min=settings.REDIS_POOL_MIN,
             redis_pool_max=settings.REDIS_POOL_MAX,
         )
@@ -114,22 +114,13 @@ async def init_recommendation_cache_driver():
 
 
 @router.on_event("startup")
-def connect_elasticsearch():
-    """Initialise Elasticsearch connection on startup."""
-    global elasticsearch
-    if not elasticsearch:
-        elasticsearch = connections.create_connection(
-            hosts=settings.ELASTICSEARCH_URI,
-            alias=settings.ELASTICSEARCH_ALIAS,
-            connection_class=RequestsHttpConnection
-            if settings.ELASTICSEARCH_TRANSPORTCLASS == "RequestsHttpConnection"
-            else Urllib3HttpConnection,
-            timeout=settings.ELASTICSEARCH_TIMEOUT,
-            use_ssl=settings.ELASTICSEARCH_USESSL,
-            verify_certs=settings.ELASTICSEARCH_VERIFYCERTS,
-            ssl_show_warn=settings.ELASTICSEARCH_SHOWSSLWARNINGS,
-        )
-    return elasticsearch
+async def init_search_engine() -> SearchEngineBase:
+    """Initialise the search engine selected by SEARCH_ENGINE on startup."""
+    global search_engine
+    if not search_engine:
+        search_engine = get_search_engine(settings.SEARCH_ENGINE)
+        await search_engine.initialize_engine()
+    return search_engine
 
 
 @router.on_event("shutdown")
@@ -139,6 +130,13 @@ async def terminate_recommendation_cache_driver():
     await recommendation_cache_driver.terminate_driver()
 
 
+@router.on_event("shutdown")
+async def terminate_search_engine():
+    """Terminate the search engine"""
+    if search_engine:
+        await search_engine.terminate_engine()
+
+
 @router.on_event("shutdown")
 async def terminate_search_cache_driver():
     """Terminate search history Redis driver"""
@@ -146,6 +144,14 @@ async def terminate_search_cache_driver():
     await search_cache_driver.terminate_driver()
 
 
+async def get_listban(request: Request) -> List[str]:
+    """Returns the user ids banned by the current user."""
+    user_id = request.session.get("user_id")
+    if user_id is None:
+        return []
+    return sorted(await banlists.get(user_id))
+
+
 @router.get("/", tags=["movies"], response_model=Wrapper[Dict])
 async def search_movies(
     request: Request,
@@ -163,10 +169,15 @@ async def search_movies(
     )[0],
     desc: Optional[bool] = True,
     field: Optional[str] = "all",
+    cursor: Optional[str] = None,
 ):
     """
-    Main entrypoint for keyword search for movies using Elasticsearch.
+    Main entrypoint for keyword search for movies using the search engine.
     See docstring for get_movies().
+
+    Passing `cursor` (empty for the first page) switches to cursor pagination, which
+    is not limited to the first ELASTICSEARCH_RESPONSESIZE results. See docstring for
+    get_movies_after().
     """
 
     return wrap(
@@ -182,10 +193,57 @@ async def search_movies(
             desc=desc if desc is not None else True,
             cache_result=True,
             field=field or "all",
+            cursor=cursor,
         )
     )
 
 
+def to_search_response(movie: Dict, score: float) -> SearchResponse:
+    """Converts a movie document with its `average_rating` script field to a tile."""
+    return SearchResponse(
+        id=movie["movie_id"],
+        title=movie["title"],
+        release_year=movie["release_date"][0:4],
+        genres=[genre["name"] for genre in movie["genres"] or []],
+        image_url=movie["image"],
+        average_rating=float(movie["average_rating"][0]),
+        num_votes=float(movie["average_rating"][1]),
+        cumulative_rating=float(movie["average_rating"][2]),
+        score=float(score or 0),
+    )
+
+
+def tile_to_document(tile: Dict, average_rating: List[float]) -> Dict:
+    """Converts a movie tile to the movie document format used by
+    process_movie_payload(), with the given `average_rating` script field."""
+    return {
+        "movie_id": tile["movie_id"],
+        "title": tile["title"],
+        "image": tile["image"],
+        "release_date": tile["release_date"],
+        "genres": [{"name": genre} for genre in tile["genres"]],
+        "positions": [
+            {"position": "director", "people": {"name": director}}
+            for director in tile["directors"]
+        ],
+        "average_rating": average_rating,
+    }
+
+
+async def movie_hits_to_payload(hits: List[SearchHit]) -> Dict:
+    """Hydrates search hits, which only carry the movie id, score and the banlist
+    adjusted rating, into a movie payload using one batch tile cache lookup."""
+    tiles = await movie_tiles.get_many(hit.movie_id for hit in hits)
+    return {
+        hit.movie_id: {
+            "score": hit.score,
+            "movie": tile_to_document(tiles[hit.movie_id], list(hit.average_rating)),
+        }
+        for hit in hits
+        if hit.movie_id in tiles
+    }
+
+
 async def process_movie_payload(
     preprocessed: Dict,
     year_filter: List[str],
@@ -197,7 +255,7 @@ async def process_movie_payload(
     desc: bool,
 ) -> Dict:
     """
-    Given a preprocessed Elasticsearch response payload, apply filters, sorting and
+    Given a preprocessed search response payload, apply filters, sorting and
     pagination, and returns an ordered array of SearchResponse objects each representing
     a movie tile.
     """
@@ -337,17 +395,7 @@ async def process_movie_payload(
     # Convert to SearchResponse objects
     for i in range(len(postprocessed)):
         movie = postprocessed[i]
-        postprocessed[i] = SearchResponse(
-            id=movie["movie"]["movie_id"],
-            title=movie["movie"]["title"],
-            release_year=movie["movie"]["release_date"][0:4],
-            genres=[genre["name"] for genre in movie["movie"]["genres"]],
-            image_url=movie["movie"]["image"],
-            average_rating=float(movie["movie"]["average_rating"][0]),
-            num_votes=float(movie["movie"]["average_rating"][1]),
-            cumulative_rating=float(movie["movie"]["average_rating"][2]),
-            score=float(movie["score"]),
-        )
+        postprocessed[i] = to_search_response(movie["movie"], movie["score"])
 
     response = {
         "movies": postprocessed,
@@ -371,10 +419,11 @@ async def get_movies(
     desc: bool = True,
     cache_result: bool = False,
     field: str = "all",
+    cursor: Optional[str] = None,
 ) -> Dict:
-    """Performs Elasticsearch query to obtain movie payload.
+    """Performs a search engine query to obtain movie payload.
 
-    Used by both Search and Recommendations. Elasticsearch query will use the keyword
+    Used by both Search and Recommendations. The search engine will use the keyword
     term to search, and any movie ids provided in movies will be looked up and added
     to the movie payload.
 
@@ -390,6 +439,8 @@ async def get_movies(
         desc: boolean specifying sort order. Default is descending order.
         cache_result: bool whether the Redis should be used to store resulting movie ids in memory.
         field: string indicating the user's chosen search type in the search bar.
+        cursor: an opaque cursor, if not None the search is delegated to
+            get_movies_after() and page is ignored.
 
     Returns:
         A dict response object structured as follows:
@@ -407,6 +458,19 @@ async def get_movies(
         years = []
     if directors is None:
         directors = []
+    if cursor is not None and movies is None:
+        return await get_movies_after(
+            request=request,
+            keywords=keywords,
+            genres=genres,
+            years=years,
+            directors=directors,
+            per_page=per_page,
+            sort=sort,
+            desc=desc,
+            field=field,
+            cursor=cursor,
+        )
     if cache_result and keywords is not None:
         global search_cache_driver
         if not search_cache_driver:
@@ -417,6 +481,7 @@ async def get_movies(
         if field != "all":
             session_name = field + "_searches"
 
+        await request.session.load(session_name)
         searches = request.session.get(session_name, {})
         try:
             search_id = searches[keywords]
@@ -428,128 +493,232 @@ async def get_movies(
             request.session[session_name] = searches
 
         # Attempt to retrieve stored movie payload from Redis
-        # If found, return the result without querying Elasticsearch
+        # If found, return the result without querying the search engine
         payload, _ = await search_cache_driver.get(search_id)
         if payload:
             return await process_movie_payload(
                 payload, years, directors, genres, per_page, page, sort, desc
             )
 
-    global elasticsearch
-    if not elasticsearch:
-        connect_elasticsearch()
+    engine = await init_search_engine()
 
-    # Build query context for scoring results
-    years_in_keywords: List[str] = (
-        re.findall(r"(\d{4})", keywords) if keywords is not None else []
+    # Get user's banlist and provide this to the search engine
+    hits = await engine.search(
+        keywords,
+        field,
+        movies,
+        await get_listban(request),
+        size=settings.ELASTICSEARCH_RESPONSESIZE,
     )
 
-    # Support different search types selected via search bar
-    fields = []
-    if field == "all":
-        fields = [
-            "title^10",
-            "description",
-            "genres.name.keyword",
-            "positions.people.name",
-            "positions.char_name",
-        ]
-    if field == "title":
-        fields = ["title"]
-    elif field == "description":
-        fields = ["description"]
-    elif field == "genres":
-        fields = ["genres.name"]
-    elif field == "people":
-        fields = ["positions.people.name"]
-
-    # Match on fields and consider numbers in keyword as years if present
-    queries = [
-        Q(
-            "bool",
-            must=[
-                Q(
-                    "multi_match",
-                    query=keywords,
-                    fields=fields,
-                )
-            ]
-            if keywords is not None
-            else [],
-            should=[
-                Q(
-                    {
-                        "bool": {
-                            "should": [
-                                {
-                                    "range": {
-                                        "release_date": {
-                                            "gte": year + "||/y",
-                                            "lte": year + "||/y",
-                                            "format": "yyyy",
-                                        }
-                                    }
-                                },
-                            ],
-                        },
-                    }
-                )
-                for year in years_in_keywords
-            ]
-            + (
-                [Q("match", movie_id=movie_id) for movie_id in movies]
-                if movies is not None
-                else []
-            ),
-            minimum_should_match=(
-                1 if ((movies is not None) or years_in_keywords) else 0
-            ),
-        )
-    ]
+    preprocessed = await movie_hits_to_payload(hits)
+
+    if cache_result and keywords is not None:
+        # Save response in Redis
+        await search_cache_driver.update(search_id, preprocessed)
 
-    search = Search(using=elasticsearch, index=settings.ELASTICSEARCH_MOVIEINDEX).extra(
-        size=settings.ELASTICSEARCH_RESPONSESIZE
+    postprocessed = await process_movie_payload(
+        preprocessed, years, directors, genres, per_page, page, sort, desc
     )
 
-    for q in queries:
-        search = search.query(q)
+    return postprocessed
 
-    # Get user's banlist and provide this to Elasticsearch
-    list_ban = ""
-    user_id = request.session.get("user_id")
-    if user_id is not None:
-        user_ban_list = await Banlists.filter(user_id=user_id, delete_date=None).values(
-            "banned_user_id"
-        )
-        user_ban_list = [str(item["banned_user_id"]) for item in user_ban_list]
-        list_ban = ",".join(user_ban_list)
 
-    search = search.script_fields(
-        average_rating={
-            "script": {"id": "calculate_rating_field", "params": {"listban": list_ban}}
-        }
-    )
+async def hydrate_movies(
+    request: Request,
+    movies: List[str],
+    genres: Optional[List[str]] = None,
+    years: Optional[List[str]] = None,
+    directors: Optional[List[str]] = None,
+    per_page: int = 1,
+    page: int = 1,
+    sort: str = ("relevance", "rating", "name", "year")[0],
+    desc: bool = True,
+) -> Dict:
+    """Looks up a ranked list of known movie ids, such as the output of the
+    recommender, with a single batch lookup in the movie tile cache.
 
-    # Execute search
-    search = search.source(
-        ["movie_id", "image", "title", "genres", "release_date", "positions"]
-    )
-    response = search.execute()
+    Banlist adjusted ratings are fetched with one cheap search engine lookup, which is
+    skipped when the current user has not banned anyone. The rank of each id is used
+    as its relevance score, so sorting by relevance preserves the given order.
+    Filters, sorting and pagination are applied the same way as in get_movies().
+
+    Args:
+        movies: a list of strings representing each movie_id to be retrieved, best first
+        (other arguments are the same as get_movies())
+
+    Returns:
+        The same response object as get_movies().
+    """
+
+    # Drop duplicates but keep the first (best) rank of each movie
+    movies = list(dict.fromkeys(movies))
+    rank = {movie_id: float(len(movies) - i) for i, movie_id in enumerate(movies)}
+
+    tiles = await movie_tiles.get_many(movies)
+    list_ban = await get_listban(request)
+    if list_ban and tiles:
+        engine = await init_search_engine()
+        ratings = await engine.ratings(list(tiles), list_ban)
+    else:
+        ratings = {
+            movie_id: tile_average_rating(tile) for movie_id, tile in tiles.items()
+        }
 
     preprocessed = {
-        hit.meta.id: {"score": hit.meta.score, "movie": hit.to_dict()}
-        for hit in response
+        movie_id: {
+            "score": rank[movie_id],
+            "movie": tile_to_document(tile, ratings[movie_id]),
+        }
+        for movie_id, tile in tiles.items()
+        if movie_id in ratings
     }
 
-    if cache_result and keywords is not None:
-        # Save response in Redis
-        await search_cache_driver.update(search_id, preprocessed)
+    return await process_movie_payload(
+        preprocessed,
+        years or [],
+        directors or [],
+        genres or [],
+        per_page,
+        page,
+        sort,
+        desc,
+    )
 
-    postprocessed = await process_movie_payload(
-        preprocessed, years, directors, genres, per_page, page, sort, desc
+
+async def get_movies_after(
+    request: Request,
+    keywords: Optional[str] = None,
+    genres: Optional[List[str]] = None,
+    years: Optional[List[str]] = None,
+    directors: Optional[List[str]] = None,
+    per_page: int = 1,
+    sort: str = ("relevance", "rating", "name", "year")[0],
+    desc: bool = True,
+    field: str = "all",
+    cursor: str = "",
+) -> Dict:
+    """Performs a cursor paginated search to obtain one page of movies.
+
+    Unlike get_movies(), filtering, sorting and pagination are all done by the
+    search engine: pages are walked on the sort values plus `movie_id` as a stable
+    tiebreaker, so every page fetches only `per_page` hits no matter how deep it is.
+    Empty keywords match every movie.
+
+    Args:
+        keywords: a string representing the user's search term as entered into
+            the search bar.
+        genres: a list of strings representing desired genres to match.
+        years: a list of strings representing desired years to match.
+        directors: a list of strings representing desired director names to match.
+        per_page: int specifying how many results to return per page.
+        sort: string indicating sort field. Possible values are relevance, rating,
+            name and year.
+        desc: boolean specifying sort order. Default is descending order.
+        field: string indicating the user's chosen search type in the search bar.
+        cursor: the opaque cursor returned with the previous page, or an empty string
+            for the first page.
+
+    Returns:
+        A dict response object structured as follows:
+            response = {
+                "movies": movies,
+                "filters": [genre_selections, director_selections, year_selections],
+                "total": total_pages,
+                "cursor": next_cursor,
+            }
+        where movies is a list of SearchResponse objects, filters is only populated on
+        the first page, and next_cursor is None on the last page. Director selections
+        are empty if the search engine cannot count directors.
+
+    Raises:
+        ApiException: 400 if the cursor is invalid, or if directors are given and
+            the search engine cannot filter on them.
+    """
+
+    genres = genres or []
+    years = years or []
+    directors = directors or []
+
+    fingerprint = query_fingerprint(
+        keywords, genres, years, directors, per_page, sort, desc, field
     )
+    try:
+        after = decode_cursor(cursor, fingerprint) if cursor else None
+    except ValueError:
+        raise ApiException(400, 2702, "Invalid cursor")
+
+    engine = await init_search_engine()
+    if directors and not engine.filters_directors:
+        raise ApiException(
+            400, 2703, "Directors cannot be filtered on with cursor pagination"
+        )
 
-    return postprocessed
+    page = await engine.search_page(
+        keywords=keywords,
+        genres=genres,
+        years=years,
+        directors=directors,
+        per_page=per_page,
+        sort=sort,
+        desc=desc,
+        field=field,
+        after=after,
+        list_ban=await get_listban(request),
+        facets=after is None,
+    )
+
+    movies = [
+        to_search_response(movie["movie"], movie["score"])
+        for movie in (await movie_hits_to_payload(page.hits)).values()
+    ]
+
+    selections = []
+    if page.genres is not None and page.years is not None:
+        selections = [
+            FilterResponse(
+                type="list",
+                name="Genre",
+                key="genre",
+                selections=sorted(
+                    (
+                        {"key": name, "name": name, "count": count}
+                        for name, count in page.genres
+                    ),
+                    key=lambda x: x["name"],
+                ),
+            ),
+            FilterResponse(
+                type="list",
+                name="Directors",
+                key="director",
+                selections=sorted(
+                    (
+                        {"key": name, "name": name, "count": count}
+                        for name, count in page.directors or []
+                    ),
+                    key=lambda x: x["name"],
+                ),
+            ),
+            FilterResponse(
+                type="slide",
+                name="Year",
+                key="year",
+                selections=[
+                    {"key": year, "name": year, "count": count}
+                    for year, count in page.years
+                ],
+            ),
+        ]
+
+    return {
+        "movies": movies,
+        "filters": selections,
+        "total": math.ceil(page.total / per_page),
+        "cursor": encode_cursor(page.after, fingerprint)
+        if page.after is not None
+        else None,
+    }
 
 
 @router.get(
@@ -569,61 +738,16 @@ async def get_suggestion(
         a dict with key "items" containing an array of MovieSuggestion objects
     """
 
-    global elasticsearch
-    if not elasticsearch:
-        elasticsearch = connect_elasticsearch()
-
-    fields = []
-    if field == "all":
-        fields = [
-            "title^10",
-            "description",
-            "genres.name.keyword",
-            "positions.people.name",
-            "positions.char_name",
-        ]
-    if field == "title":
-        fields = ["title"]
-    elif field == "description":
-        fields = ["description"]
-    elif field == "genres":
-        fields = ["genres.name"]
-    elif field == "people":
-        fields = ["positions.people.name"]
-
-    queries = [
-        Q(
-            "bool",
-            must=[
-                Q(
-                    "multi_match",
-                    query=keyword,
-                    fields=fields,
-                )
-            ],
-        )
-    ]
-
-    search = Search(using=elasticsearch, index=settings.ELASTICSEARCH_MOVIEINDEX).extra(
-        size=limit
-    )
-
-    for q in queries:
-        search = search.query(q)
-
-    search = search.source(["movie_id", "title", "image", "release_date"])
-
-    search = search.sort({"_score": {"order": "desc"}})
-    response = search.execute()
+    engine = await init_search_engine()
 
     suggestions = [
         MovieSuggestion(
-            id=hit.movie_id,
-            title=hit.title,
-            release_date=hit.release_date,
-            image_url=hit.image,
+            id=hit["movie_id"],
+            title=hit["title"],
+            release_date=hit["release_date"],
+            image_url=hit.get("image"),
         )
-        for hit in response
+        for hit in await engine.suggest(keyword, limit, field)
     ]
 
     return wrap({"items": suggestions})
@@ -699,6 +823,7 @@ async def get_recommendation(
         if not user_id:
             raise ApiException(500, 2001, "You are not logged in!")
         # Check if foryou has been generated recently
+        await request.session.load("recommendations")
         searches = request.session.get("recommendations", {})
         try:
             search_id = searches["foryou"]
@@ -738,6 +863,7 @@ async def get_recommendation(
         if not movie_id:
             raise ApiException(404, 2060, "That movie doesn't exist.")
         # Check if movie has had recommendations calculated on it within same session
+        await request.session.load("recommendations")
         searches = request.session.get("recommendations", {})
         try:
             search_id = searches[movie_id]
@@ -809,7 +935,7 @@ async def get_recommendation(
         ]
         postprocessed = movies
     else:
-        postprocessed = await get_movies(
+        postprocessed = await hydrate_movies(
             request=request,
             movies=movies,
             genres=genres,
@@ -819,7 +945,6 @@ async def get_recommendation(
             page=page or 1,
             sort=sort or ("relevance", "rating", "name", "year")[0],
             desc=desc if desc is not None else True,
-            cache_result=False,
         )
         # Cache postprocessed payload for Popular, which is only visible to logged out users (no banlist required)
         if type == "popular":
@@ -1,17 +1,22 @@
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 from fastapi import APIRouter, Request
 from humps import camelize
 from pydantic import BaseModel
+from tortoise import Tortoise
 from tortoise.exceptions import OperationalError
+from tortoise.query_utils import Q
+from tortoise.queryset import QuerySet
 from tortoise.transactions import in_transaction
 
-from app.models.db.funny_votes import FunnyVotes
-from app.models.db.helpful_votes import HelpfulVotes
-from app.models.db.movies import Movies
 from app.models.db.reviews import Reviews
-from app.models.db.spoiler_votes import SpoilerVotes
+from app.utils.cursor import decode_cursor, encode_cursor, query_fingerprint
+from app.utils.movie_details import movie_details
+from app.utils.movie_tiles import movie_tiles
+from app.utils.review_rank import rank_score_sql
+from app.utils.unique_id import id as unique_id
+from app.utils.unique_id import to_uuid
 from app.utils.wrapper import ApiException, Wrapper, wrap
 
 router = APIRouter()
@@ -61,13 +66,377 @@ class ReviewResponse(BaseModel):
         allow_population_by_field_name = True
 
 
+# the cursor of the next page is only returned with cursor
+# pagination, and is None on the last page
 class ListReviewResponse(BaseModel):
     items: List[ReviewResponse]
+    cursor: Optional[str]
+
+
+# the kinds of votes a user has given, in one query over the
+# vote tables for all the reviews of a page
+VOTE_FLAGS_SQL = " UNION ALL ".join(
+    "SELECT '{0}' AS kind, review_id FROM {0}_votes WHERE user_id = $1 "
+    "AND review_id = ANY($2::uuid[]) AND delete_date IS NULL".format(kind)
+    for kind in ("helpful", "funny", "spoiler")
+)
+
+
+async def load_vote_flags(
+    user_id: Optional[str], review_ids: Iterable[str]
+) -> Dict[str, Set[str]]:
+    """
+    Returns the kinds of votes ("helpful", "funny", "spoiler") the user
+    has given to each of the reviews, leaving out reviews they have not
+    voted on. Anonymous users have no votes and cost no query.
+    """
+    review_ids = [str(review_id) for review_id in review_ids]
+    if user_id is None or not review_ids:
+        return {}
+    flags: Dict[str, Set[str]] = {}
+    for row in await Tortoise.get_connection("default").execute_query_dict(
+        VOTE_FLAGS_SQL, [str(user_id), review_ids]
+    ):
+        flags.setdefault(str(row["review_id"]), set()).add(row["kind"])
+    return flags
+
+
+# the columns review listings need, with the author, movie and rating
+# joined in the same query. Listings should not prefetch the votes, which
+# would load every vote of every review on the page
+REVIEW_FIELDS = (
+    "review_id",
+    "user_id",
+    "user__username",
+    "movie_id",
+    "movie__title",
+    "movie__release_date",
+    "create_date",
+    "description",
+    "contains_spoiler",
+    "rating__rating",
+    "num_helpful",
+    "num_funny",
+    "num_spoiler",
+    "rank_score",
+)
+
+
+def to_review_response(row: dict, flags: Set[str]) -> ReviewResponse:
+    return ReviewResponse(
+        review_id=str(row["review_id"]),
+        user_id=str(row["user_id"]),
+        username=row["user__username"],
+        movie_id=str(row["movie_id"]),
+        movie_title=str(row["movie__title"]),
+        movie_year=str(row["movie__release_date"]),
+        create_date=str(row["create_date"]),
+        description=row["description"],
+        contains_spoiler=row["contains_spoiler"],
+        rating=row["rating__rating"],
+        num_helpful=row["num_helpful"],
+        num_funny=row["num_funny"],
+        num_spoiler=row["num_spoiler"],
+        flagged_helpful="helpful" in flags,
+        flagged_funny="funny" in flags,
+        flagged_spoiler="spoiler" in flags,
+    )
+
+
+# builds the responses for a page of reviews (rows of REVIEW_FIELDS),
+# flagged with the votes of the viewer
+async def to_review_responses(
+    rows: List[dict], user_id: Optional[str]
+) -> List[ReviewResponse]:
+    flags = await load_vote_flags(user_id, [row["review_id"] for row in rows])
+    return [
+        to_review_response(row, flags.get(str(row["review_id"]), set()))
+        for row in rows
+    ]
+
+
+# the most reviews a page can have
+MAX_REVIEWS_PER_PAGE = 41
+
+# the orders reviews can be listed in, newest first, or top first on their
+# rank score (see app/utils/review_rank.py). Both end with (create_date,
+# review_id), which is unique, so that pages can be walked with a cursor
+REVIEW_SORTS = {
+    "new": ("create_date", "review_id"),
+    "top": ("rank_score", "create_date", "review_id"),
+}
+
+
+def to_cursor_value(field: str, value):
+    if field == "create_date":
+        return value.isoformat()
+    if field == "review_id":
+        return str(value)
+    return value
+
+
+def from_cursor_value(field: str, value):
+    if field == "create_date":
+        return datetime.fromisoformat(value)
+    if field == "review_id":
+        return to_uuid(value)
+    return float(value)
+
+
+def after_filter(fields: Tuple[str, ...], values: List) -> Q:
+    """
+    Returns the filter of the rows that come after the given values in the
+    descending order of the fields. The range on the first field alone is
+    what the index scans.
+    """
+    after = Q(**{fields[-1] + "__lt": values[-1]})
+    for field, value in zip(fields[-2::-1], values[-2::-1]):
+        after = Q(**{field + "__lt": value}) | (Q(**{field: value}) & after)
+    return Q(**{fields[0] + "__lte": values[0]}) & after
+
+
+async def page_reviews(
+    query: QuerySet,
+    page: int,
+    per_page: int,
+    cursor: Optional[str],
+    fingerprint: str,
+    sort: str = "new",
+) -> Tuple[List[dict], Optional[str]]:
+    """
+    Returns one page of the reviews of a query as rows of REVIEW_FIELDS, in
+    the given REVIEW_SORTS order, and the cursor of the next page.
+
+    With a cursor (empty for the first page), pages are walked on the sort
+    fields using the indexes added by `poetry run setup`, so a deep page
+    costs the same as the first. Otherwise pages are taken at an offset,
+    and no cursor is returned.
+    """
+    fields = REVIEW_SORTS[sort]
+    query = query.order_by(*("-" + field for field in fields))
+    if cursor is None:
+        rows = (
+            await query.offset(max(page - 1, 0) * per_page)
+            .limit(per_page)
+            .values(*REVIEW_FIELDS)
+        )
+        return rows, None
+
+    try:
+        if cursor:
+            after = decode_cursor(cursor, fingerprint)
+            if len(after) != len(fields):
+                raise ValueError("Cursor does not match the sort")
+            query = query.filter(
+                after_filter(
+                    fields,
+                    [
+                        from_cursor_value(field, value)
+                        for field, value in zip(fields, after)
+                    ],
+                )
+            )
+    except (TypeError, ValueError):
+        raise ApiException(400, 2702, "Invalid cursor")
+
+    per_page = per_page or MAX_REVIEWS_PER_PAGE
+    rows = await query.limit(per_page + 1).values(*REVIEW_FIELDS)
+    if len(rows) <= per_page:
+        return rows, None
+    rows = rows[:per_page]
+    return rows, encode_cursor(
+        [to_cursor_value(field, rows[-1][field]) for field in fields], fingerprint
+    )
+
+
+# locks the review row of a user for a movie, deleted or not, before it is
+# upserted, so that concurrent posts of the review are applied one by one
+LOCK_REVIEW_SQL = (
+    "SELECT delete_date FROM reviews WHERE user_id = $1 AND movie_id = $2 "
+    "FOR UPDATE"
+)
+
+# upserts a review and, when the user had no live review for the movie,
+# counts it on the movie in the same statement: a review the upsert inserted,
+# (xmax = 0), always counts, a replaced one counts by $7, 1 if the locked row
+# was deleted. A deleted review that is posted again starts over with no
+# votes, as its votes were deleted with it
+UPSERT_REVIEW_SQL = (
+    "WITH reviewed AS (INSERT INTO reviews (review_id, user_id, movie_id, "
+    "rating_id, description, contains_spoiler, num_spoiler, num_helpful, "
+    "num_funny, create_date) VALUES ($3, $1, $2, $4, $5, $6, 0, 0, 0, now()) "
+    "ON CONFLICT (user_id, movie_id) DO UPDATE SET "
+    "rating_id = EXCLUDED.rating_id, description = EXCLUDED.description, "
+    "contains_spoiler = EXCLUDED.contains_spoiler, "
+    "create_date = EXCLUDED.create_date, delete_date = NULL, "
+    "num_spoiler = CASE WHEN reviews.delete_date IS NULL "
+    "THEN reviews.num_spoiler ELSE 0 END, "
+    "num_helpful = CASE WHEN reviews.delete_date IS NULL "
+    "THEN reviews.num_helpful ELSE 0 END, "
+    "num_funny = CASE WHEN reviews.delete_date IS NULL "
+    "THEN reviews.num_funny ELSE 0 END, "
+    "rank_score = CASE WHEN reviews.delete_date IS NULL "
+    "THEN reviews.rank_score ELSE 0 END "
+    "RETURNING create_date, (xmax = 0) AS inserted), "
+    "delta AS (SELECT create_date, inserted, "
+    "CASE WHEN inserted THEN 1 ELSE $7::int END AS d FROM reviewed), "
+    "counted AS (UPDATE movies SET num_reviews = num_reviews + delta.d "
+    "FROM delta WHERE movie_id = $2) "
+    "SELECT create_date, inserted, d <> 0 AS created FROM delta"
+)
+
+# how often upsert_review starts over when a concurrent first post of the
+# review was inserted between its lock and its upsert
+UPSERT_REVIEW_ATTEMPTS = 3
+
+
+class ReviewInsertRace(Exception):
+    pass
+
+
+# deletes the live review of a user for a movie along with its votes, and
+# uncounts it on the movie in the same statement
+DELETE_REVIEW_SQL = (
+    "WITH deleted AS (UPDATE reviews SET delete_date = now() WHERE user_id = $1 "
+    "AND movie_id = $2 AND delete_date IS NULL RETURNING review_id), "
+    + "".join(
+        "{0} AS (UPDATE {0}_votes SET delete_date = now() WHERE review_id IN "
+        "(SELECT review_id FROM deleted) AND delete_date IS NULL), ".format(kind)
+        for kind in ("helpful", "funny", "spoiler")
+    )
+    + "counted AS (UPDATE movies SET num_reviews = num_reviews - "
+    "(SELECT count(*) FROM deleted) WHERE movie_id = $2) "
+    "SELECT count(*) AS deleted FROM deleted"
+)
+
+# adds a vote of a user to a live review, counting it on the review only
+# if the user had not already given it
+VOTE_SQL = (
+    "WITH review AS (SELECT review_id FROM reviews WHERE review_id = $1 "
+    "AND delete_date IS NULL), "
+    "voted AS (INSERT INTO {kind}_votes ({kind}_vote_id, user_id, review_id, "
+    "create_date) SELECT $3, $2, review_id, now() FROM review "
+    "ON CONFLICT (user_id, review_id) DO UPDATE SET delete_date = NULL "
+    "WHERE {kind}_votes.delete_date IS NOT NULL RETURNING 1), "
+    "delta AS (SELECT count(*) AS d FROM voted), "
+    "counted AS (UPDATE reviews SET num_{kind} = num_{kind} + delta.d{rank} "
+    "FROM delta WHERE review_id IN (SELECT review_id FROM review) "
+    "RETURNING num_{kind}, delta.d) "
+    "SELECT d <> 0 AS changed, num_{kind} AS count FROM counted"
+)
+
+# removes a vote of a user from a live review, uncounting it on the review
+# only if the user had given it
+UNVOTE_SQL = (
+    "WITH unvoted AS (UPDATE {kind}_votes SET delete_date = now() "
+    "WHERE review_id = $1 AND user_id = $2 AND delete_date IS NULL RETURNING 1), "
+    "delta AS (SELECT -count(*) AS d FROM unvoted), "
+    "counted AS (UPDATE reviews SET num_{kind} = num_{kind} + delta.d{rank} "
+    "FROM delta WHERE review_id = $1 AND delete_date IS NULL "
+    "RETURNING num_{kind}, delta.d) "
+    "SELECT d <> 0 AS changed, num_{kind} AS count FROM counted"
+)
+
+
+def vote_sql(kind: str, voted: bool) -> str:
+    """Returns the VOTE_SQL or UNVOTE_SQL statement of a kind of vote, which
+    also updates the rank score of the review if the kind counts towards it."""
+    num_helpful, num_spoiler = "num_helpful", "num_spoiler"
+    if kind == "helpful":
+        num_helpful += " + delta.d"
+    elif kind == "spoiler":
+        num_spoiler += " + delta.d"
+    rank = (
+        ", rank_score = " + rank_score_sql(num_helpful, num_spoiler)
+        if kind in ("helpful", "spoiler")
+        else ""
+    )
+    return (VOTE_SQL if voted else UNVOTE_SQL).format(kind=kind, rank=rank)
+
+
+async def upsert_review(
+    user_id: str,
+    movie_id: str,
+    rating_id: str,
+    description: str,
+    contains_spoiler: bool,
+) -> Tuple[datetime, bool]:
+    """
+    Saves the review of a user for a movie and keeps the movie's num reviews
+    in the same statement, after locking the review row in the same
+    transaction. If the upsert replaced a row that was not there to lock,
+    another request inserted it concurrently, and the transaction is rolled
+    back and started over. Returns the create date of the review and whether
+    it was a new (or deleted) one.
+    """
+    for attempt in range(UPSERT_REVIEW_ATTEMPTS):
+        try:
+            async with in_transaction() as conn:
+                locked = await conn.execute_query_dict(
+                    LOCK_REVIEW_SQL, [str(user_id), str(movie_id)]
+                )
+                row = (
+                    await conn.execute_query_dict(
+                        UPSERT_REVIEW_SQL,
+                        [
+                            str(user_id),
+                            str(movie_id),
+                            to_uuid(unique_id()),
+                            str(rating_id),
+                            description,
+                            contains_spoiler,
+                            int(bool(locked) and locked[0]["delete_date"] is not None),
+                        ],
+                    )
+                )[0]
+                if not locked and not row["inserted"]:
+                    raise ReviewInsertRace()
+            return row["create_date"], bool(row["created"])
+        except ReviewInsertRace:
+            if attempt == UPSERT_REVIEW_ATTEMPTS - 1:
+                raise OperationalError("Concurrent reviews kept conflicting")
+
+
+async def delete_review(user_id: str, movie_id: str) -> bool:
+    """
+    Deletes the review of a user for a movie with its votes and keeps the
+    movie's num reviews in the same statement. Returns whether there was a
+    review to delete.
+    """
+    rows = await Tortoise.get_connection("default").execute_query_dict(
+        DELETE_REVIEW_SQL, [str(user_id), str(movie_id)]
+    )
+    return bool(rows[0]["deleted"])
+
+
+async def set_review_vote(
+    kind: str, review_id: str, user_id: str, voted: bool
+) -> Tuple[bool, Optional[int]]:
+    """
+    Adds (or removes) a "helpful", "funny" or "spoiler" vote of the user to
+    a review, applying the change to the review's count (and rank score) in
+    the same statement. Returns whether the vote changed and the new count,
+    None if the review does not exist.
+    """
+    values = [str(review_id), str(user_id)]
+    if voted:
+        values.append(to_uuid(unique_id()))
+    rows = await Tortoise.get_connection("default").execute_query_dict(
+        vote_sql(kind, voted), values
+    )
+    if not rows:
+        return False, None
+    return bool(rows[0]["changed"]), rows[0]["count"]
+
 
 #gets all reviews for that user, with pagination included
 @router.get("/reviews", tags=["review"], response_model=Wrapper[ListReviewResponse])
 async def search_user_review(
-    request: Request, keyword: Optional[str] = "", page: int = 0, per_page: int = 0
+    request: Request,
+    keyword: Optional[str] = "",
+    page: int = 0,
+    per_page: int = 0,
+    cursor: Optional[str] = None,
 ):
     #validate pagination parameters
     if per_page >= 42:
@@ -80,41 +449,16 @@ async def search_user_review(
 
     # gets all reviews ordered by created date, including
     # all relevant data and metadata 
-    reviews = [
-        ReviewResponse(
-            review_id=str(r.review_id),
-            user_id=str(r.user_id),
-            username=r.user.username,
-            movie_id=str(r.movie_id),
-            movie_title=str(r.movie.title),
-            movie_year=str(r.movie.release_date),
-            create_date=str(r.create_date),
-            description=r.description,
-            contains_spoiler=r.contains_spoiler,
-            rating=r.rating.rating,
-            num_helpful=r.num_helpful,
-            num_funny=r.num_funny,
-            num_spoiler=r.num_spoiler,
-            flagged_helpful=await r.helpful_votes.filter(
-                user_id=user_id, delete_date=None
-            ).count(),
-            flagged_funny=await r.funny_votes.filter(
-                user_id=user_id, delete_date=None
-            ).count(),
-            flagged_spoiler=await r.spoiler_votes.filter(
-                user_id=user_id, delete_date=None
-            ).count(),
-        )
-        for r in await Reviews.filter(user_id=user_id, delete_date=None)
-        .order_by("-create_date")
-        .offset((page - 1) * per_page)
-        .limit(per_page)
-        .prefetch_related(
-            "rating", "helpful_votes", "funny_votes", "spoiler_votes", "user", "movie"
-        )
-    ]
+    rows, next_cursor = await page_reviews(
+        Reviews.filter(user_id=user_id, delete_date=None),
+        page,
+        per_page,
+        cursor,
+        query_fingerprint("review/reviews", user_id, per_page),
+    )
+    reviews = await to_review_responses(rows, user_id)
 
-    return wrap({"items": reviews})
+    return wrap({"items": reviews, "cursor": next_cursor})
 
 # modifies a particular review by its author.
 @router.put("/review/{review_id}", tags=["review"])
@@ -141,14 +485,11 @@ async def update_author_review(review_id: str, review: ReviewRequest, request: R
             description=review.description,
             contains_spoiler=review.contains_spoiler,
         )
-        num_reviews = await Reviews.filter(
-            movie_id=review_movie_id, delete_date=None
-        ).count()
-        await Movies.filter(movie_id=review_movie_id).update(num_reviews=num_reviews)
-
     except OperationalError:
         raise ApiException(500, 2501, "An exception occurred")
 
+    await movie_tiles.invalidate([review_movie_id])
+    await movie_details.invalidate([review_movie_id])
     return wrap({})
 
 # delets a given review
@@ -168,27 +509,14 @@ async def delete_author_review(review_id: str, request: Request):
             401, 2609, "You must be the author to update/delete the review."
         )
     review_movie_id = (await Reviews.filter(review_id=review_id, delete_date=None).values("user_id", "movie_id"))[0]["movie_id"]
-    # deletes and updates all associated review data
+    # deletes the review with its votes and uncounts it on the movie
     try:
-        await Reviews.filter(review_id=review_id).update(
-            delete_date=datetime.now(),
-        )
-
-        await HelpfulVotes.filter(review_id=review_id).update(
-            delete_date=datetime.now()
-        )
-        await FunnyVotes.filter(review_id=review_id).update(delete_date=datetime.now())
-        await SpoilerVotes.filter(review_id=review_id).update(
-            delete_date=datetime.now()
-        )
-        num_reviews = await Reviews.filter(
-            movie_id=review_movie_id, delete_date=None
-        ).count()
-        # updates data for movie.
-        await Movies.filter(movie_id=review_movie_id).update(num_reviews=num_reviews)
+        await delete_review(review_user_id, review_movie_id)
     except OperationalError:
         raise ApiException(500, 2501, "An exception occurred")
 
+    await movie_tiles.invalidate([review_movie_id])
+    await movie_details.invalidate([review_movie_id])
     return wrap({})
 
 # adds a helpful vote to a review
@@ -202,18 +530,12 @@ async def mark_review_helpful(review_id: str, request: Request):
             401, 2001, "You are not logged in!"
         )
     try:
-        # after adding helpful votes, update review helpful count
-        async with in_transaction():
-            await HelpfulVotes.get_or_create(review_id=review_id, user_id=user_id)
-            await HelpfulVotes.filter(review_id=review_id, user_id=user_id).update(
-                delete_date=None
-            )
-            num_helpful = await HelpfulVotes.filter(
-                review_id=review_id, delete_date=None
-            ).count()
-            await Reviews.filter(review_id=review_id).update(num_helpful=num_helpful)
+        # the vote is only counted if the user had not given it yet
+        _, num_helpful = await set_review_vote("helpful", review_id, user_id, True)
     except OperationalError:
         raise ApiException(500, 2501, "An exception occurred")
+    if num_helpful is None:
+        raise ApiException(404, 2611, "Invalid review id.")
     return wrap({"count": num_helpful})
 
 # adds a funny vote to a review
@@ -227,18 +549,12 @@ async def mark_review_funny(request: Request, review_id: str):
             401, 2001, "You are not logged in!"
         )
     try:
-        async with in_transaction():
-            await FunnyVotes.get_or_create(review_id=review_id, user_id=user_id)
-            await FunnyVotes.filter(review_id=review_id, user_id=user_id).update(
-                delete_date=None
-            )
-            num_funny = await FunnyVotes.filter(
-                review_id=review_id, delete_date=None
-            ).count()
-            # after adding funny votes, update review funny count
-            await Reviews.filter(review_id=review_id).update(num_funny=num_funny)
+        # the vote is only counted if the user had not given it yet
+        _, num_funny = await set_review_vote("funny", review_id, user_id, True)
     except OperationalError:
         raise ApiException(500, 2501, "An exception occurred")
+    if num_funny is None:
+        raise ApiException(404, 2611, "Invalid review id.")
     return wrap({"count": num_funny})
 
 # adds a spoiler vote for a review
@@ -252,18 +568,12 @@ async def mark_review_spoiler(request: Request, review_id: str):
             401, 2001, "You are not logged in!"
         )
     try:
-        async with in_transaction():
-            await SpoilerVotes.get_or_create(review_id=review_id, user_id=user_id)
-            await SpoilerVotes.filter(review_id=review_id, user_id=user_id).update(
-                delete_date=None
-            )
-            num_spoiler = await SpoilerVotes.filter(
-                review_id=review_id, delete_date=None
-            ).count()
-            # after adding spoiler votes, update review spoiler count
-            await Reviews.filter(review_id=review_id).update(num_spoiler=num_spoiler)
+        # the vote is only counted if the user had not given it yet
+        _, num_spoiler = await set_review_vote("spoiler", review_id, user_id, True)
     except OperationalError:
         raise ApiException(500, 2501, "An exception occurred")
+    if num_spoiler is None:
+        raise ApiException(404, 2611, "Invalid review id.")
     return wrap({"count": num_spoiler})
 
 # deletes helpful vote for review
@@ -277,18 +587,12 @@ async def unmark_review_helpful(request: Request, review_id: str):
             401, 2001, "You are not logged in!"
         )
     try:
-        async with in_transaction():
-            await HelpfulVotes.get_or_create(review_id=review_id, user_id=user_id)
-            await HelpfulVotes.filter(review_id=review_id, user_id=user_id).update(
-                delete_date=datetime.now()
-            )
-            num_helpful = await HelpfulVotes.filter(
-                review_id=review_id, delete_date=None
-            ).count()
-            # after deleting helpful votes, update review helpful count
-            await Reviews.filter(review_id=review_id).update(num_helpful=num_helpful)
+        # the vote is only uncounted if the user had given it
+        _, num_helpful = await set_review_vote("helpful", review_id, user_id, False)
     except OperationalError:
         raise ApiException(500, 2501, "An exception occurred")
+    if num_helpful is None:
+        raise ApiException(404, 2611, "Invalid review id.")
     return wrap({"count": num_helpful})
 
 
@@ -303,18 +607,12 @@ async def unmark_review_funny(request: Request, review_id: str):
             401, 2001, "You are not logged in!"
         )
     try:
-        async with in_transaction():
-            await FunnyVotes.get_or_create(review_id=review_id, user_id=user_id)
-            await FunnyVotes.filter(review_id=review_id, user_id=user_id).update(
-                delete_date=datetime.now()
-            )
-            num_funny = await FunnyVotes.filter(
-                review_id=review_id, delete_date=None
-            ).count()
-            # after deleting funny votes, updates review funny count
-            await Reviews.filter(review_id=review_id).update(num_funny=num_funny)
+        # the vote is only uncounted if the user had given it
+        _, num_funny = await set_review_vote("funny", review_id, user_id, False)
     except OperationalError:
         raise ApiException(500, 2501, "An exception occurred")
+    if num_funny is None:
+        raise ApiException(404, 2611, "Invalid review id.")
     return wrap({"count": num_funny})
 
 
@@ -329,16 +627,10 @@ async def unmark_review_spoiler(request: Request, review_id: str):
             401, 2001, "You are not logged in!"
         )
     try:
-        async with in_transaction():
-            await SpoilerVotes.get_or_create(review_id=review_id, user_id=user_id)
-            await SpoilerVotes.filter(review_id=review_id, user_id=user_id).update(
-                delete_date=datetime.now()
-            )
-            num_spoiler = await SpoilerVotes.filter(
-                review_id=review_id, delete_date=None
-            ).count()
-            # after deleting spoiler votes, updates review spoiler count
-            await Reviews.filter(review_id=review_id).update(num_spoiler=num_spoiler)
+        # the vote is only uncounted if the user had given it
+        _, num_spoiler = await set_review_vote("spoiler", review_id, user_id, False)
     except OperationalError:
         raise ApiException(500, 2501, "An exception occurred")
+    if num_spoiler is None:
+        raise ApiException(404, 2611, "Invalid review id.")
     return wrap({"count": num_spoiler})
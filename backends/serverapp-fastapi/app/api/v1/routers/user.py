@@ -9,14 +9,13 @@ from app.models.common import ListResponse
 from app.models.db.banlists import Banlists
 from app.models.db.reviews import Reviews
 from app.models.db.users import Users
-from app.models.db.wishlists import Wishlists
+from app.utils.cursor import query_fingerprint
 from app.utils.password import hash, verify
-from app.utils.ratings import calc_average_rating
 from app.utils.wrapper import ApiException, Wrapper, wrap
 
 from .banlist import UserBanlistResponse
-from .review import ListReviewResponse, ReviewResponse
-from .wishlist import MovieWishlistResponse
+from .review import ListReviewResponse, page_reviews, to_review_responses
+from .wishlist import get_wishlist_items
 
 router = APIRouter()
 override_prefix = None
@@ -70,7 +69,13 @@ async def create_user(register: Register, request: Request) -> Wrapper[dict]:
 @router.get(
     "/{username}/reviews", tags=["user"], response_model=Wrapper[ListReviewResponse]
 )
-async def get_reviews_user(username: str, page: int = 0, per_page: int = 0):
+async def get_reviews_user(
+    username: str,
+    request: Request,
+    page: int = 0,
+    per_page: int = 0,
+    cursor: Optional[str] = None,
+):
     # handle pagination request parameters
     if per_page >= 42:
         raise ApiException(400, 2700, "Please limit the numer of items per page")
@@ -87,41 +92,18 @@ async def get_reviews_user(username: str, page: int = 0, per_page: int = 0):
 
     user_id = user[0]["user_id"]
 
-    reviews = [
-        ReviewResponse(
-            review_id=str(r.review_id),
-            user_id=str(r.user_id),
-            username=r.user.username,
-            movie_id=str(r.movie_id),
-            movie_title=str(r.movie.title),
-            movie_year=str(r.movie.release_date),
-            create_date=str(r.create_date),
-            description=r.description,
-            contains_spoiler=r.contains_spoiler,
-            rating=r.rating.rating,
-            num_helpful=r.num_helpful,
-            num_funny=r.num_funny,
-            num_spoiler=r.num_spoiler,
-            flagged_helpful=await r.helpful_votes.filter(
-                user_id=user_id, delete_date=None
-            ).count(),
-            flagged_funny=await r.funny_votes.filter(
-                user_id=user_id, delete_date=None
-            ).count(),
-            flagged_spoiler=await r.spoiler_votes.filter(
-                user_id=user_id, delete_date=None
-            ).count(),
-        )
-        for r in await Reviews.filter(user_id=user_id, delete_date=None)
-        .order_by("-create_date")
-        .offset((page - 1) * per_page)
-        .limit(per_page)
-        .prefetch_related(
-            "rating", "helpful_votes", "funny_votes", "spoiler_votes", "movie", "user"
-        )
-    ]
+    viewer_id = request.session.get("user_id")
+    rows, next_cursor = await page_reviews(
+        Reviews.filter(user_id=user_id, delete_date=None),
+        page,
+        per_page,
+        cursor,
+        query_fingerprint("user/reviews", user_id, per_page),
+    )
+    # flagged with the votes of the viewer, not of the author
+    reviews = await to_review_responses(rows, viewer_id)
 
-    return wrap({"items": reviews})
+    return wrap({"items": reviews, "cursor": next_cursor})
 
 
 # REVIEW RELATED END
@@ -136,30 +118,8 @@ async def get_user_wishlist(username: str):
     if not user:
         raise ApiException(404, 2021, "That user's profile was not found.")
     
-    items = []
-    #get all movie objects in that user's wishlist
-    for wishlist_item in await Wishlists.filter(
-        user_id=user.user_id, delete_date=None
-    ).prefetch_related("movie"):
-        rating = await calc_average_rating(
-            wishlist_item.movie.cumulative_rating,
-            wishlist_item.movie.num_votes,
-            user.user_id,
-            wishlist_item.movie_id,
-        )
-        items.append(
-            MovieWishlistResponse(
-                wishlist_id=str(wishlist_item.wishlist_id),
-                movie_id=str(wishlist_item.movie_id),
-                title=wishlist_item.movie.title,
-                image_url=wishlist_item.movie.image,
-                release_year=wishlist_item.movie.release_date.year,
-                cumulativeRating=rating["cumulative_rating"],
-                num_votes=rating["num_votes"],
-            )
-        )
-
-    return wrap({"items": items})
+    # get all movie objects in that user's wishlist
+    return wrap({"items": await get_wishlist_items(user.user_id, user.user_id)})
 
 
 # WISHLIST RELATED END
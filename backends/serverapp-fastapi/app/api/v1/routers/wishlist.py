@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
 from fastapi import APIRouter, Request
 from humps import camelize
@@ -8,7 +8,8 @@ from tortoise.exceptions import OperationalError
 
 from app.models.common import ListResponse
 from app.models.db.wishlists import Wishlists
-from app.utils.ratings import calc_average_rating
+from app.utils.movie_tiles import movie_tiles
+from app.utils.ratings import calc_average_ratings
 from app.utils.wrapper import ApiException, Wrapper, wrap
 
 router = APIRouter()
@@ -38,42 +39,58 @@ class MovieWishlistResponse(BaseModel):
 class MovieInWishlistResponse(BaseModel):
     added: bool
 
-# gets all movies on your wishlist
-@router.get(
-    "/", tags=["wishlist"], response_model=Wrapper[ListResponse[MovieWishlistResponse]]
-)
-async def get_wishlist(request: Request):
-    user_id = request.session.get("user_id")
 
-    if not user_id:
-        raise ApiException(401, 2001, "You are not logged in!")
+async def get_wishlist_items(
+    user_id: str, viewer_id: str
+) -> List[MovieWishlistResponse]:
+    """
+    Builds the wishlist of a user from one batch lookup of the movie tiles, with
+    ratings adjusted for the viewer's banlist.
+    """
+    wishlist = await Wishlists.filter(user_id=user_id, delete_date=None).values(
+        "wishlist_id", "movie_id"
+    )
+    tiles = await movie_tiles.get_many(str(item["movie_id"]) for item in wishlist)
+    # gets the banlist-adjusted ratings of all movies at once before
+    # creating the wishlist response objects
+    ratings = await calc_average_ratings(
+        {
+            movie_id: (tile["cumulative_rating"], tile["num_votes"])
+            for movie_id, tile in tiles.items()
+        },
+        viewer_id,
+    )
 
-    
     items = []
-    for wishlist_item in await Wishlists.filter(
-        user_id=user_id, delete_date=None
-    ).prefetch_related("movie"):
-        # gets the banlist-adjusted ratings before creating
-        # the wishlist response object
-        rating = await calc_average_rating(
-            wishlist_item.movie.cumulative_rating,
-            wishlist_item.movie.num_votes,
-            user_id,
-            wishlist_item.movie_id,
-        )
+    for wishlist_item in wishlist:
+        tile = tiles.get(str(wishlist_item["movie_id"]))
+        if tile is None:
+            continue
+        rating = ratings[str(wishlist_item["movie_id"])]
         items.append(
             MovieWishlistResponse(
-                wishlist_id=str(wishlist_item.wishlist_id),
-                movie_id=str(wishlist_item.movie_id),
-                title=wishlist_item.movie.title,
-                image_url=wishlist_item.movie.image,
-                release_year=wishlist_item.movie.release_date.year,
+                wishlist_id=str(wishlist_item["wishlist_id"]),
+                movie_id=tile["movie_id"],
+                title=tile["title"],
+                image_url=tile["image"],
+                release_year=tile["release_date"][0:4],
                 cumulative_rating=rating["cumulative_rating"],
                 num_votes=rating["num_votes"],
             )
         )
+    return items
+
+# gets all movies on your wishlist
+@router.get(
+    "/", tags=["wishlist"], response_model=Wrapper[ListResponse[MovieWishlistResponse]]
+)
+async def get_wishlist(request: Request):
+    user_id = request.session.get("user_id")
+
+    if not user_id:
+        raise ApiException(401, 2001, "You are not logged in!")
 
-    return wrap({"items": items})
+    return wrap({"items": await get_wishlist_items(user_id, user_id)})
 
 # checks whether that movie is already on your wishlist
 @router.get("/{movie_id}", response_model=Wrapper[MovieInWishlistResponse])
@@ -69,7 +69,20 @@ class Settings(BaseSettings):
     SESSION_SEPARATE_HTTPS: bool = True
     SESSION_TTL: int = 1800
     SESSION_STORAGE_KEY_PREFIX: str = "session:"
+    SESSION_STORAGE: str = ("json", "hash", "memory")[0]
+    SESSION_MEMORY_MAX_ENTRIES: int = 100000
+    SESSION_MEMORY_MAX_BYTES: int = 64 * 1024 * 1024
+    SESSION_LAZY_FIELDS: List[str] = [
+        "searches",
+        "title_searches",
+        "description_searches",
+        "genres_searches",
+        "people_searches",
+        "recommendations",
+    ]
     SESSION_RENEW_TIME: int = 0
+    SESSION_CACHE_SIZE: int = 0
+    SESSION_CACHE_TTL: float = 2.0
     SESSION_COOKIE_SECRET: Optional[str] = None
     SESSION_COOKIE_NAME: str = "app_session"
     SESSION_COOKIE_DOMAIN: str = ""
@@ -91,9 +104,17 @@ class Settings(BaseSettings):
     REDIS_URI: AnyUrl
     REDIS_POOL_MIN: int = 1
     REDIS_POOL_MAX: int = 20
+    REDIS_SHARD_URIS: List[str] = []
     REDIS_SEARCHES_MAX: int = 10
     REDIS_SEARCH_TTL: int = 300
 
+    # Search Settings
+    SEARCH_ENGINE: str = ("elasticsearch", "postgres", "inverted_index")[0]
+    INVERTED_INDEX_PATH: Path = (
+        Path(__file__).resolve().parents[4] / "storages" / "search_index"
+    ).resolve()
+    INVERTED_INDEX_BUILD: bool = True
+
     # Elasticsearch Settings
     ELASTICSEARCH_URI: AnyUrl
     ELASTICSEARCH_MOVIEINDEX: str = ""
@@ -109,6 +130,33 @@ class Settings(BaseSettings):
     ELASTICSEARCH_SHOWSSLWARNINGS: bool = True
     ELASTICSEARCH_TRACEREQUESTS: bool = False
 
+    # Cache Settings
+    MOVIE_TILE_CACHE_TTL: int = 3600
+    MOVIE_TILE_LRU_SIZE: int = 4096
+    MOVIE_TILE_LRU_TTL: int = 10
+    MOVIE_DETAIL_CACHE_TTL: int = 3600
+    MOVIE_DETAIL_LRU_SIZE: int = 1024
+    MOVIE_DETAIL_LRU_TTL: int = 10
+    BANLIST_CACHE_TTL: int = 3600
+    BANLIST_LRU_SIZE: int = 4096
+    BANLIST_LRU_TTL: int = 5
+    BANNED_RATINGS_TTL: int = 86400
+
+    # Rating Counter Settings
+    RATING_COUNTERS_WRITE_BEHIND: bool = True
+    RATING_COUNTERS_FLUSH_INTERVAL: float = 2.0
+    RATING_COUNTERS_LOCK_TIMEOUT: int = 60
+    RATING_COUNTERS_BATCH_SIZE: int = 1000
+
+    # Search Indexer Settings
+    SEARCH_INDEXER_ENABLED: bool = True
+    SEARCH_INDEXER_DEBOUNCE: float = 1.0
+    SEARCH_INDEXER_MAX_DELAY: float = 5.0
+    SEARCH_INDEXER_BATCH_SIZE: int = 500
+
+    # Metrics Settings
+    METRICS_ENABLED: bool = False
+
     # Email Settings
     EMAIL_ENABLED: bool = False
 
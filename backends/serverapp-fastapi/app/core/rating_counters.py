@@ -0,0 +1,360 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from fastapi import FastAPI
+from tortoise import Tortoise
+from tortoise.transactions import in_transaction
+
+from app.core.config import settings
+from app.core.redis import get_redis
+from app.utils.metrics import metrics
+
+"""
+This module keeps the `cumulative_rating` and `num_votes` counters of movies without
+making concurrent ratings of the same movie wait on its row.
+
+Rating writes add their change to a Redis hash with HINCRBYFLOAT / HINCRBY, which
+never conflict. A background flusher periodically takes the whole hash over and
+adds the net change of every movie to the database in batched
+`UPDATE ... SET x = x + delta` statements. Until then, readers add the changes that
+have not been flushed (see pending()) to what they read from the database.
+
+Only one worker flushes at a time, holding a lock it renews while flushing, and the
+flush scripts do nothing once the lock is lost. If a flusher dies after taking the
+hash over, the next flush puts its changes back, which counts them twice if the
+database update had already been committed.
+
+Every flush moves a generation counter, see generation(), so that caches only keep
+counters read while no flush was running.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Adds the `<movie_id>:s` (sum) and `<movie_id>:n` (count) fields of the hash
+# KEYS[2] to those of KEYS[1], then deletes KEYS[2]
+MERGE_LUA = """
+local fields = redis.call('HGETALL', KEYS[2])
+for i = 1, #fields, 2 do
+    if string.sub(fields[i], -2) == ':n' then
+        redis.call('HINCRBY', KEYS[1], fields[i], fields[i + 1])
+    else
+        redis.call('HINCRBYFLOAT', KEYS[1], fields[i], fields[i + 1])
+    end
+end
+redis.call('DEL', KEYS[2])
+"""
+
+# The flush scripts below all take the same KEYS: the pending hash, the hash being
+# flushed, the lock, the flush generation. ARGV: the token of the flusher holding
+# the lock. They do nothing and return nil if the lock is no longer held with
+# that token.
+FENCE_LUA = """
+if redis.call('GET', KEYS[3]) ~= ARGV[1] then
+    return nil
+end
+"""
+
+# Makes the flush generation odd (a flush is running) and different from what it
+# was, also if a flusher died and left it odd
+START_LUA = """
+if redis.call('INCR', KEYS[4]) % 2 == 0 then
+    redis.call('INCR', KEYS[4])
+end
+"""
+
+# Makes the flush generation even (no flush is running)
+END_LUA = """
+if tonumber(redis.call('GET', KEYS[4]) or '0') % 2 == 1 then
+    redis.call('INCR', KEYS[4])
+end
+"""
+
+TAKE_SCRIPT = (
+    FENCE_LUA
+    + """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+"""
+    + MERGE_LUA
+    + """
+end
+if redis.call('EXISTS', KEYS[1]) == 0 then
+"""
+    + END_LUA
+    + """
+    return {}
+end
+"""
+    + START_LUA
+    + """
+redis.call('RENAME', KEYS[1], KEYS[2])
+return redis.call('HGETALL', KEYS[2])
+"""
+)
+
+RESTORE_SCRIPT = FENCE_LUA + MERGE_LUA + END_LUA + "return 1\n"
+
+FINISH_SCRIPT = FENCE_LUA + "redis.call('DEL', KEYS[2])\n" + END_LUA + "return 1\n"
+
+# KEYS: the lock. ARGV: the token of the flusher holding it, the lock timeout
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: the lock. ARGV: the token of the flusher holding it
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+UPDATE_SQL = (
+    "UPDATE movies AS m SET cumulative_rating = m.cumulative_rating + d.cumulative, "
+    "num_votes = m.num_votes + d.votes "
+    "FROM unnest($1::uuid[], $2::float8[], $3::int[]) "
+    "AS d(movie_id, cumulative, votes) "
+    "WHERE m.movie_id = d.movie_id AND m.delete_date IS NULL"
+)
+
+
+def parse_deltas(fields: List[Union[bytes, str]]) -> Dict[str, Tuple[float, int]]:
+    """Parses HGETALL output into movie_id -> (cumulative_rating, num_votes). The
+    fields are str if the pool decodes replies."""
+    deltas: Dict[str, Tuple[float, int]] = {}
+    for name, value in zip(fields[::2], fields[1::2]):
+        if isinstance(name, bytes):
+            name = name.decode("utf-8")
+        movie_id, kind = name.rsplit(":", 1)
+        cumulative_rating, num_votes = deltas.get(movie_id, (0.0, 0))
+        if kind == "n":
+            deltas[movie_id] = (cumulative_rating, num_votes + int(value))
+        else:
+            deltas[movie_id] = (cumulative_rating + float(value), num_votes)
+    return deltas
+
+
+class RatingCounters:
+    key: str
+    flushing_key: str
+    lock_key: str
+    generation_key: str
+    interval: float
+    lock_timeout: int
+    batch_size: int
+    _task: Optional[asyncio.Task]
+
+    def __init__(
+        self,
+        key: str = "rating_counters",
+        interval: float = settings.RATING_COUNTERS_FLUSH_INTERVAL,
+        lock_timeout: int = settings.RATING_COUNTERS_LOCK_TIMEOUT,
+        batch_size: int = settings.RATING_COUNTERS_BATCH_SIZE,
+    ) -> None:
+        self.key = key
+        self.flushing_key = key + ":flushing"
+        self.lock_key = key + ":lock"
+        self.generation_key = key + ":generation"
+        self.interval = interval
+        self.lock_timeout = lock_timeout
+        self.batch_size = batch_size
+        self._task = None
+
+    @property
+    def enabled(self) -> bool:
+        return settings.RATING_COUNTERS_WRITE_BEHIND
+
+    async def record(
+        self, movie_id: str, cumulative_rating: float, num_votes: int
+    ) -> None:
+        """Adds a change to the counters of a movie, to be called after the rating
+        itself is saved."""
+        if not cumulative_rating and not num_votes:
+            return
+        movie_id = str(movie_id)
+        if not self.enabled:
+            await Tortoise.get_connection("default").execute_query(
+                "UPDATE movies SET cumulative_rating = cumulative_rating + $1, "
+                "num_votes = num_votes + $2 "
+                "WHERE movie_id = $3 AND delete_date IS NULL",
+                [float(cumulative_rating), int(num_votes), movie_id],
+            )
+            return
+        redis = await get_redis()
+        transaction = redis.multi_exec()
+        transaction.hincrbyfloat(self.key, movie_id + ":s", float(cumulative_rating))
+        transaction.hincrby(self.key, movie_id + ":n", int(num_votes))
+        await transaction.execute()
+
+    async def pending(self, movie_ids: Iterable[str]) -> Dict[str, Tuple[float, int]]:
+        """Returns the (cumulative_rating, num_votes) changes of the given movies
+        that have not been flushed to the database yet."""
+        movie_ids = [str(movie_id) for movie_id in movie_ids]
+        if not self.enabled or not movie_ids:
+            return {}
+        fields = []
+        for movie_id in movie_ids:
+            fields.extend([movie_id + ":s", movie_id + ":n"])
+        redis = await get_redis()
+        # Both hashes are read atomically, so a change is not missed while a flush
+        # takes the pending hash over. It is counted twice for the instant between
+        # the flush's commit and its deleting the hash being flushed.
+        transaction = redis.multi_exec()
+        pending = transaction.hmget(self.key, *fields, encoding="utf-8")
+        flushing = transaction.hmget(self.flushing_key, *fields, encoding="utf-8")
+        await transaction.execute()
+        pending, flushing = await pending, await flushing
+
+        deltas = {}
+        for i, movie_id in enumerate(movie_ids):
+            cumulative_rating = sum(
+                float(values[2 * i]) for values in (pending, flushing) if values[2 * i]
+            )
+            num_votes = sum(
+                int(values[2 * i + 1])
+                for values in (pending, flushing)
+                if values[2 * i + 1]
+            )
+            if cumulative_rating or num_votes:
+                deltas[movie_id] = (cumulative_rating, num_votes)
+        return deltas
+
+    async def merge(
+        self, movie_id: str, cumulative_rating: float, num_votes: int
+    ) -> Tuple[float, int]:
+        """Adds the changes not flushed yet to the counters read from a movie row."""
+        pending_rating, pending_votes = (await self.pending([movie_id])).get(
+            str(movie_id), (0.0, 0)
+        )
+        return cumulative_rating + pending_rating, num_votes + pending_votes
+
+    async def generation(self) -> int:
+        """Returns the flush generation, which is odd while a flush is running and
+        changes with every flush.
+
+        A reader that combines a movie row with pending() should only cache the
+        result if the generation was even before it read the row and unchanged
+        after it read pending(), a flush in between can make it count changes
+        twice or not at all.
+        """
+        if not self.enabled:
+            return 0
+        redis = await get_redis()
+        return int(await redis.get(self.generation_key) or 0)
+
+    async def unchanged_since(self, generation: int) -> bool:
+        """Returns whether no flush has run since generation() returned the given
+        generation, so that counters read after it can be cached."""
+        return generation % 2 == 0 and await self.generation() == generation
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            # The changes stay in Redis for the next worker to flush
+            logger.exception("Could not flush the rating counters")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Could not flush the rating counters")
+
+    async def _renew_lock(self, token: str) -> None:
+        while True:
+            await asyncio.sleep(self.lock_timeout / 3)
+            redis = await get_redis()
+            await redis.eval(
+                RENEW_SCRIPT, keys=[self.lock_key], args=[token, self.lock_timeout]
+            )
+
+    async def flush(self) -> int:
+        """Adds the pending changes to the database. Returns the number of movies
+        updated, 0 if there was nothing to flush or another worker is flushing."""
+        redis = await get_redis()
+        token = uuid.uuid4().hex
+        if not await redis.set(
+            self.lock_key, token, expire=self.lock_timeout, exist=redis.SET_IF_NOT_EXIST
+        ):
+            return 0
+        keys = [self.key, self.flushing_key, self.lock_key, self.generation_key]
+        # The lock is kept while the flush runs, so that no other flusher takes
+        # the hash being flushed back before it is deleted
+        renewal = asyncio.ensure_future(self._renew_lock(token))
+        try:
+            fields = await redis.eval(TAKE_SCRIPT, keys=keys, args=[token])
+            deltas = parse_deltas(fields or [])
+            if not deltas:
+                return 0
+
+            start = time.monotonic()
+            items = [
+                (movie_id, cumulative_rating, num_votes)
+                for movie_id, (cumulative_rating, num_votes) in sorted(deltas.items())
+                if cumulative_rating or num_votes
+            ]
+            try:
+                # Sorted by movie_id, so concurrent flushes lock rows in one order
+                async with in_transaction() as conn:
+                    for i in range(0, len(items), self.batch_size):
+                        batch = items[i : i + self.batch_size]
+                        await conn.execute_query(
+                            UPDATE_SQL,
+                            [
+                                [movie_id for movie_id, _, _ in batch],
+                                [cumulative for _, cumulative, _ in batch],
+                                [votes for _, _, votes in batch],
+                            ],
+                        )
+            except Exception:
+                await redis.eval(RESTORE_SCRIPT, keys=keys, args=[token])
+                metrics.inc("rating_counters.failed_flushes")
+                raise
+            if not await redis.eval(FINISH_SCRIPT, keys=keys, args=[token]):
+                # Another flusher has taken the changes back, they are counted twice
+                logger.error("Lost the rating counters lock while flushing")
+                metrics.inc("rating_counters.lost_locks")
+            metrics.inc("rating_counters.flushed_movies", len(items))
+            metrics.set("rating_counters.last_flush_seconds", time.monotonic() - start)
+            return len(items)
+        finally:
+            renewal.cancel()
+            await redis.eval(RELEASE_SCRIPT, keys=[self.lock_key], args=[token])
+
+
+rating_counters = RatingCounters()
+
+
+def handle_rating_counters(app: FastAPI) -> FastAPI:
+    @app.on_event("startup")
+    async def start_rating_counters():
+        if rating_counters.enabled:
+            await rating_counters.start()
+
+    @app.on_event("shutdown")
+    async def stop_rating_counters():
+        if rating_counters.enabled:
+            await rating_counters.stop()
+
+    return app
+
+
+__all__ = ["RatingCounters", "rating_counters", "handle_rating_counters"]
@@ -0,0 +1,47 @@
+from typing import Optional
+
+import aioredis
+from fastapi import FastAPI
+
+from app.core.config import settings
+
+"""
+This module holds the Redis connection pool shared by the caches of a worker. The
+pool is created on startup (or lazily on first use) and closed on app shutdown.
+"""
+
+_redis: Optional[aioredis.Redis] = None
+
+
+async def get_redis() -> aioredis.Redis:
+    global _redis
+    if _redis is None:
+        _redis = await aioredis.create_redis_pool(
+            settings.REDIS_URI,
+            minsize=settings.REDIS_POOL_MIN,
+            maxsize=settings.REDIS_POOL_MAX,
+        )
+    return _redis
+
+
+async def close_redis() -> None:
+    global _redis
+    if _redis is not None:
+        _redis.close()
+        await _redis.wait_closed()
+        _redis = None
+
+
+def handle_redis(app: FastAPI) -> FastAPI:
+    @app.on_event("startup")
+    async def init_redis_pool():
+        await get_redis()
+
+    @app.on_event("shutdown")
+    async def terminate_redis_pool():
+        await close_redis()
+
+    return app
+
+
+__all__ = ["get_redis", "close_redis", "handle_redis"]
@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import time
+from functools import partial
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from elasticsearch import helpers
+from elasticsearch_dsl import connections
+from fastapi import FastAPI
+
+from app.core.config import settings
+from app.models.db.ratings import Ratings
+from app.utils.metrics import metrics
+
+"""
+This module pushes rating changes to the Elasticsearch movie index as they happen,
+instead of waiting for pgsync to catch up and reindex the whole movie document.
+
+Write endpoints mark the (movie, user) ratings they changed; marks are debounced and
+sent in batches through the bulk API as partial updates, which apply the changed
+ratings only with the stored `update_ratings` script. pgsync still owns the rest of
+the document and the initial sync.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class SearchIndexer:
+    debounce: float
+    max_delay: float
+    batch_size: int
+    _pending: Dict[str, Tuple[float, Set[str]]]
+    _last_mark: float
+    _wakeup: Optional[asyncio.Event]
+    _task: Optional[asyncio.Task]
+
+    def __init__(
+        self,
+        debounce: float = settings.SEARCH_INDEXER_DEBOUNCE,
+        max_delay: float = settings.SEARCH_INDEXER_MAX_DELAY,
+        batch_size: int = settings.SEARCH_INDEXER_BATCH_SIZE,
+    ) -> None:
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        # movie_id -> (time first marked, user_ids whose rating changed)
+        self._pending = {}
+        self._last_mark = 0.0
+        self._wakeup = None
+        self._task = None
+        metrics.gauge("search_indexer.queue_depth", lambda: len(self._pending))
+        metrics.gauge("search_indexer.lag_seconds", self.lag)
+
+    @property
+    def enabled(self) -> bool:
+        return (
+            settings.SEARCH_INDEXER_ENABLED
+            and settings.SEARCH_ENGINE == "elasticsearch"
+        )
+
+    def lag(self) -> float:
+        """Returns how long the oldest pending change has been waiting, in seconds."""
+        if not self._pending:
+            return 0.0
+        return time.monotonic() - min(marked for marked, _ in self._pending.values())
+
+    def mark_dirty(
+        self, movie_id: str, user_id: str, marked: Optional[float] = None
+    ) -> None:
+        """Queues the rating of the user for the movie to be sent to Elasticsearch."""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        first_marked, user_ids = self._pending.get(
+            str(movie_id), (marked or now, set())
+        )
+        user_ids.add(str(user_id))
+        self._pending[str(movie_id)] = (min(first_marked, marked or now), user_ids)
+        self._last_mark = now
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            if self._pending:
+                self._wakeup.set()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Best effort, whatever is left is picked up by pgsync eventually
+        for _ in range(len(self._pending) // self.batch_size + 1):
+            if not await self.flush():
+                break
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            # Wait until writes have been quiet for `debounce` seconds, but never
+            # hold a change for more than `max_delay` seconds or past a full batch
+            while len(self._pending) < self.batch_size:
+                now = time.monotonic()
+                delay = min(
+                    self._last_mark + self.debounce - now,
+                    self.max_delay - self.lag(),
+                )
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self._wakeup.clear()
+            if not await self.flush():
+                # Elasticsearch is unavailable, back off before retrying
+                await asyncio.sleep(self.max_delay)
+            if self._pending:
+                self._wakeup.set()
+
+    async def flush(self) -> bool:
+        """Sends one batch of pending changes. Returns False if Elasticsearch could
+        not be reached, in which case the batch is queued again."""
+        if not self._pending:
+            return True
+        batch = dict(
+            sorted(self._pending.items(), key=lambda item: item[1][0])[
+                : self.batch_size
+            ]
+        )
+        for movie_id in batch:
+            del self._pending[movie_id]
+
+        start = time.monotonic()
+        try:
+            actions = await self._build_actions(batch)
+            client = connections.get_connection(settings.ELASTICSEARCH_ALIAS)
+            _, errors = await asyncio.get_event_loop().run_in_executor(
+                None,
+                partial(
+                    helpers.bulk,
+                    client,
+                    actions,
+                    raise_on_error=False,
+                    raise_on_exception=False,
+                ),
+            )
+        except Exception:
+            logger.exception("Could not send %d movies to Elasticsearch", len(batch))
+            self._requeue(batch)
+            metrics.inc("search_indexer.failed_batches")
+            return False
+
+        failed = {}
+        for error in errors:
+            item = error.get("update", {})
+            # 404: the movie has not been indexed by pgsync yet, which will
+            # index its ratings as well
+            if item.get("status") != 404 and item.get("_id") in batch:
+                failed[item["_id"]] = batch[item["_id"]]
+        if failed:
+            logger.warning("Elasticsearch rejected %d movie updates", len(failed))
+            self._requeue(failed)
+        metrics.inc("search_indexer.indexed_movies", len(batch) - len(failed))
+        metrics.inc("search_indexer.failed_movies", len(failed))
+        metrics.inc("search_indexer.batches")
+        metrics.set("search_indexer.last_batch_seconds", time.monotonic() - start)
+        return True
+
+    def _requeue(self, batch: Dict[str, Tuple[float, Set[str]]]) -> None:
+        for movie_id, (marked, user_ids) in batch.items():
+            for user_id in user_ids:
+                self.mark_dirty(movie_id, user_id, marked)
+
+    async def _build_actions(
+        self, batch: Dict[str, Tuple[float, Set[str]]]
+    ) -> List[Dict[str, Any]]:
+        user_ids = set().union(*(user_ids for _, user_ids in batch.values()))
+        current = {
+            (str(rating["movie_id"]), str(rating["user_id"])): rating["rating"]
+            for rating in await Ratings.filter(
+                movie_id__in=list(batch), user_id__in=list(user_ids), delete_date=None
+            ).values("movie_id", "user_id", "rating")
+        }
+        return [
+            {
+                "_op_type": "update",
+                "_index": settings.ELASTICSEARCH_MOVIEINDEX,
+                "_id": movie_id,
+                "retry_on_conflict": 3,
+                "script": {
+                    "id": "update_ratings",
+                    "params": {
+                        # A null rating removes the user's rating from the document
+                        "ratings": [
+                            {
+                                "user_id": user_id,
+                                "rating": current.get((movie_id, user_id)),
+                            }
+                            for user_id in sorted(user_ids)
+                        ]
+                    },
+                },
+            }
+            for movie_id, (_, user_ids) in batch.items()
+        ]
+
+
+search_indexer = SearchIndexer()
+
+
+def handle_search_indexer(app: FastAPI) -> FastAPI:
+    @app.on_event("startup")
+    async def start_search_indexer():
+        if search_indexer.enabled:
+            await search_indexer.start()
+
+    @app.on_event("shutdown")
+    async def stop_search_indexer():
+        await search_indexer.stop()
+
+    return app
+
+
+__all__ = ["SearchIndexer", "search_indexer", "handle_search_indexer"]
@@ -3,8 +3,20 @@ import binascii
 import hashlib
 import os
 import random
+from functools import partial
 from types import SimpleNamespace
-from typing import Any, Dict, List, Optional, Type, Union
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
 
 import tldextract
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
@@ -17,13 +29,18 @@ from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from app.core.config import settings
 from app.utils.dict_storage import DictStorageDriverBase
+from app.utils.dict_storage.cached import CachedDictStorageDriver
+from app.utils.dict_storage.memory import MemoryDictStorageDriver
 from app.utils.dict_storage.redis import RedisDictStorageDriver
+from app.utils.dict_storage.redis_hash import RedisHashDictStorageDriver
+from app.utils.dict_storage.sharded import ShardedDictStorageDriver
 
 """
 This module is session middleware to handle session in requests
 to the API.
 """
 
+
 def _urandom(num_bytes: int):
     try:
         return os.urandom(num_bytes)
@@ -31,7 +48,136 @@ def _urandom(num_bytes: int):
         return random.getrandbits(num_bytes << 3).to_bytes(num_bytes, byteorder="big")
 
 
-class _UncopyableDict(dict):
+_MISSING = object()
+
+
+class _TrackedDict(dict):
+    """A dict that calls `on_change` with the top-level session key under which it
+    has been modified.
+
+    Dicts stored in it are wrapped as tracked dicts, so that e.g.
+    `request.session["searches"][keywords] = search_id` is seen as a change of
+    "searches". Other mutable values (lists) are not tracked and must be assigned
+    again when changed.
+    """
+
+    def __init__(
+        self,
+        data: Dict[str, Any],
+        on_change: Callable[[str], None],
+        key: Optional[str] = None,
+    ) -> None:
+        super().__init__()
+        self._on_change = on_change
+        # The top-level key of a nested dict, None for the session itself
+        self._key = key
+        dict.update(
+            self, ((key, self._track(key, value)) for key, value in data.items())
+        )
+
+    def _changed(self, key: str) -> None:
+        self._on_change(key if self._key is None else self._key)
+
+    def _track(self, key: str, value: Any) -> Any:
+        top_key = key if self._key is None else self._key
+        if (
+            isinstance(value, _TrackedDict)
+            and value._on_change is self._on_change
+            and value._key == top_key
+        ):
+            return value
+        if isinstance(value, dict):
+            return _TrackedDict(value, self._on_change, top_key)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        current = dict.get(self, key, _MISSING)
+        # Assigning back a nested dict, or an equal scalar, is not a change
+        if current is value or (
+            type(current) is type(value)
+            and isinstance(value, (str, int, float, bool))
+            and current == value
+        ):
+            return
+        dict.__setitem__(self, key, self._track(key, value))
+        self._changed(key)
+
+    def __delitem__(self, key: str) -> None:
+        dict.__delitem__(self, key)
+        self._changed(key)
+
+    def pop(self, key: str, *default: Any) -> Any:
+        if key in self:
+            self._changed(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self) -> Tuple[str, Any]:
+        item = dict.popitem(self)
+        self._changed(item[0])
+        return item
+
+    def setdefault(self, key: str, default: Any = None) -> Any:
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other: Any) -> "_TrackedDict":
+        self.update(other)
+        return self
+
+    def clear(self) -> None:
+        for key in list(self):
+            self._changed(key)
+        dict.clear(self)
+
+
+class _UncopyableDict(_TrackedDict):
+    """The session of a request. `changed` holds the keys modified since it was
+    loaded, which have to be written back to the driver.
+
+    Drivers may leave rarely used keys out of get(), see
+    DictStorageDriverBase.get_fields(). A request reads them after
+    `await request.session.load(key, ...)`.
+    """
+
+    changed: Set[str]
+    # Whether the driver may hold keys of this session that have not been loaded
+    partial: bool
+
+    def __init__(
+        self,
+        data: Dict[str, Any],
+        loader: Optional[Callable[[List[str]], Awaitable[Dict[str, Any]]]] = None,
+        partial: bool = False,
+    ) -> None:
+        self.changed = set()
+        self.partial = partial
+        self._loader = loader
+        self._loaded: Set[str] = set()
+        super().__init__(data, self.changed.add)
+
+    @property
+    def modified(self) -> bool:
+        return bool(self.changed)
+
+    async def load(self, *keys: str) -> None:
+        """Loads the given keys from the driver, if they have not been read yet."""
+        keys = [
+            key
+            for key in keys
+            if key not in self and key not in self.changed and key not in self._loaded
+        ]
+        if not keys or self._loader is None:
+            return
+        self._loaded.update(keys)
+        for key, value in (await self._loader(keys)).items():
+            if key not in self:
+                dict.__setitem__(self, key, self._track(key, value))
+
     def __copy__(self):
         raise NotImplementedError("This dictionary should not be copied.")
 
@@ -42,7 +188,6 @@ class _UncopyableDict(dict):
 class AdvancedSessionMiddleware:
     app: ASGIApp
     driver: DictStorageDriverBase
-    initalized: bool
     separate_https: bool
     server_ttl: int
     key_prefix: str
@@ -71,6 +216,9 @@ class AdvancedSessionMiddleware:
         cookie_domain: str = settings.SESSION_COOKIE_DOMAIN,
         cookie_path: str = settings.SESSION_COOKIE_PATH,
         cookie_same_site: str = settings.SESSION_COOKIE_SAME_SITE,
+        cache_size: int = settings.SESSION_CACHE_SIZE,
+        cache_ttl: float = settings.SESSION_CACHE_TTL,
+        cache_redis_uri: str = settings.REDIS_URI,
     ) -> None:
         self.app = app
         self.separate_https = separate_https
@@ -87,7 +235,7 @@ class AdvancedSessionMiddleware:
         self.cookie_path = cookie_path
         self.cookie_same_site = cookie_same_site
         self.cookie_max_age = ttl
-        if issubclass(driver, DictStorageDriverBase):
+        if isinstance(driver, type) and issubclass(driver, DictStorageDriverBase):
             self.driver = driver(
                 *(driver_args or []),
                 **{
@@ -106,7 +254,17 @@ class AdvancedSessionMiddleware:
                 "The session driver should be a class"
                 " or a object of DictStorageDriverBase."
             )
-        self.initalized = self.driver.initialized
+        # Sessions stored in memory are already local to the worker, another cache
+        # in front of them would only copy them and add invalidation traffic
+        if cache_size > 0 and not isinstance(self.driver, MemoryDictStorageDriver):
+            self.driver = CachedDictStorageDriver(
+                self.driver,
+                redis_uri=cache_redis_uri,
+                channel=self.key_prefix + "invalidate",
+                size=cache_size,
+                ttl=cache_ttl,
+                metrics_prefix="session_cache",
+            )
 
         async def terminate_driver():
             await self.driver.terminate_driver()
@@ -160,15 +318,20 @@ class AdvancedSessionMiddleware:
                 session_id = None
         elif session_id and len(session_id) != 26:
             session_id = None
-        if not self.initalized:
+        if not self.driver.initialized:
             await self.driver.initialize_driver()
         if self.separate_https:
             await self.driver.set_key_prefix(self.key_prefix + scope["scheme"] + "-")
         if session_id:
-            session, ttl = await self.driver.get(session_id)
-            if not session:
+            session, ttl = await self.driver.lookup(session_id)
+            if session is None:
+                session = {}
                 session_id = None
-        session = _UncopyableDict(session)
+        session = _UncopyableDict(
+            session,
+            partial(self.driver.get_fields, session_id) if session_id else None,
+            partial=bool(session_id and self.driver.lazy_fields),
+        )
         scope["session"] = session
 
         async def send_wrapper(message: Message):
@@ -182,7 +345,8 @@ class AdvancedSessionMiddleware:
                     raise RuntimeError("scope['session'] should not be re-assigned.")
 
                 headers = MutableHeaders(scope=message)
-                if scope["session"]:
+                # A session may hold only lazy keys that the request has not read
+                if scope["session"] or scope["session"].partial:
                     if session_id is None:
                         # Initialize a new session cookie
                         session_id_new = await self.driver.create()
@@ -221,8 +385,12 @@ class AdvancedSessionMiddleware:
                         )
                         del dummy
                     else:
-                        # Store the current session
-                        await self.driver.update(session_id, scope["session"])
+                        # Store the current session if it has changed, reading it
+                        # has already renewed its expiry in the driver
+                        if scope["session"].modified:
+                            await self.driver.update_fields(
+                                session_id, scope["session"], scope["session"].changed
+                            )
                         # Handle renew
                         if ttl <= self.renew_on_ttl:
                             dummy = SimpleNamespace()
@@ -299,14 +467,37 @@ class AdvancedSessionMiddleware:
 
 
 def handle_session(app: FastAPI) -> FastAPI:
-    app.add_middleware(
-        AdvancedSessionMiddleware,
-        driver=RedisDictStorageDriver,
-        driver_kwargs={
-            "redis_uri": settings.REDIS_URI,
+    if settings.SESSION_STORAGE == "memory":
+        driver = MemoryDictStorageDriver
+        driver_kwargs = {
+            "max_entries": settings.SESSION_MEMORY_MAX_ENTRIES,
+            "max_bytes": settings.SESSION_MEMORY_MAX_BYTES,
+            "metrics_prefix": "session_storage",
+        }
+    else:
+        driver_kwargs = {
             "redis_pool_min": settings.REDIS_POOL_MIN,
             "redis_pool_max": settings.REDIS_POOL_MAX,
-        },
+        }
+        if settings.SESSION_STORAGE == "hash":
+            driver = RedisHashDictStorageDriver
+            driver_kwargs["lazy_fields"] = settings.SESSION_LAZY_FIELDS
+        else:
+            driver = RedisDictStorageDriver
+        if len(settings.REDIS_SHARD_URIS) > 1:
+            driver_kwargs = {
+                "redis_uris": settings.REDIS_SHARD_URIS,
+                "shard_class": driver,
+                "shard_kwargs": driver_kwargs,
+                "metrics_prefix": "session_shards",
+            }
+            driver = ShardedDictStorageDriver
+        else:
+            driver_kwargs["redis_uri"] = (
+                settings.REDIS_SHARD_URIS or [settings.REDIS_URI]
+            )[0]
+    app.add_middleware(
+        AdvancedSessionMiddleware, driver=driver, driver_kwargs=driver_kwargs
     )
 
     return app
@@ -11,6 +11,9 @@ from app.api.v1.routers import router as api_router
 from app.core.config import settings
 from app.core.database import handle_database
 from app.core.errors import handle_errors
+from app.core.rating_counters import handle_rating_counters
+from app.core.redis import handle_redis
+from app.core.search_indexer import handle_search_indexer
 from app.core.session import handle_session
 from app.core.static_router import handle_static_routes
 
@@ -68,6 +71,10 @@ if settings.GZIP_ENABLED:
 app = handle_errors(app)
 app = handle_static_routes(app)
 app = handle_session(app)
+# Registered before the database so that pending changes are flushed on shutdown
+app = handle_search_indexer(app)
+app = handle_rating_counters(app)
 app = handle_database(app)
+app = handle_redis(app)
 
 app.include_router(api_router, prefix=settings.API_URL_PATH)
@@ -21,6 +21,8 @@ class Positions(Model):
     person = fields.ForeignKeyField("models.People")
     position = fields.CharField(max_length=300, null=True)
     char_name = fields.CharField(max_length=300, null=True)
+    # the rank of the person in the film's credits, from the import
+    billing_order = fields.IntField(null=True)
     create_date = fields.DatetimeField(auto_now_add=True)
     delete_date = fields.DatetimeField(null=True)
 
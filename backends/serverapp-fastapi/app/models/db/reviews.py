@@ -25,6 +25,8 @@ class Reviews(Model):
     num_spoiler = fields.IntField(default=0)
     num_helpful = fields.IntField(default=0)
     num_funny = fields.IntField(default=0)
+    # maintained from the vote counts, see app/utils/review_rank.py
+    rank_score = fields.FloatField(default=0)
     create_date = fields.DatetimeField(auto_now_add=True)
     delete_date = fields.DatetimeField(null=True)
 
@@ -0,0 +1,99 @@
+import json
+from typing import FrozenSet
+
+from app.core.config import settings
+from app.core.redis import get_redis
+from app.models.db.banlists import Banlists
+from app.utils.lru import LRUCache
+
+"""
+This module caches the banlist of each user, the ids of the users whose ratings and
+reviews they do not want to see, which nearly every authenticated read needs.
+
+Banlists are cached in two levels, a per-worker LRU in front of one Redis key per
+user, and loaded from the database on a miss. Ban and unban write through: the
+endpoint updates the database, then rewrites the user's banlist in both levels.
+A miss only fills Redis if no banlist was written in the meantime.
+"""
+
+
+async def load_banlist(user_id: str) -> FrozenSet[str]:
+    return frozenset(
+        str(item["banned_user_id"])
+        for item in await Banlists.filter(user_id=user_id, delete_date=None).values(
+            "banned_user_id"
+        )
+    )
+
+
+class BanlistCache:
+    prefix: str
+    ttl: int
+    lru: LRUCache
+
+    def __init__(
+        self,
+        prefix: str = "banlist:",
+        ttl: int = settings.BANLIST_CACHE_TTL,
+        lru_size: int = settings.BANLIST_LRU_SIZE,
+        lru_ttl: int = settings.BANLIST_LRU_TTL,
+    ) -> None:
+        self.prefix = prefix
+        self.ttl = ttl
+        self.lru = LRUCache(maxsize=lru_size, ttl=lru_ttl)
+
+    async def get(self, user_id: str) -> FrozenSet[str]:
+        """Returns the ids of the users banned by the user, loading and caching the
+        banlist on a miss."""
+        user_id = str(user_id)
+        banned = self.lru.get(user_id)
+        if banned is not None:
+            return banned
+        redis = await get_redis()
+        value = await redis.get(self.prefix + user_id, encoding="utf-8")
+        if value is not None:
+            banned = frozenset(json.loads(value))
+            self.lru.set(user_id, banned)
+            return banned
+        banned = await load_banlist(user_id)
+        # Only fills an empty key, a refresh() that ran while the banlist was
+        # loaded has written a newer one
+        if not await self.set(user_id, banned, only_if_missing=True):
+            value = await redis.get(self.prefix + user_id, encoding="utf-8")
+            if value is not None:
+                banned = frozenset(json.loads(value))
+                self.lru.set(user_id, banned)
+        return banned
+
+    async def set(
+        self, user_id: str, banned: FrozenSet[str], only_if_missing: bool = False
+    ) -> bool:
+        """Caches the banlist of the user, returns whether it was stored."""
+        user_id = str(user_id)
+        redis = await get_redis()
+        stored = await redis.set(
+            self.prefix + user_id,
+            json.dumps(sorted(banned)),
+            expire=self.ttl,
+            exist=redis.SET_IF_NOT_EXIST if only_if_missing else None,
+        )
+        if stored:
+            self.lru.set(user_id, banned)
+        return bool(stored)
+
+    async def refresh(self, user_id: str) -> FrozenSet[str]:
+        """Rewrites the cached banlist of the user from the database, to be called
+        after the user bans or unbans someone.
+
+        The banlist is reloaded rather than patched so that concurrent changes
+        made through other workers are not lost. Other workers' LRUs are not
+        notified and expire on their own within BANLIST_LRU_TTL seconds.
+        """
+        banned = await load_banlist(user_id)
+        await self.set(user_id, banned)
+        return banned
+
+
+banlists = BanlistCache()
+
+__all__ = ["BanlistCache", "banlists", "load_banlist"]
@@ -0,0 +1,254 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from tortoise import Tortoise
+
+from app.core.config import settings
+from app.core.redis import get_redis
+from app.models.db.banlists import Banlists
+from app.utils.banlist_cache import load_banlist
+
+"""
+This module maintains, for each viewer, the sum and count of the ratings given to
+each movie by the users the viewer has banned, so that adjusting a movie's rating
+for a banlist is a lookup no matter how many ratings or bans there are.
+
+The deltas of a viewer live in one Redis hash, with a `<movie_id>:s` (sum) and
+`<movie_id>:n` (count) field per movie their banned users have rated. A hash is
+built from the banlist and ratings in the database on first read, and rating writes
+update it incrementally after that. Updates skip hashes that have not been built,
+and hashes expire after BANNED_RATINGS_TTL seconds.
+
+A build is only stored if nothing it read changed while it ran. Bans and unbans
+delete the hash and move a version of the viewer, so that builds which read the
+banlist before the change are not stored. Rating writes are fenced the same way
+for every rater: rating_changing() counts a write in flight before the rating is
+saved, and rating_changed() applies it to the built hashes, ends the write and
+moves the version of the rater in one step. Builds are not stored while a banned
+rater has a write in flight or once their version has moved, as the write may or
+may not be in what the build read from the database.
+"""
+
+BUILT = "_built"
+# How many seconds a rating write may be in flight before builds ignore it, in
+# case the worker writing it died before calling rating_changed()
+WRITE_TIMEOUT = 60
+
+# KEYS: the hash to build, the banlist version of the viewer, then the writes in
+# flight and the version of each banned rater. ARGV: the ttl, the viewer version
+# read before the banlist was loaded, the rater versions read before the ratings
+# were loaded, then movie_id, sum, count, ...
+BUILD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[2] then
+    return 0
+end
+local raters = (#KEYS - 2) / 2
+for i = 1, raters do
+    if tonumber(redis.call('GET', KEYS[1 + 2 * i]) or '0') > 0 then
+        return 0
+    end
+    if (redis.call('GET', KEYS[2 + 2 * i]) or '0') ~= ARGV[2 + i] then
+        return 0
+    end
+end
+redis.call('HSET', KEYS[1], '_built', 1)
+for i = 3 + raters, #ARGV, 3 do
+    redis.call('HSET', KEYS[1], ARGV[i] .. ':s', ARGV[i + 1])
+    redis.call('HSET', KEYS[1], ARGV[i] .. ':n', ARGV[i + 2])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# KEYS: the writes in flight and the version of the rater, then the hashes of the
+# viewers to update. ARGV: the ttl, then movie_id, sum, count, ...
+APPLY_SCRIPT = """
+if redis.call('DECR', KEYS[1]) <= 0 then
+    redis.call('DEL', KEYS[1])
+end
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+local applied = 0
+for k = 3, #KEYS do
+    local key = KEYS[k]
+    if redis.call('HEXISTS', key, '_built') == 1 then
+        for i = 2, #ARGV, 3 do
+            local count = redis.call('HINCRBY', key, ARGV[i] .. ':n', ARGV[i + 2])
+            if count <= 0 then
+                redis.call('HDEL', key, ARGV[i] .. ':s', ARGV[i] .. ':n')
+            else
+                redis.call('HINCRBYFLOAT', key, ARGV[i] .. ':s', ARGV[i + 1])
+            end
+        end
+        applied = applied + 1
+    end
+end
+return applied
+"""
+
+
+async def load_banned_ratings(
+    banned_user_ids: Iterable[str],
+) -> Dict[str, Tuple[float, int]]:
+    """Sums the ratings of the given users per movie."""
+    banned_user_ids = list(banned_user_ids)
+    if not banned_user_ids:
+        return {}
+    return {
+        str(row["movie_id"]): (row["cumulative_rating"], row["num_votes"])
+        for row in await Tortoise.get_connection("default").execute_query_dict(
+            "SELECT movie_id, count(*) AS num_votes, sum(rating) AS cumulative_rating "
+            "FROM ratings WHERE user_id = ANY($1::uuid[]) AND delete_date IS NULL "
+            "AND rating IS NOT NULL GROUP BY movie_id",
+            [banned_user_ids],
+        )
+    }
+
+
+def to_args(deltas: Dict[str, Tuple[float, int]]) -> List:
+    args = []
+    for movie_id, (cumulative_rating, num_votes) in deltas.items():
+        args.extend([movie_id, repr(float(cumulative_rating)), int(num_votes)])
+    return args
+
+
+class BannedRatings:
+    prefix: str
+    ttl: int
+
+    def __init__(
+        self, prefix: str = "banned_ratings:", ttl: int = settings.BANNED_RATINGS_TTL
+    ) -> None:
+        self.prefix = prefix
+        self.ttl = ttl
+
+    async def get_many(
+        self, viewer_id: str, movie_ids: List[str]
+    ) -> Dict[str, Tuple[float, int]]:
+        """Returns the (sum, count) of the ratings of the given movies by the users
+        the viewer has banned. Movies they have not rated are left out."""
+        movie_ids = [str(movie_id) for movie_id in movie_ids]
+        if not movie_ids:
+            return {}
+        key = self.prefix + str(viewer_id)
+        fields = [BUILT]
+        for movie_id in movie_ids:
+            fields.extend([movie_id + ":s", movie_id + ":n"])
+        redis = await get_redis()
+        values = await redis.hmget(key, *fields, encoding="utf-8")
+        if values[0] is None:
+            deltas = await self.build(viewer_id)
+            return {
+                movie_id: deltas[movie_id]
+                for movie_id in movie_ids
+                if movie_id in deltas
+            }
+        return {
+            movie_id: (float(values[1 + 2 * i]), int(values[2 + 2 * i]))
+            for i, movie_id in enumerate(movie_ids)
+            if values[2 + 2 * i] is not None
+        }
+
+    def rater_keys(self, user_id: str) -> List[str]:
+        """Returns the keys of the writes in flight and the version of a rater."""
+        key = self.prefix + "rater:" + str(user_id)
+        return [key + ":writing", key + ":version"]
+
+    async def build(self, viewer_id: str) -> Dict[str, Tuple[float, int]]:
+        # The banlist is read from the database, not from its cache, which may
+        # still hold it from before a ban on another worker
+        key = self.prefix + str(viewer_id)
+        redis = await get_redis()
+        version = await redis.get(key + ":version", encoding="utf-8") or "0"
+        banned_user_ids = list(await load_banlist(viewer_id))
+        rater_keys = [
+            rater_key
+            for banned_user_id in banned_user_ids
+            for rater_key in self.rater_keys(banned_user_id)
+        ]
+        rater_versions = (
+            await redis.mget(*rater_keys[1::2], encoding="utf-8") if rater_keys else []
+        )
+        deltas = await load_banned_ratings(banned_user_ids)
+        await redis.eval(
+            BUILD_SCRIPT,
+            keys=[key, key + ":version"] + rater_keys,
+            args=[self.ttl, version]
+            + [rater_version or "0" for rater_version in rater_versions]
+            + to_args(deltas),
+        )
+        return deltas
+
+    async def apply(
+        self,
+        user_id: str,
+        viewer_ids: List[str],
+        deltas: Dict[str, Tuple[float, int]],
+    ) -> None:
+        """Applies a change of the ratings of a user to the deltas of the viewers
+        who banned them, and ends a write started with rating_changing()."""
+        redis = await get_redis()
+        await redis.eval(
+            APPLY_SCRIPT,
+            keys=self.rater_keys(user_id)
+            + [self.prefix + str(viewer_id) for viewer_id in viewer_ids],
+            args=[self.ttl] + to_args(deltas),
+        )
+
+    async def ban_changed(self, viewer_id: str) -> None:
+        """Drops the deltas of the viewer so that they are built again from their
+        new banlist, to be called after the banlist is updated."""
+        key = self.prefix + str(viewer_id)
+        redis = await get_redis()
+        transaction = redis.multi_exec()
+        transaction.incr(key + ":version")
+        transaction.expire(key + ":version", self.ttl)
+        transaction.delete(key)
+        await transaction.execute()
+
+    async def rating_changing(self, user_id: str) -> None:
+        """Keeps builds from being stored until rating_changed() is called, to be
+        called before a rating of the user is saved."""
+        writing_key, _ = self.rater_keys(user_id)
+        redis = await get_redis()
+        transaction = redis.multi_exec()
+        transaction.incr(writing_key)
+        transaction.expire(writing_key, WRITE_TIMEOUT)
+        await transaction.execute()
+
+    async def rating_changed(
+        self,
+        user_id: str,
+        movie_id: str,
+        old_rating: Optional[float],
+        new_rating: Optional[float],
+    ) -> None:
+        """Applies a rating change of the user (None for no rating) to the deltas of
+        every viewer who banned them, to be called after the rating is saved, or
+        with equal ratings if it was not, once for every rating_changing()."""
+        if old_rating == new_rating:
+            await self.apply(user_id, [], {})
+            return
+        viewer_ids = [
+            str(item["user_id"])
+            for item in await Banlists.filter(
+                banned_user_id=user_id, delete_date=None
+            ).values("user_id")
+        ]
+        await self.apply(
+            user_id,
+            viewer_ids,
+            {
+                str(movie_id): (
+                    (new_rating or 0.0) - (old_rating or 0.0),
+                    (new_rating is not None) - (old_rating is not None),
+                )
+            },
+        )
+
+
+banned_ratings = BannedRatings()
+
+__all__ = ["BannedRatings", "banned_ratings", "load_banned_ratings"]
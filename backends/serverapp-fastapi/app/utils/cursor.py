@@ -0,0 +1,48 @@
+import base64
+import binascii
+import hashlib
+import json
+from typing import Any, List
+
+"""
+This module encodes and decodes the opaque cursors handed out by endpoints that
+use cursor (keyset) pagination. A cursor carries the sort values of the last item
+of a page, together with a fingerprint of the query it was issued for, so that it
+cannot be replayed against a different query.
+"""
+
+
+def query_fingerprint(*parts: Any) -> str:
+    """Returns a short stable digest of the query parameters a cursor belongs to."""
+    return hashlib.sha1(
+        json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()[:16]
+
+
+def encode_cursor(after: List[Any], fingerprint: str = "") -> str:
+    payload = json.dumps({"a": after, "q": fingerprint}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, fingerprint: str = "") -> List[Any]:
+    """Returns the sort values stored in the cursor.
+
+    Raises:
+        ValueError: the cursor is malformed or was issued for another query.
+    """
+    try:
+        payload = json.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        )
+    except (binascii.Error, UnicodeError, json.JSONDecodeError):
+        raise ValueError("Malformed cursor")
+    if (
+        not isinstance(payload, dict)
+        or not isinstance(payload.get("a"), list)
+        or payload.get("q") != fingerprint
+    ):
+        raise ValueError("Cursor does not match the query")
+    return payload["a"]
+
+
+__all__ = ["query_fingerprint", "encode_cursor", "decode_cursor"]
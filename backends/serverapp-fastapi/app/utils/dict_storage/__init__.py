@@ -1,4 +1,5 @@
-from typing import Any, Callable, Dict, Optional, Tuple, Union
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 
 class DictStorageDriverBase:
@@ -8,6 +9,8 @@ class DictStorageDriverBase:
     initialized: bool = False
     ttl: int
     renew_on_ttl: int
+    # Fields get() leaves out, to be read with get_fields()
+    lazy_fields: List[str] = []
 
     def __init__(
         self,
@@ -40,9 +43,27 @@ class DictStorageDriverBase:
     async def get(self, key: str) -> Tuple[Dict[str, Any], int]:
         return {}, 0
 
+    async def lookup(self, key: str) -> Tuple[Optional[Dict[str, Any]], int]:
+        # Like get(), but returns None for a missing dict, which drivers with lazy
+        # fields tell apart from a dict that only holds lazy fields ({}).
+        value, ttl = await self.get(key)
+        return value or None, ttl
+
+    async def get_fields(self, key: str, fields: List[str]) -> Dict[str, Any]:
+        # Drivers that leave fields out of get() load them here. Those that store
+        # the whole dict under one key have nothing left to load.
+        return {}
+
     async def update(self, key: str, value: Dict[str, Any]) -> None:
         pass
 
+    async def update_fields(
+        self, key: str, value: Dict[str, Any], fields: Iterable[str]
+    ) -> None:
+        # Stores the given fields of the dict, the ones missing from it are
+        # removed. Drivers that store the whole dict under one key rewrite it.
+        await self.update(key, value)
+
     async def destroy(self, key: str) -> None:
         pass
 
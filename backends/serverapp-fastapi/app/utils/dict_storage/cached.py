@@ -0,0 +1,184 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import aioredis
+
+from app.utils.lru import LRUCache
+from app.utils.metrics import metrics
+
+from ..dict_storage import DictStorageDriverBase
+
+"""
+This module keeps recently read dicts of another driver in a per-worker LRU, so
+that a user sending bursts of requests to one worker does not make a Redis round
+trip for every one of them.
+
+Workers tell each other about the dicts they update or destroy on a Redis pub/sub
+channel and drop their copies. A copy read before a change is published is served
+for at most the LRU's ttl, and nothing is cached while the worker is not
+subscribed to the channel.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class CachedDictStorageDriver(DictStorageDriverBase):
+    driver: DictStorageDriverBase
+    redis_uri: str
+    channel: str
+    lru: LRUCache
+    listening: bool
+    metrics_prefix: str
+    _origin: str
+    _publisher: Optional[aioredis.Redis]
+    _task: Optional[asyncio.Task]
+
+    def __init__(
+        self,
+        driver: DictStorageDriverBase,
+        redis_uri: str = "",
+        channel: str = "dict_storage:invalidate",
+        size: int = 1024,
+        ttl: float = 2.0,
+        metrics_prefix: str = "dict_storage_cache",
+    ) -> None:
+        self.driver = driver
+        self.redis_uri = redis_uri
+        self.channel = channel
+        self.lru = LRUCache(maxsize=size, ttl=ttl)
+        self.listening = False
+        self.metrics_prefix = metrics_prefix
+        self._origin = uuid.uuid4().hex
+        self._publisher = None
+        self._task = None
+        metrics.gauge(metrics_prefix + ".size", lambda: len(self.lru))
+
+    @property
+    def key_prefix(self) -> str:
+        return self.driver.key_prefix
+
+    @property
+    def lazy_fields(self) -> List[str]:
+        return self.driver.lazy_fields
+
+    @property
+    def ttl(self) -> int:
+        return self.driver.ttl
+
+    @property
+    def renew_on_ttl(self) -> int:
+        return self.driver.renew_on_ttl
+
+    def _cache_key(self, key: str) -> Tuple[str, str]:
+        return self.driver.key_prefix, key.strip().upper()
+
+    async def set_key_prefix(self, new_key_prefix: str = "") -> None:
+        await self.driver.set_key_prefix(new_key_prefix)
+
+    async def initialize_driver(self) -> None:
+        # The driver must be initialized first.
+        if not self.driver.initialized:
+            await self.driver.initialize_driver()
+        self._publisher = await aioredis.create_redis_pool(self.redis_uri, maxsize=2)
+        self._task = asyncio.ensure_future(self._listen())
+        self.initialized = True
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                subscriber = await aioredis.create_redis(self.redis_uri)
+                try:
+                    (channel,) = await subscriber.subscribe(self.channel)
+                    self.listening = True
+                    while await channel.wait_message():
+                        origin, key_prefix, key = json.loads(await channel.get())
+                        if origin != self._origin:
+                            self.lru.pop((key_prefix, key))
+                finally:
+                    # Changes may be missed until the channel is subscribed again
+                    self.listening = False
+                    self.lru.clear()
+                    subscriber.close()
+                    await subscriber.wait_closed()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Lost the dict storage invalidation channel")
+            await asyncio.sleep(1)
+
+    async def _invalidate(self, key: str) -> None:
+        key_prefix, key = self._cache_key(key)
+        await self._publisher.publish(
+            self.channel, json.dumps([self._origin, key_prefix, key])
+        )
+
+    async def create(self) -> str:
+        return await self.driver.create()
+
+    async def get(self, key: str) -> Tuple[Dict[str, Any], int]:
+        value, ttl = await self.lookup(key)
+        return value or {}, ttl
+
+    async def lookup(self, key: str) -> Tuple[Optional[Dict[str, Any]], int]:
+        cache_key = self._cache_key(key)
+        cached = self.lru.get(cache_key) if self.listening else None
+        if cached is not None:
+            metrics.inc(self.metrics_prefix + ".hits")
+            value_s, ttl, stored = cached
+            if ttl:
+                ttl = max(0, ttl - int(time.monotonic() - stored))
+            return json.loads(value_s), ttl
+        metrics.inc(self.metrics_prefix + ".misses")
+        value, ttl = await self.driver.lookup(key)
+        if value is not None and self.listening:
+            self.lru.set(cache_key, (json.dumps(value), ttl, time.monotonic()))
+        return value, ttl
+
+    async def get_fields(self, key: str, fields: List[str]) -> Dict[str, Any]:
+        return await self.driver.get_fields(key, fields)
+
+    async def update(self, key: str, value: Dict[str, Any]) -> None:
+        await self.driver.update(key, value)
+        await self._updated(key, value)
+
+    async def update_fields(
+        self, key: str, value: Dict[str, Any], fields: Iterable[str]
+    ) -> None:
+        await self.driver.update_fields(key, value, fields)
+        await self._updated(key, value)
+
+    async def _updated(self, key: str, value: Dict[str, Any]) -> None:
+        cache_key = self._cache_key(key)
+        if value and self.listening:
+            self.lru.set(cache_key, (json.dumps(value), self.ttl, time.monotonic()))
+        else:
+            self.lru.pop(cache_key)
+        await self._invalidate(key)
+
+    async def destroy(self, key: str) -> None:
+        await self.driver.destroy(key)
+        self.lru.pop(self._cache_key(key))
+        await self._invalidate(key)
+
+    async def terminate_driver(self) -> None:
+        # The driver must be terminated correctly in the end.
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._publisher is not None:
+            self._publisher.close()
+            await self._publisher.wait_closed()
+            self._publisher = None
+        await self.driver.terminate_driver()
+        self.initialized = False
+
+
+__all__ = ["CachedDictStorageDriver"]
@@ -0,0 +1,150 @@
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+
+from app.utils.metrics import metrics
+from app.utils.unique_id import id, to_base32
+
+from ..dict_storage import DictStorageDriverBase
+
+"""
+This module stores dicts in the memory of the worker, for single-worker
+deployments, tests and benchmarks that should not need a Redis server. It follows
+the get / update / destroy / renew semantics of RedisDictStorageDriver.
+
+Dicts are kept as JSON, both so that callers never share a dict with the storage
+and so that the memory they take can be accounted. When there are more than
+`max_entries` dicts or they take more than `max_bytes`, the least recently used
+ones are evicted.
+
+Expiry uses a timer wheel of `wheel_size` one-second slots, a dict is listed in the
+slot of the second it expires. Every call first empties the slots the clock has
+gone past since the previous call, removing the dicts that are due and leaving
+those due on a later turn of the wheel, so there is no timer per dict and no
+background task.
+"""
+
+
+class MemoryDictStorageDriver(DictStorageDriverBase):
+    max_entries: int
+    max_bytes: int
+    memory_usage: int
+    wheel_size: int
+    clock: Callable[[], float]
+    _items: "OrderedDict[str, Tuple[str, int]]"
+    _wheel: List[Set[str]]
+    _tick: int
+
+    def __init__(
+        self,
+        key_prefix: str = "",
+        key_filter: Optional[Union[str, Callable[[str], str]]] = r"[^a-zA-Z0-9_-]+",
+        ttl: int = 0,
+        renew_on_ttl: int = 0,
+        max_entries: int = 100000,
+        max_bytes: int = 64 * 1024 * 1024,
+        wheel_size: int = 4096,
+        clock: Callable[[], float] = time.monotonic,
+        metrics_prefix: str = "dict_storage_memory",
+    ) -> None:
+        super().__init__(
+            key_prefix=key_prefix,
+            key_filter=key_filter,
+            ttl=ttl,
+            renew_on_ttl=renew_on_ttl,
+        )
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.memory_usage = 0
+        self.wheel_size = wheel_size
+        self.clock = clock
+        # full key -> (JSON of the dict, the second it expires at, 0 for never)
+        self._items = OrderedDict()
+        self._wheel = [set() for _ in range(wheel_size)]
+        self._tick = int(clock())
+        metrics.gauge(metrics_prefix + ".entries", lambda: len(self._items))
+        metrics.gauge(metrics_prefix + ".bytes", lambda: self.memory_usage)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @staticmethod
+    def _size(full_key: str, value_s: str) -> int:
+        return len(full_key) + len(value_s.encode("utf-8"))
+
+    def _expire(self) -> int:
+        """Removes the dicts that have expired, returns the current second."""
+        now = int(self.clock())
+        if now > self._tick:
+            # After a full turn every slot has been visited
+            for second in range(
+                self._tick + 1, min(now, self._tick + self.wheel_size) + 1
+            ):
+                slot = self._wheel[second % self.wheel_size]
+                for full_key in [key for key in slot if self._items[key][1] <= now]:
+                    self._remove(full_key)
+            self._tick = now
+        return now
+
+    def _store(self, full_key: str, value_s: str, expires: int) -> None:
+        self._items[full_key] = (value_s, expires)
+        self._items.move_to_end(full_key)
+        if expires:
+            self._wheel[expires % self.wheel_size].add(full_key)
+
+    def _remove(self, full_key: str) -> None:
+        value_s, expires = self._items.pop(full_key)
+        if expires:
+            self._wheel[expires % self.wheel_size].discard(full_key)
+        self.memory_usage -= self._size(full_key, value_s)
+
+    async def create(self) -> str:
+        new_id = to_base32(id())
+        # Lazy approach: we don't create it here but in update
+        return new_id.upper()
+
+    async def get(self, key: str) -> Tuple[Dict[str, Any], int]:
+        full_key = self.key_prefix + self.key_filter(key.strip().upper())
+        now = self._expire()
+        item = self._items.get(full_key)
+        if item is None:
+            return {}, 0
+        value_s, expires = item
+        result = json.loads(value_s)
+        if not result:
+            self._remove(full_key)
+            return {}, 0
+        ttl = 0
+        if self.ttl:
+            ttl = expires - now if expires else -1
+            if -1 <= ttl <= self.renew_on_ttl:
+                if expires:
+                    self._wheel[expires % self.wheel_size].discard(full_key)
+                self._store(full_key, value_s, now + self.ttl)
+            ttl = max(0, ttl)
+        self._items.move_to_end(full_key)
+        return result, ttl
+
+    async def update(self, key: str, value: Dict[str, Any]) -> None:
+        full_key = self.key_prefix + self.key_filter(key.strip().upper())
+        now = self._expire()
+        value_s = json.dumps(value)
+        if full_key in self._items:
+            self._remove(full_key)
+        self._store(full_key, value_s, now + self.ttl if self.ttl else 0)
+        self.memory_usage += self._size(full_key, value_s)
+        # Evicts the least recently used dicts, down to the limits
+        while self._items and (
+            len(self._items) > self.max_entries or self.memory_usage > self.max_bytes
+        ):
+            self._remove(next(iter(self._items)))
+
+    async def destroy(self, key: str) -> None:
+        full_key = self.key_prefix + self.key_filter(key.strip().upper())
+        self._expire()
+        if full_key in self._items:
+            self._remove(full_key)
+
+
+__all__ = ["MemoryDictStorageDriver"]
@@ -9,8 +9,29 @@ from app.utils.unique_id import id, to_base32
 
 from ..dict_storage import DictStorageDriverBase
 
+# Gets a session and renews its expiry in one atomic call.
+# KEYS: the session key. ARGV: the ttl (0 if sessions do not expire), the ttl
+# at or below which the session is renewed, back to the full ttl.
+# Returns {} for a missing session, otherwise {value, ttl before renewal}
+GET_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if not value then
+    return {}
+end
+local ttl = 0
+if tonumber(ARGV[1]) > 0 then
+    ttl = redis.call('TTL', KEYS[1])
+    if ttl >= -1 and ttl <= tonumber(ARGV[2]) then
+        redis.call('EXPIRE', KEYS[1], ARGV[1])
+    end
+end
+return {value, ttl}
+"""
+
 
 class RedisDictStorageDriver(DictStorageDriverBase):
+    # The script get() runs, see GET_SCRIPT for its keys and first two arguments
+    get_script: str = GET_SCRIPT
     key_prefix: str
     key_filter: Callable[[str], str]
     key_filter_regex: str = ""
@@ -21,6 +42,7 @@ class RedisDictStorageDriver(DictStorageDriverBase):
     redis: aioredis.Redis
     redis_pool_min: int
     redis_pool_max: int
+    get_script_sha: str
 
     def __init__(
         self,
@@ -54,6 +76,7 @@ class RedisDictStorageDriver(DictStorageDriverBase):
         self.redis = await aioredis.create_redis_pool(
             self.redis_uri, minsize=self.redis_pool_min, maxsize=self.redis_pool_max
         )
+        self.get_script_sha = await self.redis.script_load(self.get_script)
         self.initialized = True
 
     async def create(self) -> str:
@@ -62,25 +85,20 @@ class RedisDictStorageDriver(DictStorageDriverBase):
         return new_id.upper()
 
     async def get(self, key: str) -> Tuple[Dict[str, Any], int]:
-        # [Note]: This action is not atomic, consider replacing with eval(Lua script).
         full_key = self.key_prefix + self.key_filter(key.strip().upper())
         ttl = 0
         try:
-            result_s = await self.redis.get(full_key, encoding="utf-8")
-            if not result_s:
+            reply = await self.get_and_renew(full_key)
+            if not reply:
                 raise LookupError
+            # The value is bytes, or str if the pool decodes replies
+            result_s, ttl = reply
             result = json.loads(result_s)
             if not isinstance(result, dict):
                 raise TypeError
             if not result:
                 raise ValueError
-            if self.ttl:
-                ttl = await self.redis.ttl(full_key)
-                if -1 <= ttl <= self.renew_on_ttl:
-                    await self.redis.expire(full_key, self.renew_on_ttl)
-                ttl = max(0, ttl)
-            else:
-                ttl = 0
+            ttl = max(0, ttl) if self.ttl else 0
         except (
             LookupError,
             UnicodeError,
@@ -92,8 +110,23 @@ class RedisDictStorageDriver(DictStorageDriverBase):
             if not isinstance(error, LookupError):
                 await self.redis.unlink(full_key)
             result = {}
+            ttl = 0
         return result, ttl
 
+    async def get_and_renew(self, full_key: str, *extra_args: Any) -> list:
+        """Runs the get script, loading it again if Redis has lost it (e.g. after a
+        restart or SCRIPT FLUSH)."""
+        args = [self.ttl, self.renew_on_ttl, *extra_args]
+        try:
+            return await self.redis.evalsha(
+                self.get_script_sha, keys=[full_key], args=args
+            )
+        except aioredis.errors.ReplyError as error:
+            if not str(error).startswith("NOSCRIPT"):
+                raise
+        self.get_script_sha = await self.redis.script_load(self.get_script)
+        return await self.redis.evalsha(self.get_script_sha, keys=[full_key], args=args)
+
     async def update(self, key: str, value: Dict[str, Any]) -> None:
         full_key = self.key_prefix + self.key_filter(key.strip().upper())
         await self.redis.set(
@@ -0,0 +1,152 @@
+import json
+from asyncio import TimeoutError as AioTimeoutError
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from .redis import RedisDictStorageDriver
+
+"""
+This module stores every dict as a Redis hash with one JSON encoded field per key,
+so that reading or changing one key of a large dict does not transfer the others.
+
+Fields listed in `lazy_fields` are left out of get() and read on demand with
+get_fields(), and update_fields() writes only the fields a request has changed. A
+hash that only holds lazy fields is still there: lookup() returns {} for it and
+None for a missing hash.
+"""
+
+# Gets the fields of a hash, except the lazy ones, and renews its expiry in one
+# atomic call.
+# KEYS: the hash key. ARGV: the ttl (0 if dicts do not expire), the ttl at or
+# below which the hash is renewed, back to the full ttl, then the lazy fields.
+# Returns {0} for a missing hash, otherwise {1, ttl before renewal, name, value,
+# ...}, with no name and value if the hash only holds lazy fields
+GET_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {0}
+end
+local ttl = 0
+if tonumber(ARGV[1]) > 0 then
+    ttl = redis.call('TTL', KEYS[1])
+    if ttl >= -1 and ttl <= tonumber(ARGV[2]) then
+        redis.call('EXPIRE', KEYS[1], ARGV[1])
+    end
+end
+local lazy = {}
+for i = 3, #ARGV do
+    lazy[ARGV[i]] = true
+end
+local names = {}
+for _, name in ipairs(redis.call('HKEYS', KEYS[1])) do
+    if not lazy[name] then
+        names[#names + 1] = name
+    end
+end
+local result = {1, ttl}
+if #names > 0 then
+    local values = redis.call('HMGET', KEYS[1], unpack(names))
+    for i, name in ipairs(names) do
+        result[#result + 1] = name
+        result[#result + 1] = values[i]
+    end
+end
+return result
+"""
+
+
+def _to_str(value: Union[bytes, str]) -> str:
+    # Replies are bytes, or str if the pool decodes them
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class RedisHashDictStorageDriver(RedisDictStorageDriver):
+    get_script: str = GET_SCRIPT
+    lazy_fields: List[str]
+
+    def __init__(self, *args: Any, lazy_fields: Iterable[str] = (), **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.lazy_fields = list(lazy_fields)
+
+    async def get(self, key: str) -> Tuple[Dict[str, Any], int]:
+        result, ttl = await self.lookup(key)
+        return result or {}, ttl
+
+    async def lookup(self, key: str) -> Tuple[Optional[Dict[str, Any]], int]:
+        full_key = self.key_prefix + self.key_filter(key.strip().upper())
+        ttl = 0
+        try:
+            reply = await self.get_and_renew(full_key, *self.lazy_fields)
+            if not reply or not reply[0]:
+                raise LookupError
+            ttl, fields = reply[1], reply[2:]
+            result = {
+                _to_str(name): json.loads(value)
+                for name, value in zip(fields[::2], fields[1::2])
+            }
+            ttl = max(0, ttl) if self.ttl else 0
+        except (
+            LookupError,
+            UnicodeError,
+            json.JSONDecodeError,
+            TypeError,
+            ValueError,
+            AioTimeoutError,
+        ) as error:
+            if not isinstance(error, LookupError):
+                await self.redis.unlink(full_key)
+            result = None
+            ttl = 0
+        return result, ttl
+
+    async def get_fields(self, key: str, fields: List[str]) -> Dict[str, Any]:
+        if not fields:
+            return {}
+        full_key = self.key_prefix + self.key_filter(key.strip().upper())
+        result = {}
+        try:
+            values = await self.redis.hmget(full_key, *fields)
+        except AioTimeoutError:
+            return result
+        for field, value in zip(fields, values):
+            if value is None:
+                continue
+            try:
+                result[field] = json.loads(value)
+            except (UnicodeError, json.JSONDecodeError):
+                # A broken field is dropped on its own, the rest of the dict is kept
+                await self.redis.hdel(full_key, field)
+        return result
+
+    async def update(self, key: str, value: Dict[str, Any]) -> None:
+        full_key = self.key_prefix + self.key_filter(key.strip().upper())
+        transaction = self.redis.multi_exec()
+        transaction.unlink(full_key)
+        if value:
+            transaction.hmset_dict(
+                full_key, {field: json.dumps(item) for field, item in value.items()}
+            )
+            if self.ttl:
+                transaction.expire(full_key, self.ttl)
+        await transaction.execute()
+
+    async def update_fields(
+        self, key: str, value: Dict[str, Any], fields: Iterable[str]
+    ) -> None:
+        full_key = self.key_prefix + self.key_filter(key.strip().upper())
+        fields = list(fields)
+        changed = {
+            field: json.dumps(value[field]) for field in fields if field in value
+        }
+        removed = [field for field in fields if field not in value]
+        if not changed and not removed:
+            return
+        transaction = self.redis.multi_exec()
+        if changed:
+            transaction.hmset_dict(full_key, changed)
+        if removed:
+            transaction.hdel(full_key, *removed)
+        if self.ttl:
+            transaction.expire(full_key, self.ttl)
+        await transaction.execute()
+
+
+__all__ = ["RedisHashDictStorageDriver"]
@@ -0,0 +1,310 @@
+import asyncio
+import hashlib
+import logging
+from bisect import bisect
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Type, Union
+from urllib.parse import urlsplit
+
+import aioredis
+
+from app.utils.metrics import metrics
+
+from ..dict_storage import DictStorageDriverBase
+from .redis import RedisDictStorageDriver
+
+"""
+This module spreads dicts over several storages, usually one Redis per shard, by
+consistent hashing: every shard is placed on a hash ring at `vnodes` points, and a
+key belongs to the shard of the first point at or after the hash of the key. Adding
+or removing a shard only moves the keys of the ring segments it owns.
+
+A shard that fails with a connection error is removed from the ring and the call
+is retried on the shard that takes its keys over. The dicts it held are lost, which
+suits sessions and caches. A background task probes failed shards every
+`health_check_interval` seconds and adds them back once they answer, so workers
+that saw a short outage agree on the ring again. Shards that are unreachable when
+the driver is initialized start out failed, unless none of them answers. Shards can
+also be added back with add_shard().
+"""
+
+logger = logging.getLogger(__name__)
+
+# Errors that take a shard out of the ring
+SHARD_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    aioredis.ConnectionClosedError,
+    aioredis.PoolClosedError,
+)
+
+
+# The key failed shards are probed with, it is read but never written
+HEALTH_CHECK_KEY = "HEALTH_CHECK"
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+def shard_name(redis_uri: str) -> str:
+    """Names the shard of a Redis URI by its address and database, so that changing
+    the credentials or options does not move keys."""
+    parts = urlsplit(redis_uri)
+    return "{}:{}{}".format(parts.hostname, parts.port or 6379, parts.path or "/0")
+
+
+class ShardedDictStorageDriver(DictStorageDriverBase):
+    shards: Dict[str, DictStorageDriverBase]
+    failed: Dict[str, DictStorageDriverBase]
+    vnodes: int
+    operations: Dict[str, int]
+    health_check_interval: float
+    metrics_prefix: str
+    _ring: List[Tuple[int, str]]
+    _task: Optional[asyncio.Task]
+
+    def __init__(
+        self,
+        key_prefix: str = "",
+        key_filter: Optional[Union[str, Callable[[str], str]]] = r"[^a-zA-Z0-9_-]+",
+        ttl: int = 0,
+        renew_on_ttl: int = 0,
+        redis_uris: Iterable[str] = (),
+        shard_class: Type[DictStorageDriverBase] = RedisDictStorageDriver,
+        shard_kwargs: Optional[Dict[str, Any]] = None,
+        shards: Optional[Dict[str, DictStorageDriverBase]] = None,
+        vnodes: int = 160,
+        health_check_interval: float = 5.0,
+        metrics_prefix: str = "dict_storage_shards",
+    ) -> None:
+        super().__init__(
+            key_prefix=key_prefix,
+            key_filter=key_filter,
+            ttl=ttl,
+            renew_on_ttl=renew_on_ttl,
+        )
+        if shards is None:
+            shards = {
+                shard_name(redis_uri): shard_class(
+                    key_prefix=key_prefix,
+                    key_filter=key_filter,
+                    ttl=ttl,
+                    renew_on_ttl=renew_on_ttl,
+                    redis_uri=redis_uri,
+                    **(shard_kwargs or {}),
+                )
+                for redis_uri in redis_uris
+            }
+        if not shards:
+            raise ValueError("A sharded storage needs at least one shard.")
+        self.lazy_fields = next(iter(shards.values())).lazy_fields
+        self.shards = {}
+        self.failed = {}
+        self.vnodes = vnodes
+        self.operations = {}
+        self.health_check_interval = health_check_interval
+        self.metrics_prefix = metrics_prefix
+        self._ring = []
+        self._task = None
+        for name, shard in shards.items():
+            self._place(name, shard)
+
+    def _place(self, name: str, shard: DictStorageDriverBase) -> None:
+        self.shards[name] = shard
+        self.operations.setdefault(name, 0)
+        self._ring = sorted(
+            self._ring
+            + [(_hash("{}#{}".format(name, i)), name) for i in range(self.vnodes)]
+        )
+        metrics.gauge(
+            "{}.{}.operations".format(self.metrics_prefix, name),
+            lambda: self.operations.get(name, 0),
+        )
+
+    def shard_for(self, key: str) -> str:
+        """Returns the name of the shard the key belongs to."""
+        if not self._ring:
+            raise LookupError("No shard is left in the ring.")
+        i = bisect(self._ring, (_hash(key.strip().upper()), ""))
+        return self._ring[i % len(self._ring)][1]
+
+    async def add_shard(
+        self, name: str, shard: Optional[DictStorageDriverBase] = None
+    ) -> None:
+        """Adds a shard, or puts back one that was removed after failing, and gives
+        it its keys back."""
+        failed = self.failed.pop(name, None)
+        if shard is None:
+            if failed is None:
+                raise KeyError(name)
+            shard = failed
+        elif failed is not None and failed.initialized:
+            await failed.terminate_driver()
+        if name in self.shards and self.shards[name] is not shard:
+            await self.remove_shard(name)
+        if self.initialized and not shard.initialized:
+            await shard.initialize_driver()
+        self._ring = [point for point in self._ring if point[1] != name]
+        self._place(name, shard)
+
+    async def remove_shard(self, name: str) -> None:
+        """Takes a shard out of the ring and closes it, its keys go to the shards
+        next to it on the ring."""
+        self._ring = [point for point in self._ring if point[1] != name]
+        shard = self.shards.pop(name, None) or self.failed.pop(name, None)
+        if shard is not None and shard.initialized:
+            await shard.terminate_driver()
+
+    def _fail(self, name: str) -> None:
+        self._ring = [point for point in self._ring if point[1] != name]
+        self.failed[name] = self.shards.pop(name)
+
+    async def _call(self, key: str, operation: str, *args: Any) -> Any:
+        while True:
+            name = self.shard_for(key)
+            shard = self.shards[name]
+            try:
+                result = await getattr(shard, operation)(key, *args)
+            except SHARD_ERRORS:
+                if self.shards.get(name) is not shard:
+                    # A concurrent call has already taken it out of the ring
+                    continue
+                if len(self.shards) <= 1:
+                    raise
+                logger.exception("Removing dict storage shard %s", name)
+                metrics.inc("{}.{}.failures".format(self.metrics_prefix, name))
+                # Kept open, its pool reconnects and the health check puts it back
+                self._fail(name)
+                continue
+            self.operations[name] = self.operations.get(name, 0) + 1
+            return result
+
+    async def check_failed(self) -> List[str]:
+        """Adds the failed shards that answer again back to the ring, returns their
+        names."""
+        recovered = []
+        for name, shard in list(self.failed.items()):
+            try:
+                if self.initialized and not shard.initialized:
+                    # It was unreachable when the driver was initialized
+                    await shard.initialize_driver()
+                await shard.lookup(HEALTH_CHECK_KEY)
+            except SHARD_ERRORS:
+                continue
+            if self.failed.get(name) is shard:
+                logger.info("Adding dict storage shard %s back", name)
+                await self.add_shard(name)
+                recovered.append(name)
+        return recovered
+
+    async def _check_failed_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self.check_failed()
+            except Exception:
+                logger.exception("Could not check the failed dict storage shards")
+
+    async def set_key_prefix(self, new_key_prefix: str = "") -> None:
+        self.key_prefix = new_key_prefix
+        for shard in [*self.shards.values(), *self.failed.values()]:
+            await shard.set_key_prefix(new_key_prefix)
+
+    async def initialize_driver(self) -> None:
+        # The driver must be initialized first.
+        shards = [
+            (name, shard)
+            for name, shard in self.shards.items()
+            if not shard.initialized
+        ]
+        results = await asyncio.gather(
+            *(shard.initialize_driver() for _, shard in shards),
+            return_exceptions=True,
+        )
+        errors = []
+        for (name, shard), result in zip(shards, results):
+            if isinstance(result, SHARD_ERRORS):
+                errors.append((name, result))
+            elif isinstance(result, BaseException):
+                raise result
+        if len(errors) == len(self.shards):
+            # Nothing to fall back on, the next initialization tries them all again
+            raise errors[0][1]
+        for name, error in errors:
+            # The health check initializes it and adds it back once it answers
+            logger.error("Dict storage shard %s is unreachable: %r", name, error)
+            metrics.inc("{}.{}.failures".format(self.metrics_prefix, name))
+            self._fail(name)
+        if self.health_check_interval > 0 and self._task is None:
+            self._task = asyncio.ensure_future(self._check_failed_periodically())
+        self.initialized = True
+
+    async def create(self) -> str:
+        return await next(iter(self.shards.values())).create()
+
+    async def get(self, key: str) -> Tuple[Dict[str, Any], int]:
+        return await self._call(key, "get")
+
+    async def lookup(self, key: str) -> Tuple[Optional[Dict[str, Any]], int]:
+        return await self._call(key, "lookup")
+
+    async def get_fields(self, key: str, fields: List[str]) -> Dict[str, Any]:
+        return await self._call(key, "get_fields", fields)
+
+    async def update(self, key: str, value: Dict[str, Any]) -> None:
+        await self._call(key, "update", value)
+
+    async def update_fields(
+        self, key: str, value: Dict[str, Any], fields: Iterable[str]
+    ) -> None:
+        await self._call(key, "update_fields", value, list(fields))
+
+    async def destroy(self, key: str) -> None:
+        await self._call(key, "destroy")
+
+    async def terminate_driver(self) -> None:
+        # The driver must be terminated correctly in the end.
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.gather(
+            *(
+                shard.terminate_driver()
+                for shard in [*self.shards.values(), *self.failed.values()]
+                if shard.initialized
+            )
+        )
+        self.initialized = False
+
+
+def redis_dict_storage(
+    redis_uris: List[str],
+    shard_class: Type[DictStorageDriverBase] = RedisDictStorageDriver,
+    **kwargs: Any,
+) -> DictStorageDriverBase:
+    """Returns a driver over the given Redis URIs, sharded if there are several."""
+    if len(redis_uris) == 1:
+        return shard_class(redis_uri=redis_uris[0], **kwargs)
+    shard_kwargs = {
+        name: kwargs.pop(name)
+        for name in list(kwargs)
+        if name not in ("key_prefix", "key_filter", "ttl", "renew_on_ttl")
+    }
+    return ShardedDictStorageDriver(
+        redis_uris=redis_uris,
+        shard_class=shard_class,
+        shard_kwargs=shard_kwargs,
+        **kwargs,
+    )
+
+
+__all__ = [
+    "HEALTH_CHECK_KEY",
+    "ShardedDictStorageDriver",
+    "redis_dict_storage",
+    "shard_name",
+]
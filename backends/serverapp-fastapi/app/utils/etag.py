@@ -0,0 +1,33 @@
+import hashlib
+
+from fastapi import Request
+
+"""
+This module provides helpers for conditional GET requests: responses carry a
+strong ETag computed from their body, and a client that sends it back in
+If-None-Match gets a 304 Not Modified without the body.
+"""
+
+
+def strip_weak(etag: str) -> str:
+    etag = etag.strip()
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def make_etag(body: str) -> str:
+    """Returns a strong entity tag for the given response body."""
+    return '"{}"'.format(hashlib.sha1(body.encode("utf-8")).hexdigest())
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Returns whether the If-None-Match header of the request matches the entity
+    tag, using the weak comparison RFC 7232 specifies for If-None-Match."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(strip_weak(tag) == strip_weak(etag) for tag in header.split(","))
+
+
+__all__ = ["make_etag", "etag_matches"]
@@ -0,0 +1,36 @@
+from typing import Callable, Dict
+
+"""
+This module keeps the in-process metrics of a worker: counters that are incremented
+as things happen, and gauges that are computed when the metrics are read.
+"""
+
+
+class MetricsRegistry:
+    _counters: Dict[str, float]
+    _gauges: Dict[str, Callable[[], float]]
+
+    def __init__(self) -> None:
+        self._counters = {}
+        self._gauges = {}
+
+    def inc(self, name: str, value: float = 1) -> None:
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def set(self, name: str, value: float) -> None:
+        self._counters[name] = value
+
+    def gauge(self, name: str, read: Callable[[], float]) -> None:
+        """Registers a gauge, `read` is called every time the metrics are read."""
+        self._gauges[name] = read
+
+    def snapshot(self) -> Dict[str, float]:
+        values = dict(self._counters)
+        for name, read in self._gauges.items():
+            values[name] = read()
+        return dict(sorted(values.items()))
+
+
+metrics = MetricsRegistry()
+
+__all__ = ["MetricsRegistry", "metrics"]
@@ -0,0 +1,137 @@
+import json
+from typing import Dict, List, Optional
+
+from app.core.config import settings
+from app.core.rating_counters import rating_counters
+from app.core.redis import get_redis
+from app.models.db.movies import Movies
+from app.models.db.positions import Positions
+from app.utils.lru import LRUCache
+
+"""
+This module caches the movie detail document, everything the movie page shows
+about a movie: its fields, genres, top billed crew and rating aggregates. Like
+tiles, the document is viewer independent, the banlist adjustment of the rating
+is applied per request.
+
+Documents are cached in two levels, a per-worker LRU in front of one Redis key
+per movie, and are loaded from the database on a miss. Rating and review writes
+invalidate them, other catalog changes are picked up within
+MOVIE_DETAIL_CACHE_TTL seconds. Documents loaded while the rating counters were
+flushed are not cached.
+"""
+
+# the most crew members a document holds, in billing order. The rest of the
+# crew is listed page by page, see list_crew()
+CREW_SIZE = 50
+
+
+async def list_crew(movie_id: str, offset: int, limit: int) -> List[Dict]:
+    """Returns crew members of a movie in billing order."""
+    return [
+        {
+            "id": str(position["person_id"]),
+            "name": position["person__name"],
+            "position": position["position"],
+            "image": position["person__image"],
+        }
+        for position in await Positions.filter(movie_id=movie_id)
+        .order_by("billing_order", "position_id")
+        .offset(offset)
+        .limit(limit)
+        .values("person_id", "person__name", "position", "person__image")
+    ]
+
+
+async def load_movie_detail(movie_id: str) -> Optional[Dict]:
+    """Builds the detail document of a movie from the database, None if the movie
+    does not exist."""
+    movie = (
+        await Movies.filter(movie_id=movie_id, delete_date=None)
+        .prefetch_related("genres")
+        .first()
+    )
+    if movie is None:
+        return None
+    cumulative_rating, num_votes = await rating_counters.merge(
+        movie_id, movie.cumulative_rating, movie.num_votes
+    )
+    return {
+        "movie_id": str(movie.movie_id),
+        "title": movie.title,
+        "release_date": str(movie.release_date),
+        "release_year": str(movie.release_date.year),
+        "description": movie.description,
+        "image": movie.image,
+        "trailers": movie.trailer,
+        "genres": [genre.name for genre in movie.genres],
+        "crew": await list_crew(movie_id, 0, CREW_SIZE),
+        "num_crew": await Positions.filter(movie_id=movie_id).count(),
+        "num_reviews": movie.num_reviews,
+        "num_votes": num_votes,
+        "cumulative_rating": cumulative_rating,
+    }
+
+
+class MovieDetailCache:
+    prefix: str
+    ttl: int
+    lru: LRUCache
+
+    def __init__(
+        self,
+        prefix: str = "movie_detail:",
+        ttl: int = settings.MOVIE_DETAIL_CACHE_TTL,
+        lru_size: int = settings.MOVIE_DETAIL_LRU_SIZE,
+        lru_ttl: int = settings.MOVIE_DETAIL_LRU_TTL,
+    ) -> None:
+        self.prefix = prefix
+        self.ttl = ttl
+        self.lru = LRUCache(maxsize=lru_size, ttl=lru_ttl)
+
+    async def get(self, movie_id: str) -> Optional[Dict]:
+        """Returns the detail document of the movie, loading and caching it on a
+        miss. Returns None if the movie does not exist."""
+        movie_id = str(movie_id)
+        detail = self.lru.get(movie_id)
+        if detail is not None:
+            return detail
+        redis = await get_redis()
+        value = await redis.get(self.prefix + movie_id, encoding="utf-8")
+        if value is not None:
+            detail = json.loads(value)
+            self.lru.set(movie_id, detail)
+            return detail
+        generation = await rating_counters.generation()
+        detail = await load_movie_detail(movie_id)
+        # See MovieTileCache.get_many()
+        if detail is not None and await rating_counters.unchanged_since(generation):
+            await redis.set(self.prefix + movie_id, json.dumps(detail), expire=self.ttl)
+            self.lru.set(movie_id, detail)
+        return detail
+
+    async def invalidate(self, movie_ids: List[str]) -> None:
+        """Drops the given movies' documents, to be called after rating or review
+        writes.
+
+        Other workers' LRUs are not notified and expire on their own within
+        MOVIE_DETAIL_LRU_TTL seconds.
+        """
+        movie_ids = [str(movie_id) for movie_id in movie_ids]
+        if not movie_ids:
+            return
+        for movie_id in movie_ids:
+            self.lru.pop(movie_id)
+        redis = await get_redis()
+        await redis.delete(*(self.prefix + movie_id for movie_id in movie_ids))
+
+
+movie_details = MovieDetailCache()
+
+__all__ = [
+    "CREW_SIZE",
+    "MovieDetailCache",
+    "movie_details",
+    "load_movie_detail",
+    "list_crew",
+]
@@ -0,0 +1,147 @@
+import json
+import time
+from typing import Dict, Iterable, List
+
+from app.core.config import settings
+from app.core.rating_counters import rating_counters
+from app.core.redis import get_redis
+from app.models.db.movies import Movies
+from app.models.db.positions import Positions
+from app.utils.lru import LRUCache
+
+"""
+This module caches movie "tiles", the compact movie objects shown by search,
+recommendations and wishlists. Tiles are viewer independent: the rating aggregates
+are not adjusted for any banlist.
+
+Tiles are cached in two levels, a per-worker LRU in front of a single Redis hash
+keyed by movie_id, and are loaded from the database in one batch on a miss. Tiles
+loaded while the rating counters were flushed are not cached.
+"""
+
+
+async def load_movie_tiles(movie_ids: Iterable[str]) -> Dict[str, Dict]:
+    """Builds the tiles of the given movies from the database."""
+    tiles = {}
+    for movie in await Movies.filter(
+        movie_id__in=list(movie_ids), delete_date=None
+    ).prefetch_related("genres"):
+        tiles[str(movie.movie_id)] = {
+            "movie_id": str(movie.movie_id),
+            "title": movie.title,
+            "release_date": movie.release_date.isoformat(),
+            "image": movie.image,
+            "genres": [genre.name for genre in movie.genres],
+            "directors": [],
+            "num_reviews": movie.num_reviews,
+            "num_votes": movie.num_votes,
+            "cumulative_rating": movie.cumulative_rating,
+        }
+    for movie_id, (cumulative_rating, num_votes) in (
+        await rating_counters.pending(tiles)
+    ).items():
+        tiles[movie_id]["cumulative_rating"] += cumulative_rating
+        tiles[movie_id]["num_votes"] += num_votes
+    if tiles:
+        for position in await Positions.filter(
+            movie_id__in=list(tiles), position="director"
+        ).values("movie_id", "person__name"):
+            tiles[str(position["movie_id"])]["directors"].append(
+                position["person__name"]
+            )
+    return tiles
+
+
+class MovieTileCache:
+    key: str
+    ttl: int
+    lru: LRUCache
+
+    def __init__(
+        self,
+        key: str = "movie_tiles",
+        ttl: int = settings.MOVIE_TILE_CACHE_TTL,
+        lru_size: int = settings.MOVIE_TILE_LRU_SIZE,
+        lru_ttl: int = settings.MOVIE_TILE_LRU_TTL,
+    ) -> None:
+        self.key = key
+        self.ttl = ttl
+        self.lru = LRUCache(maxsize=lru_size, ttl=lru_ttl)
+
+    async def get_many(self, movie_ids: Iterable[str]) -> Dict[str, Dict]:
+        """Returns the tiles of the given movies in the given order, loading and
+        caching missing tiles. Movies that do not exist are left out."""
+        movie_ids = [str(movie_id) for movie_id in movie_ids]
+        tiles = self.lru.get_many(movie_ids)
+        missing = [
+            movie_id for movie_id in dict.fromkeys(movie_ids) if movie_id not in tiles
+        ]
+        if missing:
+            redis = await get_redis()
+            now = time.time()
+            not_cached = []
+            for movie_id, value in zip(
+                missing, await redis.hmget(self.key, *missing, encoding="utf-8")
+            ):
+                # Redis can only expire the whole hash, so each field holds its own
+                # expiry time. The hash never outgrows the catalog.
+                expires, tile = json.loads(value) if value else (0, None)
+                if expires > now:
+                    tiles[movie_id] = tile
+                    self.lru.set(movie_id, tile)
+                else:
+                    not_cached.append(movie_id)
+            if not_cached:
+                generation = await rating_counters.generation()
+                loaded = await load_movie_tiles(not_cached)
+                # Tiles loaded while the rating counters were flushed may count
+                # changes twice or not at all, they are only cached if no flush ran
+                if await rating_counters.unchanged_since(generation):
+                    await self.set_many(loaded)
+                tiles.update(loaded)
+        return {
+            movie_id: tiles[movie_id] for movie_id in movie_ids if movie_id in tiles
+        }
+
+    async def set_many(self, tiles: Dict[str, Dict]) -> None:
+        if not tiles:
+            return
+        expires = time.time() + self.ttl
+        redis = await get_redis()
+        await redis.hmset_dict(
+            self.key,
+            {movie_id: json.dumps([expires, tile]) for movie_id, tile in tiles.items()},
+        )
+        for movie_id, tile in tiles.items():
+            self.lru.set(movie_id, tile)
+
+    async def invalidate(self, movie_ids: List[str]) -> None:
+        """Drops the given movies' tiles, to be called after rating or review writes.
+
+        Other workers' LRUs are not notified and expire on their own within
+        MOVIE_TILE_LRU_TTL seconds.
+        """
+        movie_ids = [str(movie_id) for movie_id in movie_ids]
+        if not movie_ids:
+            return
+        for movie_id in movie_ids:
+            self.lru.pop(movie_id)
+        redis = await get_redis()
+        await redis.hdel(self.key, *movie_ids)
+
+
+def tile_average_rating(tile: Dict) -> List[float]:
+    """Returns the (not banlist adjusted) rating of a tile in the same
+    [average, num_votes, cumulative] form as the Elasticsearch rating script."""
+    num_votes = tile["num_votes"]
+    cumulative_rating = tile["cumulative_rating"]
+    return [
+        cumulative_rating / num_votes if num_votes > 0 else 0.0,
+        num_votes,
+        cumulative_rating,
+    ]
+
+
+movie_tiles = MovieTileCache()
+
+__all__ = ["MovieTileCache", "movie_tiles", "load_movie_tiles", "tile_average_rating"]
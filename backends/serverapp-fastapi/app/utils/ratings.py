@@ -1,33 +1,14 @@
-from app.models.db.banlists import Banlists
-from app.models.db.ratings import Ratings
-from app.models.db.reviews import Reviews
+from typing import Dict, Tuple
+
+from app.utils.banned_ratings import banned_ratings
 
 
 """
-This helper function is used for calculating the average rating of a 
-movie. It takes into account banned list if a user_id is provided.
+These helper functions are used for calculating the average rating of
+movies. They take into account banned list if a user_id is provided.
 """
 
-async def calc_average_rating(
-    cumulative_rating, num_votes, user_id=None, movie_id=None
-) -> float:
-    if (user_id is not None) and (movie_id is not None):
-        ban_list = await Banlists.filter(user_id=user_id, delete_date=None).values(
-            "banned_user_id"
-        )
-        exclude_list = []
-        for item in ban_list:
-            exclude_list.append(str(item["banned_user_id"]))
-
-        exclude_rating = await Ratings.filter(
-            movie_id=movie_id, user_id__in=exclude_list, delete_date=None
-        ).values("rating")
-
-        for item in exclude_rating:
-            if item["rating"] is not None:
-                cumulative_rating = cumulative_rating - item["rating"]
-                num_votes = num_votes - 1
-
+def to_rating(cumulative_rating, num_votes) -> dict:
     average_rating = round(cumulative_rating / num_votes if num_votes > 0 else 0.0, 1)
     rating = dict()
     rating["average_rating"] = average_rating
@@ -36,4 +17,40 @@ async def calc_average_rating(
     return rating
 
 
-__all__ = ["calc_average_rating"]
+async def calc_average_rating(
+    cumulative_rating, num_votes, user_id=None, movie_id=None
+) -> float:
+    if (user_id is not None) and (movie_id is not None):
+        return (
+            await calc_average_ratings(
+                {str(movie_id): (cumulative_rating, num_votes)}, user_id
+            )
+        )[str(movie_id)]
+    return to_rating(cumulative_rating, num_votes)
+
+
+async def calc_average_ratings(
+    movies: Dict[str, Tuple[float, int]], user_id=None
+) -> Dict[str, dict]:
+    """
+    Batch version of calc_average_rating, for lists of movies. Takes the
+    (cumulative_rating, num_votes) of each movie id and returns their ratings,
+    with the ratings of the users banned by the user looked up in one call to
+    the maintained banned rating deltas.
+    """
+    excluded = (
+        await banned_ratings.get_many(user_id, list(movies))
+        if user_id is not None
+        else {}
+    )
+
+    ratings = {}
+    for movie_id, (cumulative_rating, num_votes) in movies.items():
+        excluded_rating, excluded_votes = excluded.get(movie_id, (0, 0))
+        ratings[movie_id] = to_rating(
+            cumulative_rating - excluded_rating, num_votes - excluded_votes
+        )
+    return ratings
+
+
+__all__ = ["calc_average_rating", "calc_average_ratings"]
@@ -0,0 +1,31 @@
+"""
+This module scores reviews for the "top" ordering of review listings.
+
+The rank score of a review is the lower bound of the Wilson score interval of
+the share of its votes that are helpful, with spoiler votes counted against it.
+It favours reviews that many users found helpful over ones with a single helpful
+vote, and is 0 for reviews without votes. The score is kept in the indexed
+`rank_score` column of reviews, updated by the statements that change the vote
+counts.
+"""
+
+# z for a 95% confidence interval
+Z = 1.96
+
+
+def rank_score_sql(num_helpful: str, num_spoiler: str) -> str:
+    """
+    Returns the SQL expression of the rank score of a review, given the SQL
+    expressions of its helpful (h) and spoiler (s) vote counts:
+
+        (h + z²/2 - z * sqrt(h * s / (h + s) + z²/4)) / (h + s + z²)
+    """
+    h, s = "({})".format(num_helpful), "({})".format(num_spoiler)
+    return (
+        "CASE WHEN {h} + {s} <= 0 THEN 0 ELSE ({h} + {z2} / 2 - {z} * "
+        "sqrt({h} * {s}::float8 / ({h} + {s}) + {z2} / 4)) / ({h} + {s} + {z2}) "
+        "END".format(h=h, s=s, z=Z, z2=round(Z * Z, 4))
+    )
+
+
+__all__ = ["rank_score_sql"]
@@ -0,0 +1,117 @@
+import importlib
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+"""
+Search engines run the keyword searches behind the search bar, suggestions and
+hydration of ratings. They only return movie ids, scores and banlist adjusted
+ratings; everything else is read from the movie tile cache.
+
+An engine is picked with the SEARCH_ENGINE setting, see get_search_engine().
+"""
+
+
+class SearchHit(NamedTuple):
+    movie_id: str
+    score: float
+    # [average rating, number of votes, cumulative rating], banlist adjusted
+    average_rating: List[float]
+    # Engine specific sort values, only set by search_page()
+    sort: Optional[List[Any]] = None
+
+
+class SearchPage(NamedTuple):
+    hits: List[SearchHit]
+    total: int
+    # (name, count) and (year, count) facets, only computed when asked for
+    genres: Optional[List[Tuple[str, int]]]
+    years: Optional[List[Tuple[str, int]]]
+    # The sort values to resume after, None on the last page
+    after: Optional[List[Any]]
+    # (name, count) facets of directors, None if not asked for or if the engine
+    # cannot tell directors from other people
+    directors: Optional[List[Tuple[str, int]]] = None
+
+
+class SearchEngineBase:
+    initialized: bool = False
+    # Whether search_page() can filter on directors, rather than on any person
+    filters_directors: bool = True
+
+    async def initialize_engine(self) -> None:
+        # The engine must be initialized first.
+        self.initialized = True
+
+    async def search(
+        self,
+        keywords: Optional[str] = None,
+        field: str = "all",
+        movies: Optional[List[str]] = None,
+        list_ban: Optional[List[str]] = None,
+        size: int = 10,
+    ) -> List[SearchHit]:
+        """Returns the best `size` movies matching the keywords, best first.
+
+        Numbers in the keywords are also matched as release years. If `movies` is
+        given, only those movies are matched.
+        """
+        return []
+
+    async def search_page(
+        self,
+        keywords: Optional[str] = None,
+        genres: Optional[List[str]] = None,
+        years: Optional[List[str]] = None,
+        directors: Optional[List[str]] = None,
+        per_page: int = 1,
+        sort: str = ("relevance", "rating", "name", "year")[0],
+        desc: bool = True,
+        field: str = "all",
+        after: Optional[List[Any]] = None,
+        list_ban: Optional[List[str]] = None,
+        facets: bool = False,
+    ) -> SearchPage:
+        """Returns one page of filtered and sorted movies, starting after the sort
+        values of the last movie of the previous page. Empty keywords match every
+        movie."""
+        return SearchPage([], 0, None, None, None)
+
+    async def ratings(
+        self, movies: List[str], list_ban: Optional[List[str]] = None
+    ) -> Dict[str, List[float]]:
+        """Returns the banlist adjusted ratings of the given movies."""
+        return {}
+
+    async def suggest(
+        self, keyword: str, limit: int = 8, field: str = "all"
+    ) -> List[Dict[str, Any]]:
+        """Returns the movie_id, title, release_date and image of the best `limit`
+        movies matching what the user has typed so far."""
+        return []
+
+    async def terminate_engine(self) -> None:
+        # The engine must be terminated correctly in the end.
+        self.initialized = False
+
+
+SEARCH_ENGINES = {
+    "elasticsearch": ("elasticsearch", "ElasticsearchSearchEngine"),
+    "postgres": ("postgres", "PostgresSearchEngine"),
+    "inverted_index": ("inverted_index", "InvertedIndexSearchEngine"),
+}
+
+
+def get_search_engine(name: str) -> SearchEngineBase:
+    try:
+        module, engine = SEARCH_ENGINES[name]
+    except KeyError:
+        raise ValueError("Unknown search engine: " + name)
+    return getattr(importlib.import_module("." + module, __name__), engine)()
+
+
+__all__ = [
+    "SearchHit",
+    "SearchPage",
+    "SearchEngineBase",
+    "SEARCH_ENGINES",
+    "get_search_engine",
+]
@@ -0,0 +1,323 @@
+import re
+from typing import Any, Dict, List, Optional
+
+from elasticsearch import Elasticsearch, RequestsHttpConnection, Urllib3HttpConnection
+from elasticsearch_dsl import Q, Search, connections
+
+from app.core.config import settings
+
+from . import SearchEngineBase, SearchHit, SearchPage
+
+"""
+The Elasticsearch search engine, querying the movie index kept in sync by pgsync.
+Banlist adjusted ratings are computed by the stored `calculate_rating_field` and
+`calculate_rating_sort` scripts.
+"""
+
+
+def get_search_fields(field: str = "all") -> List[str]:
+    """Maps the search type selected in the search bar to the fields to match on."""
+    if field == "all":
+        return [
+            "title^10",
+            "description",
+            "genres.name.keyword",
+            "positions.people.name",
+            "positions.char_name",
+        ]
+    if field == "title":
+        return ["title"]
+    elif field == "description":
+        return ["description"]
+    elif field == "genres":
+        return ["genres.name"]
+    elif field == "people":
+        return ["positions.people.name"]
+    return []
+
+
+def year_query(year: str) -> Q:
+    return Q(
+        "range",
+        release_date={
+            "gte": year + "||/y",
+            "lte": year + "||/y",
+            "format": "yyyy",
+        },
+    )
+
+
+class ElasticsearchSearchEngine(SearchEngineBase):
+    initialized: bool = False
+    # Positions are indexed as plain objects rather than nested documents, so a
+    # director can only be matched by name among all people of the movie
+    filters_directors: bool = False
+    client: Optional[Elasticsearch]
+    index: str
+
+    def __init__(
+        self,
+        client: Optional[Elasticsearch] = None,
+        index: str = settings.ELASTICSEARCH_MOVIEINDEX,
+    ) -> None:
+        self.client = client
+        self.index = index
+
+    async def initialize_engine(self) -> None:
+        # The engine must be initialized first.
+        if self.client is None:
+            self.client = connections.create_connection(
+                hosts=settings.ELASTICSEARCH_URI,
+                alias=settings.ELASTICSEARCH_ALIAS,
+                connection_class=RequestsHttpConnection
+                if settings.ELASTICSEARCH_TRANSPORTCLASS == "RequestsHttpConnection"
+                else Urllib3HttpConnection,
+                timeout=settings.ELASTICSEARCH_TIMEOUT,
+                use_ssl=settings.ELASTICSEARCH_USESSL,
+                verify_certs=settings.ELASTICSEARCH_VERIFYCERTS,
+                ssl_show_warn=settings.ELASTICSEARCH_SHOWSSLWARNINGS,
+            )
+        self.initialized = True
+
+    def build_movie_search(
+        self,
+        keywords: Optional[str] = None,
+        field: str = "all",
+        movies: Optional[List[str]] = None,
+        list_ban: Optional[List[str]] = None,
+        size: int = 10,
+    ) -> Search:
+        """Builds the scoring query used by search(), see its docstring.
+
+        Returns:
+            An unexecuted Search object.
+        """
+
+        # Build query context for scoring results
+        years_in_keywords: List[str] = (
+            re.findall(r"(\d{4})", keywords) if keywords is not None else []
+        )
+
+        # Match on fields and consider numbers in keyword as years if present
+        query = Q(
+            "bool",
+            must=[
+                Q(
+                    "multi_match",
+                    query=keywords,
+                    fields=get_search_fields(field),
+                )
+            ]
+            if keywords is not None
+            else [],
+            should=[Q("bool", should=[year_query(year)]) for year in years_in_keywords]
+            + (
+                [Q("match", movie_id=movie_id) for movie_id in movies]
+                if movies is not None
+                else []
+            ),
+            minimum_should_match=(
+                1 if ((movies is not None) or years_in_keywords) else 0
+            ),
+        )
+
+        search = (
+            Search(using=self.client, index=self.index).extra(size=size).query(query)
+        )
+        return self.with_ratings(search, list_ban)
+
+    def build_hydration_search(
+        self, movies: List[str], list_ban: Optional[List[str]] = None
+    ) -> Search:
+        """Builds a non-scoring query that looks up the given movie ids.
+
+        The ids are matched with a single `terms` filter, so Elasticsearch skips
+        relevance scoring entirely, and only as many hits as ids are requested.
+        """
+        search = (
+            Search(using=self.client, index=self.index)
+            .filter("terms", movie_id=movies)
+            .extra(size=len(movies), track_total_hits=False)
+        )
+        return self.with_ratings(search, list_ban)
+
+    def with_ratings(self, search: Search, list_ban: Optional[List[str]]) -> Search:
+        search = search.script_fields(
+            average_rating={
+                "script": {
+                    "id": "calculate_rating_field",
+                    "params": {"listban": ",".join(list_ban or [])},
+                }
+            }
+        )
+        # Movie details are hydrated from the tile cache
+        return search.source(["movie_id"])
+
+    async def search(
+        self,
+        keywords: Optional[str] = None,
+        field: str = "all",
+        movies: Optional[List[str]] = None,
+        list_ban: Optional[List[str]] = None,
+        size: int = 10,
+    ) -> List[SearchHit]:
+        response = self.build_movie_search(
+            keywords, field, movies, list_ban, size
+        ).execute()
+        return [
+            SearchHit(hit.movie_id, hit.meta.score, list(hit.average_rating))
+            for hit in response
+        ]
+
+    async def search_page(
+        self,
+        keywords: Optional[str] = None,
+        genres: Optional[List[str]] = None,
+        years: Optional[List[str]] = None,
+        directors: Optional[List[str]] = None,
+        per_page: int = 1,
+        sort: str = ("relevance", "rating", "name", "year")[0],
+        desc: bool = True,
+        field: str = "all",
+        after: Optional[List[Any]] = None,
+        list_ban: Optional[List[str]] = None,
+        facets: bool = False,
+    ) -> SearchPage:
+        """Walks pages with `search_after` on the sort values plus `movie_id` as a
+        stable tiebreaker, so every page fetches only `per_page` hits no matter how
+        deep it is."""
+
+        # Score on keywords (as search() does), facets are non-scoring filters
+        years_in_keywords: List[str] = re.findall(r"(\d{4})", keywords or "")
+        filters = []
+        if genres:
+            filters.append(Q("terms", **{"genres.name.keyword": genres}))
+        if years:
+            filters.append(
+                Q(
+                    "bool",
+                    should=[year_query(year) for year in years],
+                    minimum_should_match=1,
+                )
+            )
+        if directors:
+            # Matches any person of that name, see filters_directors
+            filters.append(
+                Q(
+                    "bool",
+                    should=[
+                        Q("match_phrase", **{"positions.people.name": director})
+                        for director in directors
+                    ],
+                    minimum_should_match=1,
+                )
+            )
+        query = Q(
+            "bool",
+            must=[Q("multi_match", query=keywords, fields=get_search_fields(field))]
+            if keywords
+            else [Q("match_all")],
+            should=[year_query(year) for year in years_in_keywords],
+            minimum_should_match=1 if years_in_keywords else 0,
+            filter=filters,
+        )
+
+        order = "desc" if desc else "asc"
+        sort_keys = {
+            "relevance": [{"_score": {"order": order}}],
+            "rating": [
+                {
+                    "_script": {
+                        "type": "number",
+                        "script": {
+                            "id": "calculate_rating_sort",
+                            "params": {"listban": ",".join(list_ban or [])},
+                        },
+                        "order": order,
+                    }
+                }
+            ],
+            "name": [{"title.title_sort": {"order": order}}],
+            "year": [{"release_date": {"order": order}}],
+        }[sort] + [{"movie_id": {"order": "asc"}}]
+
+        search = (
+            Search(using=self.client, index=self.index)
+            .query(query)
+            .sort(*sort_keys)
+            .extra(size=per_page, track_scores=True, track_total_hits=True)
+        )
+        if after is not None:
+            search = search.extra(search_after=after)
+        if facets:
+            search.aggs.bucket("genres", "terms", field="genres.name.keyword", size=100)
+            search.aggs.bucket(
+                "years",
+                "date_histogram",
+                field="release_date",
+                calendar_interval="year",
+                format="yyyy",
+                min_doc_count=1,
+            )
+        response = self.with_ratings(search, list_ban).execute()
+
+        hits = [
+            SearchHit(
+                hit.movie_id,
+                hit.meta.score,
+                list(hit.average_rating),
+                list(hit.meta.sort),
+            )
+            for hit in response
+        ]
+        return SearchPage(
+            hits=hits,
+            total=response.hits.total.value,
+            genres=[
+                (bucket.key, bucket.doc_count)
+                for bucket in response.aggregations.genres.buckets
+            ]
+            if facets
+            else None,
+            years=[
+                (bucket.key_as_string, bucket.doc_count)
+                for bucket in response.aggregations.years.buckets
+            ]
+            if facets
+            else None,
+            after=hits[-1].sort if len(hits) == per_page else None,
+        )
+
+    async def ratings(
+        self, movies: List[str], list_ban: Optional[List[str]] = None
+    ) -> Dict[str, List[float]]:
+        return {
+            hit.movie_id: list(hit.average_rating)
+            for hit in self.build_hydration_search(movies, list_ban).execute()
+        }
+
+    async def suggest(
+        self, keyword: str, limit: int = 8, field: str = "all"
+    ) -> List[Dict[str, Any]]:
+        search = (
+            Search(using=self.client, index=self.index)
+            .extra(size=limit)
+            .query(
+                Q(
+                    "bool",
+                    must=[
+                        Q(
+                            "multi_match",
+                            query=keyword,
+                            fields=get_search_fields(field),
+                        )
+                    ],
+                )
+            )
+            .source(["movie_id", "title", "image", "release_date"])
+            .sort({"_score": {"order": "desc"}})
+        )
+        return [hit.to_dict() for hit in search.execute()]
+
+
+__all__ = ["ElasticsearchSearchEngine", "get_search_fields"]
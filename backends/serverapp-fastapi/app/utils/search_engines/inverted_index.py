@@ -0,0 +1,651 @@
+import json
+import os
+import re
+import shutil
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from tortoise import Tortoise
+
+from app.core.config import settings
+from app.core.rating_counters import rating_counters
+
+from . import SearchEngineBase, SearchHit, SearchPage
+
+"""
+An in-process search engine over an inverted index held in NumPy arrays, for nodes
+that should answer searches without a network hop (such as read-only replicas) and
+for tests that need a deterministic engine.
+
+The index is built from the movie tables when the engine starts and snapshotted to
+a directory of `.npy` files (INVERTED_INDEX_PATH), which later starts can memory map
+instead of rebuilding. Keywords are scored with BM25 the way the Elasticsearch
+`multi_match` query scores them: every field on its own, a movie scores as its best
+field and titles are boosted ten times. Character names are not searched.
+
+The rating counters of the movies a search returns, and of those rated by the
+users the viewer has banned, are read from the database with the changes not
+flushed yet (see app/core/rating_counters.py) before the ratings of the banned users
+are taken off them. The engine keeps what it read, so sorting by rating uses the
+counters of the snapshot for movies no search has returned since; the ratings shown
+are always current. Movies added after the snapshot are not searched, but ratings()
+reads them from the database.
+"""
+
+FORMAT_VERSION = 2
+# The BM25 parameters, Elasticsearch defaults
+K1 = 1.2
+B = 0.75
+# Fields whose terms are whole names rather than words; like keyword fields in
+# Elasticsearch they are not normalized by length
+NAME_FIELDS = ("genre_names", "directors")
+FIELDS = ("title", "description", "genres", "people") + NAME_FIELDS
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+def normalize_name(name: str) -> str:
+    return " ".join(tokenize(name))
+
+
+def get_search_fields(field: str = "all") -> Dict[str, float]:
+    """Maps the search type selected in the search bar to the fields to match on
+    and their boosts, as get_search_fields() of the Elasticsearch engine does."""
+    if field == "all":
+        # As genres.name.keyword, the whole keywords must be the genre name
+        return {"title": 10.0, "description": 1.0, "genre_names": 1.0, "people": 1.0}
+    if field == "title":
+        return {"title": 1.0}
+    elif field == "description":
+        return {"description": 1.0}
+    elif field == "genres":
+        return {"genres": 1.0}
+    elif field == "people":
+        return {"people": 1.0}
+    return {}
+
+
+def to_average_rating(num_votes: int, cumulative_rating: float) -> List[float]:
+    return [
+        cumulative_rating / num_votes if num_votes > 0 else 0.0,
+        num_votes,
+        cumulative_rating,
+    ]
+
+
+def to_millis(value: datetime) -> int:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1000)
+
+
+def build_postings(field: str, doc_tokens: List[List[str]]) -> Dict[str, np.ndarray]:
+    """Builds the postings of one field: the sorted `terms`, the `offsets` of the
+    postings of each term in `docs`, and the BM25 `idf` of each term and `impacts`
+    of each posting, whose product is the score of the term for the document."""
+    terms_list: List[bytes] = []
+    docs_list: List[int] = []
+    tfs_list: List[int] = []
+    for doc, tokens in enumerate(doc_tokens):
+        for term, tf in Counter(tokens).items():
+            terms_list.append(term.encode("utf-8"))
+            docs_list.append(doc)
+            tfs_list.append(tf)
+
+    terms, term_ids = np.unique(
+        np.array(terms_list, dtype=np.bytes_), return_inverse=True
+    )
+    term_ids = term_ids.reshape(-1)
+    docs = np.array(docs_list, dtype=np.int32)
+    tfs = np.array(tfs_list, dtype=np.float32)
+    order = np.lexsort((docs, term_ids))
+    docs, tfs = docs[order], tfs[order]
+
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_ids, minlength=len(terms)), out=offsets[1:])
+    document_frequencies = np.diff(offsets)
+    idf = np.log(
+        1
+        + (len(doc_tokens) - document_frequencies + 0.5) / (document_frequencies + 0.5)
+    )
+
+    lengths = np.array([len(tokens) for tokens in doc_tokens], dtype=np.float32)
+    b = 0.0 if field in NAME_FIELDS else B
+    average_length = lengths.mean() if lengths.size and lengths.mean() > 0 else 1.0
+    impacts = tfs * (K1 + 1) / (tfs + K1 * (1 - b + b * lengths[docs] / average_length))
+
+    return {
+        field + ".terms": terms,
+        field + ".offsets": offsets,
+        field + ".docs": docs,
+        field + ".idf": idf.astype(np.float32),
+        field + ".impacts": impacts.astype(np.float32),
+    }
+
+
+class InvertedIndex:
+    """The arrays of an index, memory mapped when loaded from a snapshot.
+
+    Documents are numbered in `movie_ids` order, so the postings of every term list
+    documents in movie_id order as well.
+    """
+
+    arrays: Dict[str, np.ndarray]
+
+    def __init__(self, arrays: Dict[str, np.ndarray]) -> None:
+        self.arrays = arrays
+
+    @property
+    def size(self) -> int:
+        return len(self.arrays["movie_ids"])
+
+    @classmethod
+    def build(
+        cls,
+        movies: List[Dict[str, Any]],
+        positions: List[Dict[str, Any]],
+        genres: List[Dict[str, Any]],
+    ) -> "InvertedIndex":
+        """Builds the index from rows of movies (movie_id, title, description,
+        release_date, image, num_votes, cumulative_rating), their people (movie_id,
+        name, position) and their genres (movie_id, name)."""
+        movies = sorted(movies, key=lambda movie: str(movie["movie_id"]))
+        doc_of = {str(movie["movie_id"]): doc for doc, movie in enumerate(movies)}
+        doc_tokens: Dict[str, List[List[str]]] = {
+            field: [[] for _ in movies] for field in FIELDS
+        }
+        # The name a normalized director name is shown as in the facets
+        director_names: Dict[str, str] = {}
+        for doc, movie in enumerate(movies):
+            doc_tokens["title"][doc] = tokenize(movie["title"])
+            doc_tokens["description"][doc] = tokenize(movie["description"])
+        for position in positions:
+            doc = doc_of.get(str(position["movie_id"]))
+            if doc is not None:
+                doc_tokens["people"][doc].extend(tokenize(position["name"]))
+                if position["position"] == "director":
+                    director = normalize_name(position["name"])
+                    doc_tokens["directors"][doc].append(director)
+                    director_names.setdefault(director, position["name"])
+        for genre in genres:
+            doc = doc_of.get(str(genre["movie_id"]))
+            if doc is not None:
+                doc_tokens["genres"][doc].extend(tokenize(genre["name"]))
+                doc_tokens["genre_names"][doc].append(genre["name"])
+
+        release_dates = np.array(
+            [to_millis(movie["release_date"]) for movie in movies], dtype=np.int64
+        )
+        arrays = {
+            "movie_ids": np.array(
+                [str(movie["movie_id"]).encode("utf-8") for movie in movies],
+                dtype=np.bytes_,
+            ),
+            "titles": np.array(
+                [(movie["title"] or "").encode("utf-8") for movie in movies],
+                dtype=np.bytes_,
+            ),
+            "images": np.array(
+                [(movie["image"] or "").encode("utf-8") for movie in movies],
+                dtype=np.bytes_,
+            ),
+            "release_dates": release_dates,
+            "years": release_dates.astype("datetime64[ms]")
+            .astype("datetime64[Y]")
+            .astype(np.int64)
+            + 1970,
+            "num_votes": np.array(
+                [movie["num_votes"] or 0 for movie in movies], dtype=np.int64
+            ),
+            "cumulative_ratings": np.array(
+                [movie["cumulative_rating"] or 0 for movie in movies], dtype=np.float64
+            ),
+        }
+        for field in FIELDS:
+            arrays.update(build_postings(field, doc_tokens[field]))
+        arrays["directors.names"] = np.array(
+            [
+                director_names[term.decode()].encode("utf-8")
+                for term in arrays["directors.terms"]
+            ],
+            dtype=np.bytes_,
+        )
+        return cls(arrays)
+
+    @classmethod
+    def load(cls, path: Path) -> "InvertedIndex":
+        with open(path / "meta.json") as file:
+            meta = json.load(file)
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError("Unsupported search index snapshot: " + str(path))
+        return cls(
+            {
+                name: np.load(path / (name + ".npy"), mmap_mode="r")
+                for name in meta["arrays"]
+            }
+        )
+
+    def save(self, path: Path) -> None:
+        """Writes the snapshot next to `path` and swaps it in, so that it is never
+        read half written. Processes that mapped the previous snapshot keep reading
+        it until they load the new one."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        staging = path.with_name(path.name + ".new-" + str(os.getpid()))
+        retired = path.with_name(path.name + ".old-" + str(os.getpid()))
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir()
+        for name, array in self.arrays.items():
+            np.save(staging / (name + ".npy"), array)
+        with open(staging / "meta.json", "w") as file:
+            json.dump(
+                {
+                    "version": FORMAT_VERSION,
+                    "documents": self.size,
+                    "arrays": list(self.arrays),
+                    "built": time.time(),
+                },
+                file,
+            )
+        try:
+            if path.exists():
+                os.rename(path, retired)
+            os.rename(staging, path)
+        except OSError:
+            # Another process swapped its snapshot in at the same time
+            shutil.rmtree(staging, ignore_errors=True)
+        shutil.rmtree(retired, ignore_errors=True)
+
+    def lookup(self, movie_ids: List[str]) -> np.ndarray:
+        """Returns the documents of the given movies, -1 for unknown ones."""
+        ids = self.arrays["movie_ids"]
+        keys = np.array([movie_id.encode("utf-8") for movie_id in movie_ids], np.bytes_)
+        docs = np.searchsorted(ids, keys)
+        found = docs < len(ids)
+        found[found] = ids[docs[found]] == keys[found]
+        return np.where(found, docs, -1)
+
+    def find(self, movie_ids: List[str]) -> np.ndarray:
+        """Returns the documents of the given movies, skipping unknown ones."""
+        docs = self.lookup(movie_ids)
+        return docs[docs >= 0]
+
+    def postings(self, field: str, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the documents containing the term and the scores of the term."""
+        terms = self.arrays[field + ".terms"]
+        key = term.encode("utf-8")
+        i = np.searchsorted(terms, key)
+        if i == len(terms) or terms[i] != key:
+            return np.zeros(0, np.int32), np.zeros(0, np.float32)
+        start, end = self.arrays[field + ".offsets"][i : i + 2]
+        return (
+            self.arrays[field + ".docs"][start:end],
+            self.arrays[field + ".idf"][i] * self.arrays[field + ".impacts"][start:end],
+        )
+
+    def score(self, keywords: str, fields: Dict[str, float]) -> np.ndarray:
+        """Returns the score of every document, zero if it does not match."""
+        best = np.zeros(self.size, dtype=np.float32)
+        for field, boost in fields.items():
+            terms = [keywords.strip()] if field in NAME_FIELDS else tokenize(keywords)
+            scores = np.zeros(self.size, dtype=np.float32)
+            for term in terms:
+                docs, term_scores = self.postings(field, term)
+                # A term lists every document once, so this adds once per document
+                scores[docs] += term_scores
+            np.maximum(best, boost * scores, out=best)
+        return best
+
+    def having(self, field: str, names: List[str]) -> np.ndarray:
+        """Returns whether each document has any of the names in a name field."""
+        mask = np.zeros(self.size, dtype=bool)
+        for name in names:
+            mask[self.postings(field, name)[0]] = True
+        return mask
+
+
+class InvertedIndexSearchEngine(SearchEngineBase):
+    initialized: bool = False
+    index: Optional[InvertedIndex]
+    path: Path
+    connection_name: str
+    # The num_votes and cumulative_rating of every document of `_counters_index`,
+    # updated whenever they are read from the database
+    _counters: Optional[Tuple[np.ndarray, np.ndarray]] = None
+    _counters_index: Optional[InvertedIndex] = None
+
+    def __init__(
+        self,
+        index: Optional[InvertedIndex] = None,
+        path: Path = settings.INVERTED_INDEX_PATH,
+        connection_name: str = "default",
+    ) -> None:
+        self.index = index
+        self.path = path
+        self.connection_name = connection_name
+
+    async def initialize_engine(self) -> None:
+        # The engine must be initialized first.
+        if self.index is None:
+            if settings.INVERTED_INDEX_BUILD or not (self.path / "meta.json").exists():
+                (await self.build_index()).save(self.path)
+            self.index = InvertedIndex.load(self.path)
+        self.initialized = True
+
+    async def build_index(self) -> InvertedIndex:
+        conn = Tortoise.get_connection(self.connection_name)
+        movies = await conn.execute_query_dict(
+            "SELECT movie_id, title, description, release_date, image, num_votes, "
+            "cumulative_rating FROM movies WHERE delete_date IS NULL"
+        )
+        positions = await conn.execute_query_dict(
+            "SELECT pos.movie_id, p.name, pos.position FROM positions pos "
+            "JOIN people p ON p.person_id = pos.person_id "
+            "WHERE pos.delete_date IS NULL"
+        )
+        genres = await conn.execute_query_dict(
+            "SELECT mg.movie_id, g.name FROM movie_genres mg "
+            "JOIN genres g ON g.genre_id = mg.genre_id"
+        )
+        return InvertedIndex.build(movies, positions, genres)
+
+    @property
+    def counters(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._counters_index is not self.index:
+            self._counters = (
+                np.array(self.index.arrays["num_votes"], dtype=np.int64),
+                np.array(self.index.arrays["cumulative_ratings"], dtype=np.float64),
+            )
+            self._counters_index = self.index
+        return self._counters
+
+    def movie_ids(self, docs: np.ndarray) -> List[str]:
+        return [self.index.arrays["movie_ids"][doc].decode() for doc in docs]
+
+    async def read_counters(self, movie_ids: List[str]) -> Dict[str, Tuple[int, float]]:
+        """Reads the num_votes and cumulative_rating of the given movies, with the
+        changes that have not been flushed yet, and keeps those of the movies in the
+        index."""
+        if not movie_ids:
+            return {}
+        rows = await Tortoise.get_connection(self.connection_name).execute_query_dict(
+            "SELECT movie_id, num_votes, cumulative_rating FROM movies "
+            "WHERE movie_id = ANY($1::uuid[]) AND delete_date IS NULL",
+            [movie_ids],
+        )
+        pending = await rating_counters.pending(str(row["movie_id"]) for row in rows)
+        read = {}
+        for row in rows:
+            movie_id = str(row["movie_id"])
+            cumulative_rating, num_votes = pending.get(movie_id, (0.0, 0))
+            read[movie_id] = (
+                row["num_votes"] + num_votes,
+                (row["cumulative_rating"] or 0.0) + cumulative_rating,
+            )
+        docs = self.index.lookup(list(read))
+        known = docs >= 0
+        num_votes, cumulative_ratings = self.counters
+        num_votes[docs[known]] = np.array(
+            [counters[0] for counters in read.values()], dtype=np.int64
+        )[known]
+        cumulative_ratings[docs[known]] = np.array(
+            [counters[1] for counters in read.values()], dtype=np.float64
+        )[known]
+        return read
+
+    async def banned_counters(
+        self, list_ban: Optional[List[str]], movie_ids: Optional[List[str]] = None
+    ) -> Dict[str, Tuple[int, float]]:
+        """Returns the num_votes and cumulative_rating the banned users have given
+        to every movie, or to the given movies only."""
+        if not list_ban or movie_ids == []:
+            return {}
+        sql = (
+            "SELECT movie_id, count(*) AS num_votes, sum(rating) AS cumulative_rating "
+            "FROM ratings WHERE user_id = ANY($1::uuid[]) AND delete_date IS NULL "
+            "AND rating IS NOT NULL"
+        )
+        params = [list_ban]
+        if movie_ids is not None:
+            sql += " AND movie_id = ANY($2::uuid[])"
+            params.append(movie_ids)
+        rows = await Tortoise.get_connection(self.connection_name).execute_query_dict(
+            sql + " GROUP BY movie_id", params
+        )
+        return {
+            str(row["movie_id"]): (row["num_votes"], row["cumulative_rating"])
+            for row in rows
+        }
+
+    def rating_arrays(
+        self, banned: Dict[str, Tuple[int, float]]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the num_votes and cumulative_rating of every document, less those
+        given by the banned users."""
+        num_votes, cumulative_ratings = self.counters
+        if not banned:
+            return num_votes, cumulative_ratings
+        docs = self.index.lookup(list(banned))
+        known = docs >= 0
+        num_votes, cumulative_ratings = num_votes.copy(), cumulative_ratings.copy()
+        num_votes[docs[known]] -= np.array(
+            [counters[0] for counters in banned.values()], dtype=np.int64
+        )[known]
+        cumulative_ratings[docs[known]] -= np.array(
+            [counters[1] for counters in banned.values()], dtype=np.float64
+        )[known]
+        return num_votes, cumulative_ratings
+
+    def to_hit(
+        self,
+        doc: int,
+        scores: np.ndarray,
+        num_votes: np.ndarray,
+        cumulative_ratings: np.ndarray,
+        sort: Optional[List[Any]] = None,
+    ) -> SearchHit:
+        return SearchHit(
+            self.index.arrays["movie_ids"][doc].decode(),
+            float(scores[doc]),
+            to_average_rating(int(num_votes[doc]), float(cumulative_ratings[doc])),
+            sort,
+        )
+
+    def match(
+        self, keywords: Optional[str], field: str
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the scores of the documents and which of them match, numbers in
+        the keywords also have to match as release years."""
+        if not keywords:
+            return (
+                np.zeros(self.index.size, dtype=np.float32),
+                np.ones(self.index.size, dtype=bool),
+            )
+        scores = self.index.score(keywords, get_search_fields(field))
+        matched = scores > 0
+        years_in_keywords = [int(year) for year in re.findall(r"(\d{4})", keywords)]
+        if years_in_keywords:
+            matched &= np.isin(self.index.arrays["years"], years_in_keywords)
+        return scores, matched
+
+    async def search(
+        self,
+        keywords: Optional[str] = None,
+        field: str = "all",
+        movies: Optional[List[str]] = None,
+        list_ban: Optional[List[str]] = None,
+        size: int = 10,
+    ) -> List[SearchHit]:
+        if keywords is not None and not keywords.strip():
+            return []
+        scores, matched = self.match(keywords, field)
+        if movies is not None:
+            in_movies = np.zeros(self.index.size, dtype=bool)
+            in_movies[self.index.find(movies)] = True
+            matched &= in_movies
+        docs = np.flatnonzero(matched)
+        docs = docs[np.lexsort((docs, -scores[docs]))][:size]
+        movie_ids = self.movie_ids(docs)
+        await self.read_counters(movie_ids)
+        banned = await self.banned_counters(list_ban, movie_ids)
+        num_votes, cumulative_ratings = self.rating_arrays(banned)
+        return [self.to_hit(doc, scores, num_votes, cumulative_ratings) for doc in docs]
+
+    async def search_page(
+        self,
+        keywords: Optional[str] = None,
+        genres: Optional[List[str]] = None,
+        years: Optional[List[str]] = None,
+        directors: Optional[List[str]] = None,
+        per_page: int = 1,
+        sort: str = ("relevance", "rating", "name", "year")[0],
+        desc: bool = True,
+        field: str = "all",
+        after: Optional[List[Any]] = None,
+        list_ban: Optional[List[str]] = None,
+        facets: bool = False,
+    ) -> SearchPage:
+        """Walks pages with a keyset condition on the sort value plus `movie_id` as
+        a stable tiebreaker, like the other engines."""
+        scores, matched = self.match(keywords, field)
+        if genres:
+            matched &= self.index.having("genre_names", genres)
+        if years:
+            matched &= np.isin(self.index.arrays["years"], [int(y) for y in years])
+        if directors:
+            matched &= self.index.having(
+                "directors", [normalize_name(director) for director in directors]
+            )
+        docs = np.flatnonzero(matched)
+        banned = await self.banned_counters(list_ban)
+        if sort == "rating":
+            # The ratings of the banned users are taken off current counters
+            await self.read_counters(list(banned))
+
+        def average_ratings() -> np.ndarray:
+            num_votes, cumulative_ratings = self.rating_arrays(banned)
+            return np.where(
+                num_votes > 0, cumulative_ratings / np.maximum(num_votes, 1), 0.0
+            )
+
+        values = {
+            "relevance": lambda: scores.astype(np.float64),
+            "rating": average_ratings,
+            "name": lambda: self.index.arrays["titles"],
+            "year": lambda: self.index.arrays["release_dates"],
+        }[sort]()[docs]
+        ids = self.index.arrays["movie_ids"][docs]
+
+        page = np.ones(len(docs), dtype=bool)
+        if after is not None:
+            value = after[0].encode("utf-8") if sort == "name" else after[0]
+            movie_id = after[1].encode("utf-8")
+            beyond = values < value if desc else values > value
+            page = beyond | ((values == value) & (ids > movie_id))
+        _, ranks = np.unique(values[page], return_inverse=True)
+        ranks = ranks.reshape(-1)
+        order = np.lexsort((docs[page], -ranks if desc else ranks))[:per_page]
+
+        await self.read_counters(self.movie_ids(docs[page][order]))
+        num_votes, cumulative_ratings = self.rating_arrays(banned)
+        hits = [
+            self.to_hit(
+                doc,
+                scores,
+                num_votes,
+                cumulative_ratings,
+                [value.decode() if sort == "name" else value.item(), movie_id.decode()],
+            )
+            for doc, value, movie_id in zip(
+                docs[page][order], values[page][order], ids[page][order]
+            )
+        ]
+
+        genre_facets = year_facets = director_facets = None
+        if facets:
+            genre_facets = self.facets(
+                matched, "genre_names", self.index.arrays["genre_names.terms"]
+            )
+            director_facets = self.facets(
+                matched, "directors", self.index.arrays["directors.names"]
+            )
+            matched_years, year_counts = np.unique(
+                self.index.arrays["years"][docs], return_counts=True
+            )
+            year_facets = [
+                (str(year), int(count))
+                for year, count in zip(matched_years, year_counts)
+            ]
+
+        return SearchPage(
+            hits=hits,
+            total=len(docs),
+            genres=genre_facets,
+            years=year_facets,
+            after=hits[-1].sort if len(hits) == per_page else None,
+            directors=director_facets,
+        )
+
+    def facets(
+        self, matched: np.ndarray, field: str, names: np.ndarray
+    ) -> List[Tuple[str, int]]:
+        """Counts the matched documents of each term of a name field, shown as
+        `names`, most common first."""
+        offsets = self.index.arrays[field + ".offsets"]
+        postings = self.index.arrays[field + ".docs"]
+        counts = [
+            (name.decode(), int(matched[postings[start:end]].sum()))
+            for name, start, end in zip(names, offsets[:-1], offsets[1:])
+        ]
+        return sorted(
+            [(name, count) for name, count in counts if count > 0],
+            key=lambda facet: (-facet[1], facet[0]),
+        )[:100]
+
+    async def ratings(
+        self, movies: List[str], list_ban: Optional[List[str]] = None
+    ) -> Dict[str, List[float]]:
+        read = await self.read_counters(movies)
+        banned = await self.banned_counters(list_ban, list(read))
+        ratings = {}
+        for movie_id, (num_votes, cumulative_rating) in read.items():
+            banned_votes, banned_rating = banned.get(movie_id, (0, 0.0))
+            ratings[movie_id] = to_average_rating(
+                num_votes - banned_votes, cumulative_rating - banned_rating
+            )
+        return ratings
+
+    async def suggest(
+        self, keyword: str, limit: int = 8, field: str = "all"
+    ) -> List[Dict[str, Any]]:
+        if not keyword.strip():
+            return []
+        scores = self.index.score(keyword, get_search_fields(field))
+        docs = np.flatnonzero(scores > 0)
+        docs = docs[np.lexsort((docs, -scores[docs]))][:limit]
+        arrays = self.index.arrays
+        return [
+            {
+                "movie_id": arrays["movie_ids"][doc].decode(),
+                "title": arrays["titles"][doc].decode(),
+                "release_date": datetime.fromtimestamp(
+                    arrays["release_dates"][doc] / 1000, timezone.utc
+                ).isoformat(),
+                "image": arrays["images"][doc].decode() or None,
+            }
+            for doc in docs
+        ]
+
+    async def terminate_engine(self) -> None:
+        # The engine must be terminated correctly in the end.
+        self.initialized = False
+
+
+__all__ = ["InvertedIndex", "InvertedIndexSearchEngine"]
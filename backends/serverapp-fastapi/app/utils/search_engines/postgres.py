@@ -0,0 +1,394 @@
+import re
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from tortoise import Tortoise
+
+from . import SearchEngineBase, SearchHit, SearchPage
+
+"""
+The Postgres search engine, a full-text search on the movie tables themselves for
+deployments without Elasticsearch. It needs the `search_vector` columns and the GIN
+indexes created by `poetry run setup` (see scripts/setup.py).
+
+Keywords are matched the way the Elasticsearch `multi_match` query does: any word
+may match, every field is scored on its own and a movie scores as its best field,
+with titles boosted ten times. Lexemes are matched with `tsvector`s, trigrams
+(pg_trgm) also catch typos and partially typed words in titles and names but rank
+below lexeme matches. Character names are not searched.
+"""
+
+# The weights of the (D, C, B, A) labels of movies.search_vector, in which the
+# title is labelled A and the description B
+TITLE_WEIGHTS = "'{0, 0, 0, 1}'"
+DESCRIPTION_WEIGHTS = "'{0, 0, 1, 0}'"
+TRIGRAM_WEIGHT = 0.05
+
+
+class QueryParameters:
+    """Collects the values of a query as asyncpg `$n` placeholders."""
+
+    values: List[Any]
+
+    def __init__(self) -> None:
+        self.values = []
+
+    def add(self, value: Any, cast: str = "") -> str:
+        self.values.append(value)
+        return "$" + str(len(self.values)) + ("::" + cast if cast else "")
+
+
+def match_arms(field: str) -> List[str]:
+    """Returns the SELECT statements yielding (movie_id, score) for each field the
+    search type selected in the search bar matches on. They read the `words` and
+    `names` tsqueries and the `keywords` text from the `q` CTE."""
+    title = [
+        "SELECT m.movie_id, 10 * ts_rank({}, m.search_vector, q.words) AS score "
+        "FROM movies m, q WHERE m.search_vector @@ q.words "
+        "AND ts_rank({}, m.search_vector, q.words) > 0".format(
+            TITLE_WEIGHTS, TITLE_WEIGHTS
+        ),
+        "SELECT m.movie_id, {} * word_similarity(q.keywords, m.title) "
+        "FROM movies m, q WHERE q.keywords <% m.title".format(10 * TRIGRAM_WEIGHT),
+    ]
+    description = [
+        "SELECT m.movie_id, ts_rank({}, m.search_vector, q.words) "
+        "FROM movies m, q WHERE m.search_vector @@ q.words "
+        "AND ts_rank({}, m.search_vector, q.words) > 0".format(
+            DESCRIPTION_WEIGHTS, DESCRIPTION_WEIGHTS
+        )
+    ]
+    people = [
+        "SELECT pos.movie_id, ts_rank(p.search_vector, q.names) "
+        "FROM people p JOIN positions pos ON pos.person_id = p.person_id, q "
+        "WHERE p.search_vector @@ q.names AND pos.delete_date IS NULL",
+        "SELECT pos.movie_id, {} * word_similarity(q.keywords, p.name) "
+        "FROM people p JOIN positions pos ON pos.person_id = p.person_id, q "
+        "WHERE q.keywords <% p.name AND pos.delete_date IS NULL".format(TRIGRAM_WEIGHT),
+    ]
+    if field == "all":
+        return (
+            title
+            + description
+            + people
+            + [
+                # As genres.name.keyword, the whole keywords must be the genre name
+                "SELECT mg.movie_id, 0.1 FROM movie_genres mg "
+                "JOIN genres g ON g.genre_id = mg.genre_id, q "
+                "WHERE lower(g.name) = lower(q.keywords)"
+            ]
+        )
+    if field == "title":
+        return title
+    elif field == "description":
+        return description
+    elif field == "genres":
+        return [
+            "SELECT mg.movie_id, ts_rank(to_tsvector('english', g.name), q.words) "
+            "FROM movie_genres mg JOIN genres g ON g.genre_id = mg.genre_id, q "
+            "WHERE to_tsvector('english', g.name) @@ q.words"
+        ]
+    elif field == "people":
+        return people
+    return []
+
+
+def keywords_cte(params: QueryParameters, keywords: str) -> str:
+    # plainto_tsquery() ANDs the words, OR them instead to match like multi_match
+    keywords_param = params.add(keywords, "text")
+    return (
+        "q AS (SELECT {keywords} AS keywords, "
+        "replace(plainto_tsquery('english', {keywords})::text, '&', '|')::tsquery "
+        "AS words, "
+        "replace(plainto_tsquery('simple', {keywords})::text, '&', '|')::tsquery "
+        "AS names)".format(keywords=keywords_param)
+    )
+
+
+def banned_ratings_cte(params: QueryParameters, list_ban: List[str]) -> str:
+    return (
+        "banned AS (SELECT movie_id, count(*) AS num_votes, "
+        "sum(rating) AS cumulative_rating FROM ratings "
+        "WHERE user_id = ANY({}) AND delete_date IS NULL AND rating IS NOT NULL "
+        "GROUP BY movie_id)".format(params.add(list_ban, "uuid[]"))
+    )
+
+
+def rating_columns(list_ban: List[str]) -> str:
+    """The banlist adjusted num_votes and cumulative_rating of movies `m`, which
+    must be joined with the `banned` CTE when there is a banlist."""
+    if not list_ban:
+        return "m.num_votes, m.cumulative_rating"
+    return (
+        "m.num_votes - coalesce(b.num_votes, 0) AS num_votes, "
+        "m.cumulative_rating - coalesce(b.cumulative_rating, 0) AS cumulative_rating"
+    )
+
+
+def to_average_rating(row: Dict[str, Any]) -> List[float]:
+    num_votes = row["num_votes"]
+    cumulative_rating = row["cumulative_rating"]
+    return [
+        cumulative_rating / num_votes if num_votes > 0 else 0.0,
+        num_votes,
+        cumulative_rating,
+    ]
+
+
+class PostgresSearchEngine(SearchEngineBase):
+    initialized: bool = False
+    connection_name: str
+
+    def __init__(self, connection_name: str = "default") -> None:
+        self.connection_name = connection_name
+
+    async def query(self, sql: str, params: QueryParameters) -> List[Dict[str, Any]]:
+        return await Tortoise.get_connection(self.connection_name).execute_query_dict(
+            sql, params.values
+        )
+
+    def build_matches(
+        self,
+        params: QueryParameters,
+        keywords: Optional[str],
+        field: str,
+        movies: Optional[List[str]],
+        list_ban: List[str],
+        filters: Optional[List[str]] = None,
+    ) -> str:
+        """Builds the CTEs up to `matched`, the matching movies `m` with their
+        `score` and banlist adjusted ratings."""
+        ctes = []
+        conditions = ["m.delete_date IS NULL"] + (filters or [])
+        source = "movies m"
+        if keywords:
+            ctes.append(keywords_cte(params, keywords))
+            ctes.append(
+                "matches AS (SELECT movie_id, max(score) AS score FROM ({}) arms "
+                "GROUP BY movie_id)".format(" UNION ALL ".join(match_arms(field)))
+            )
+            source = "matches s JOIN movies m ON m.movie_id = s.movie_id"
+            years_in_keywords = re.findall(r"(\d{4})", keywords)
+            if years_in_keywords:
+                conditions.append(
+                    "extract(year FROM m.release_date)::int = ANY({})".format(
+                        params.add([int(year) for year in years_in_keywords], "int[]")
+                    )
+                )
+        if movies is not None:
+            conditions.append(
+                "m.movie_id = ANY({})".format(params.add(movies, "uuid[]"))
+            )
+        if list_ban:
+            ctes.append(banned_ratings_cte(params, list_ban))
+            source += " LEFT JOIN banned b ON b.movie_id = m.movie_id"
+        ctes.append(
+            "matched AS (SELECT m.movie_id, m.title, m.release_date, {score} AS score, "
+            "{ratings} FROM {source} WHERE {conditions})".format(
+                score="s.score" if keywords else "0.0::float8",
+                ratings=rating_columns(list_ban),
+                source=source,
+                conditions=" AND ".join(conditions),
+            )
+        )
+        return "WITH " + ", ".join(ctes)
+
+    async def search(
+        self,
+        keywords: Optional[str] = None,
+        field: str = "all",
+        movies: Optional[List[str]] = None,
+        list_ban: Optional[List[str]] = None,
+        size: int = 10,
+    ) -> List[SearchHit]:
+        if keywords is not None and not keywords.strip():
+            return []
+        params = QueryParameters()
+        sql = self.build_matches(
+            params, keywords, field, movies, list_ban or []
+        ) + " SELECT * FROM matched ORDER BY score DESC, movie_id LIMIT {}".format(
+            params.add(size, "int")
+        )
+        return [
+            SearchHit(str(row["movie_id"]), row["score"], to_average_rating(row))
+            for row in await self.query(sql, params)
+        ]
+
+    async def search_page(
+        self,
+        keywords: Optional[str] = None,
+        genres: Optional[List[str]] = None,
+        years: Optional[List[str]] = None,
+        directors: Optional[List[str]] = None,
+        per_page: int = 1,
+        sort: str = ("relevance", "rating", "name", "year")[0],
+        desc: bool = True,
+        field: str = "all",
+        after: Optional[List[Any]] = None,
+        list_ban: Optional[List[str]] = None,
+        facets: bool = False,
+    ) -> SearchPage:
+        """Walks pages with a keyset condition on the sort value plus `movie_id` as
+        a stable tiebreaker, so every page reads only `per_page` rows past the
+        filters no matter how deep it is."""
+        params = QueryParameters()
+        filters = []
+        if genres:
+            filters.append(
+                "EXISTS (SELECT 1 FROM movie_genres mg "
+                "JOIN genres g ON g.genre_id = mg.genre_id "
+                "WHERE mg.movie_id = m.movie_id AND g.name = ANY({}))".format(
+                    params.add(genres, "text[]")
+                )
+            )
+        if years:
+            filters.append(
+                "extract(year FROM m.release_date)::int = ANY({})".format(
+                    params.add([int(year) for year in years], "int[]")
+                )
+            )
+        if directors:
+            filters.append(
+                "EXISTS (SELECT 1 FROM positions pos "
+                "JOIN people p ON p.person_id = pos.person_id "
+                "WHERE pos.movie_id = m.movie_id AND pos.position = 'director' "
+                "AND pos.delete_date IS NULL AND p.name = ANY({}))".format(
+                    params.add(directors, "text[]")
+                )
+            )
+        sql = self.build_matches(params, keywords, field, None, list_ban or [], filters)
+
+        sort_column, cast = {
+            "relevance": ("score", "float8"),
+            "rating": (
+                "CASE WHEN num_votes > 0 "
+                "THEN cumulative_rating / num_votes ELSE 0 END",
+                "float8",
+            ),
+            "name": ("title", "text"),
+            "year": ("release_date", "timestamptz"),
+        }[sort]
+        keyset = "TRUE"
+        if after is not None:
+            value = after[0]
+            if cast == "timestamptz":
+                value = datetime.fromisoformat(value)
+            value = params.add(value, cast)
+            movie_id = params.add(after[1], "uuid")
+            keyset = (
+                "(sort_value {op} {value} "
+                "OR (sort_value = {value} AND movie_id > {id}))".format(
+                    op="<" if desc else ">", value=value, id=movie_id
+                )
+            )
+        page_sql = (
+            sql + ", sorted AS (SELECT *, {} AS sort_value FROM matched) "
+            "SELECT *, (SELECT count(*) FROM matched) AS total FROM sorted "
+            "WHERE {} ORDER BY sort_value {}, movie_id LIMIT {}".format(
+                sort_column,
+                keyset,
+                "DESC" if desc else "ASC",
+                params.add(per_page, "int"),
+            )
+        )
+        rows = await self.query(page_sql, params)
+        if rows:
+            total = rows[0]["total"]
+        else:
+            total = (
+                await self.query(sql + " SELECT count(*) AS total FROM matched", params)
+            )[0]["total"]
+
+        hits = [
+            SearchHit(
+                str(row["movie_id"]),
+                row["score"],
+                to_average_rating(row),
+                [
+                    row["sort_value"].isoformat()
+                    if isinstance(row["sort_value"], datetime)
+                    else row["sort_value"],
+                    str(row["movie_id"]),
+                ],
+            )
+            for row in rows
+        ]
+
+        genre_facets = year_facets = director_facets = None
+        if facets:
+            genre_facets = [
+                (row["name"], row["count"])
+                for row in await self.query(
+                    sql + " SELECT g.name, count(*) AS count FROM matched "
+                    "JOIN movie_genres mg ON mg.movie_id = matched.movie_id "
+                    "JOIN genres g ON g.genre_id = mg.genre_id "
+                    "GROUP BY g.name ORDER BY count DESC, g.name LIMIT 100",
+                    params,
+                )
+            ]
+            year_facets = [
+                (str(row["year"]), row["count"])
+                for row in await self.query(
+                    sql + " SELECT extract(year FROM release_date)::int AS year, "
+                    "count(*) AS count FROM matched GROUP BY year ORDER BY year",
+                    params,
+                )
+            ]
+            director_facets = [
+                (row["name"], row["count"])
+                for row in await self.query(
+                    sql + " SELECT p.name, count(DISTINCT matched.movie_id) AS count "
+                    "FROM matched JOIN positions pos "
+                    "ON pos.movie_id = matched.movie_id "
+                    "JOIN people p ON p.person_id = pos.person_id "
+                    "WHERE pos.position = 'director' AND pos.delete_date IS NULL "
+                    "GROUP BY p.name ORDER BY count DESC, p.name LIMIT 100",
+                    params,
+                )
+            ]
+
+        return SearchPage(
+            hits=hits,
+            total=total,
+            genres=genre_facets,
+            years=year_facets,
+            after=hits[-1].sort if len(hits) == per_page else None,
+            directors=director_facets,
+        )
+
+    async def ratings(
+        self, movies: List[str], list_ban: Optional[List[str]] = None
+    ) -> Dict[str, List[float]]:
+        if not movies:
+            return {}
+        params = QueryParameters()
+        sql = self.build_matches(params, None, "all", movies, list_ban or [])
+        return {
+            str(row["movie_id"]): to_average_rating(row)
+            for row in await self.query(sql + " SELECT * FROM matched", params)
+        }
+
+    async def suggest(
+        self, keyword: str, limit: int = 8, field: str = "all"
+    ) -> List[Dict[str, Any]]:
+        if not keyword.strip():
+            return []
+        params = QueryParameters()
+        sql = (
+            self.build_matches(params, keyword, field, None, [])
+            + " SELECT matched.movie_id, matched.title, matched.release_date, "
+            "m.image FROM matched JOIN movies m ON m.movie_id = matched.movie_id "
+            "ORDER BY score DESC, movie_id LIMIT {}".format(params.add(limit, "int"))
+        )
+        return [
+            {
+                "movie_id": str(row["movie_id"]),
+                "title": row["title"],
+                "release_date": row["release_date"].isoformat(),
+                "image": row["image"],
+            }
+            for row in await self.query(sql, params)
+        ]
+
+
+__all__ = ["PostgresSearchEngine"]
@@ -0,0 +1,28 @@
+import importlib
+import sys
+
+"""
+Benchmarks for the server app.
+
+Every submodule registered below exposes a `main(argv)` function and can be run with
+`poetry run benchmark <name> [options]`. Most of them talk to the services configured
+in `.env` (except `search` and `dict_storage_shards`, which run fully in process),
+see the docstring of each module for what it needs.
+"""
+
+BENCHMARKS = {
+    "dict_storage_shards": "benchmarks.dict_storage_shards",
+    "hydration": "benchmarks.hydration",
+    "rating_writes": "benchmarks.rating_writes",
+    "search": "benchmarks.search",
+    "search_engines": "benchmarks.search_engines",
+    "session_middleware": "benchmarks.session_middleware",
+}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("Usage: benchmark <name> [options]", file=sys.stderr)
+        print("Available benchmarks: " + ", ".join(sorted(BENCHMARKS)), file=sys.stderr)
+        sys.exit(1)
+    importlib.import_module(BENCHMARKS[sys.argv[1]]).main(sys.argv[2:])
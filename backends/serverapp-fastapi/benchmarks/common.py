@@ -0,0 +1,78 @@
+import asyncio
+import math
+import time
+from typing import Awaitable, Callable, Dict, List
+
+"""
+Timing and reporting helpers shared by the benchmarks.
+"""
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """Nearest-rank percentile of the samples."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Summarizes latency samples (in seconds) as milliseconds."""
+    return {
+        "n": len(samples),
+        "mean": sum(samples) / len(samples) * 1000 if samples else 0.0,
+        "p50": percentile(samples, 50) * 1000,
+        "p95": percentile(samples, 95) * 1000,
+        "p99": percentile(samples, 99) * 1000,
+    }
+
+
+def time_sync(fn: Callable[[], object], repeat: int, warmup: int = 3) -> List[float]:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def time_async(
+    fn: Callable[[], Awaitable[object]], repeat: int, warmup: int = 3
+) -> List[float]:
+    for _ in range(warmup):
+        await fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def print_report(title: str, rows: Dict[str, Dict[str, float]]) -> None:
+    columns = []
+    for row in rows.values():
+        columns += [column for column in row if column not in columns]
+    width = max([len(name) for name in rows] + [len(title)])
+    print()
+    print(title.ljust(width) + "".join(column.rjust(12) for column in columns))
+    for name, row in rows.items():
+        print(
+            name.ljust(width)
+            + "".join(
+                (
+                    "{:.3f}".format(row[column])
+                    if isinstance(row.get(column), float)
+                    else str(row.get(column, "-"))
+                ).rjust(12)
+                for column in columns
+            )
+        )
+
+
+def run(coroutine: Awaitable[object]) -> object:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop.run_until_complete(coroutine)
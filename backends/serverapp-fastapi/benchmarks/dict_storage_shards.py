@@ -0,0 +1,71 @@
+import argparse
+import statistics
+from typing import Dict, List
+
+from app.utils.dict_storage.memory import MemoryDictStorageDriver
+from app.utils.dict_storage.sharded import ShardedDictStorageDriver
+
+from .common import print_report, run, summarize, time_async
+
+"""
+Measures how evenly the sharded dict storage spreads keys and how many of them move
+when a shard is removed, for a number of virtual nodes per shard, with in-memory
+shards standing in for the Redis ones. Ideally a removal only moves the keys of the
+removed shard, 1 / shards of them. It also times a get through the ring next to a
+get on a single in-memory storage. Runs fully in process.
+
+    poetry run benchmark dict_storage_shards --shards 4 --vnodes 10 40 160
+"""
+
+
+def make_sharded(shards: int, vnodes: int) -> ShardedDictStorageDriver:
+    return ShardedDictStorageDriver(
+        shards={
+            "redis-{}:6379/0".format(i): MemoryDictStorageDriver(ttl=1800)
+            for i in range(shards)
+        },
+        vnodes=vnodes,
+    )
+
+
+async def benchmark(shards: int, vnodes_list: List[int], keys: int, gets: int) -> None:
+    names = ["K{:08d}".format(i) for i in range(keys)]
+    rows: Dict[str, Dict[str, float]] = {}
+    for vnodes in vnodes_list:
+        driver = make_sharded(shards, vnodes)
+        await driver.initialize_driver()
+        for key in names:
+            await driver.update(key, {"user_id": key})
+        counts = list(driver.operations.values())
+        owners = {key: driver.shard_for(key) for key in names}
+        await driver.remove_shard(next(iter(driver.shards)))
+        moved = sum(owners[key] != driver.shard_for(key) for key in names)
+        samples = await time_async(lambda: driver.get(names[0]), gets)
+        rows["{} vnodes".format(vnodes)] = {
+            "min keys": min(counts),
+            "max keys": max(counts),
+            "stdev %": statistics.pstdev(counts) / (keys / shards) * 100,
+            "moved %": moved / keys * 100,
+            "get ms": summarize(samples)["mean"],
+        }
+        await driver.terminate_driver()
+
+    single = MemoryDictStorageDriver(ttl=1800)
+    await single.update(names[0], {"user_id": names[0]})
+    samples = await time_async(lambda: single.get(names[0]), gets)
+    rows["unsharded"] = {"get ms": summarize(samples)["mean"]}
+
+    print_report(
+        "{} keys on {} shards, ideal move {:.1f}%".format(keys, shards, 100 / shards),
+        rows,
+    )
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="benchmark dict_storage_shards")
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--vnodes", type=int, nargs="+", default=[10, 40, 160])
+    parser.add_argument("--keys", type=int, default=50000)
+    parser.add_argument("--gets", type=int, default=10000)
+    args = parser.parse_args(argv)
+    run(benchmark(args.shards, args.vnodes, args.keys, args.gets))
@@ -0,0 +1,57 @@
+import argparse
+from typing import List
+
+from elasticsearch_dsl import Search
+
+from app.utils.search_engines.elasticsearch import ElasticsearchSearchEngine
+
+from .common import print_report, run, summarize, time_sync
+
+"""
+Compares the scoring `bool.should` query formerly used to look up recommended movies
+with the `terms` filter used by the Elasticsearch search engine to hydrate
+recommendations. Needs the Elasticsearch cluster configured in `.env`.
+
+    poetry run benchmark hydration --sizes 20 50 --repeat 200
+"""
+
+
+async def benchmark(sizes: List[int], repeat: int) -> None:
+    engine = ElasticsearchSearchEngine()
+    await engine.initialize_engine()
+    sample = [
+        hit.movie_id
+        for hit in Search(using=engine.client, index=engine.index)
+        .source(["movie_id"])
+        .extra(size=max(sizes))
+        .execute()
+    ]
+
+    rows = {}
+    for size in sizes:
+        ids = sample[:size]
+        queries = {
+            "bool.should match": engine.build_movie_search(movies=ids),
+            "terms filter": engine.build_hydration_search(ids),
+        }
+        for name, search in queries.items():
+            took = []
+
+            def execute():
+                took.append(search.execute(ignore_cache=True).took)
+
+            row = summarize(time_sync(execute, repeat))
+            # Averaged over the timed runs only, the warmup runs come first
+            timed = took[-repeat:]
+            row["es took"] = sum(timed) / len(timed)
+            rows["{} x{}".format(name, len(ids))] = row
+
+    print_report("query (ms)", rows)
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="benchmark hydration")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 50])
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args(argv)
+    run(benchmark(args.sizes, args.repeat))
@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import tortoise
+from tortoise.transactions import in_transaction
+
+from app.api.v1.routers.movie import update_cumulative_rating, upsert_rating
+from app.core.config import settings
+from app.core.rating_counters import rating_counters
+from app.core.redis import close_redis
+from app.models.db.movies import Movies
+from app.models.db.ratings import Ratings
+from app.models.db.reviews import Reviews
+
+from .common import print_report, run, summarize
+
+"""
+Measures the throughput of rating writes, comparing the ORM path `rate_movie` used
+to take (seven queries and a read-modify-write of the movie's counters) with the
+locked read and single upsert statement of `upsert_rating`, with the counters
+updated in the statement and written behind through Redis.
+
+Writers rate random movies as temporary users, which are deleted afterwards along
+with their ratings, and the counters of the rated movies are recounted. Run it
+against a development database with the app stopped, with Redis configured in
+`.env` for the write-behind path.
+
+Before it is timed, every path is checked to count a first rating, a re-rating
+and a rating after a delete once each, and to leave soft-deleted movies alone. The
+benchmark fails if one does not.
+
+    poetry run benchmark rating_writes --writers 16 --writes 200
+    poetry run benchmark rating_writes --movies 1  # every writer rates one movie
+"""
+
+
+async def orm_rating(user_id: str, movie_id: str, rating: float) -> None:
+    """The rating write of rate_movie before it was made a single statement."""
+    async with in_transaction():
+        existing_rating = await Ratings.get_or_none(user_id=user_id, movie_id=movie_id)
+        if existing_rating:
+            old_rating = existing_rating.rating
+            if existing_rating.delete_date:
+                existing_rating.delete_date = None
+                existing_rating.rating = rating
+                old_rating = None
+            else:
+                existing_rating.rating = rating
+            await existing_rating.save(update_fields=["rating", "delete_date"])
+        else:
+            old_rating = None
+            await Ratings.create(user_id=user_id, movie_id=movie_id, rating=rating)
+        async with in_transaction():
+            movie = await Movies.get_or_none(movie_id=movie_id, delete_date=None)
+            if movie:
+                if old_rating:
+                    movie.cumulative_rating += rating - old_rating
+                else:
+                    movie.num_votes += 1
+                    movie.cumulative_rating += rating
+                await movie.save(update_fields=["cumulative_rating", "num_votes"])
+        current_rating = await Ratings.get(user_id=user_id, movie_id=movie_id)
+        async with in_transaction():
+            review = await Reviews.get_or_none(
+                user_id=user_id, movie_id=movie_id, delete_date=None
+            )
+            if review:
+                review.rating = current_rating
+                await review.save(update_fields=["rating_id"])
+
+
+async def upsert(user_id: str, movie_id: str, rating: float) -> None:
+    settings.RATING_COUNTERS_WRITE_BEHIND = False
+    await upsert_rating(user_id, movie_id, rating)
+
+
+async def upsert_write_behind(user_id: str, movie_id: str, rating: float) -> None:
+    settings.RATING_COUNTERS_WRITE_BEHIND = True
+    await upsert_rating(user_id, movie_id, rating)
+
+
+async def create_users(count: int) -> List[str]:
+    conn = tortoise.Tortoise.get_connection("default")
+    user_ids = [str(uuid.uuid4()) for _ in range(count)]
+    for user_id in user_ids:
+        await conn.execute_query(
+            "INSERT INTO users (user_id, username, password_hash, role, "
+            "last_login_date, create_date) VALUES ($1, $2, '', 'user', now(), now())",
+            [user_id, "benchmark-" + user_id[:8]],
+        )
+    return user_ids
+
+
+async def clean_up(user_ids: List[str], movie_ids: List[str]) -> None:
+    conn = tortoise.Tortoise.get_connection("default")
+    await conn.execute_query(
+        "DELETE FROM ratings WHERE user_id = ANY($1::uuid[])", [user_ids]
+    )
+    await conn.execute_query(
+        "DELETE FROM users WHERE user_id = ANY($1::uuid[])", [user_ids]
+    )
+    await conn.execute_query(
+        "UPDATE movies m SET num_votes = r.num_votes, "
+        "cumulative_rating = r.cumulative_rating FROM (SELECT m2.movie_id, "
+        "count(r2.rating) AS num_votes, coalesce(sum(r2.rating), 0) "
+        "AS cumulative_rating FROM movies m2 LEFT JOIN ratings r2 "
+        "ON r2.movie_id = m2.movie_id AND r2.delete_date IS NULL "
+        "WHERE m2.movie_id = ANY($1::uuid[]) GROUP BY m2.movie_id) r "
+        "WHERE m.movie_id = r.movie_id",
+        [movie_ids],
+    )
+
+
+async def delete_rating(user_id: str, movie_id: str) -> None:
+    """The rating delete of delete_rating."""
+    rows = await tortoise.Tortoise.get_connection("default").execute_query_dict(
+        "UPDATE ratings SET delete_date = now() WHERE user_id = $1 "
+        "AND movie_id = $2 AND delete_date IS NULL RETURNING rating",
+        [user_id, movie_id],
+    )
+    if rows:
+        await update_cumulative_rating(movie_id, None, rows[0]["rating"])
+
+
+async def read_counters(movie_id: str) -> Tuple[float, int]:
+    if rating_counters.enabled:
+        await rating_counters.flush()
+    row = (
+        await tortoise.Tortoise.get_connection("default").execute_query_dict(
+            "SELECT cumulative_rating, num_votes FROM movies WHERE movie_id = $1",
+            [movie_id],
+        )
+    )[0]
+    return row["cumulative_rating"], row["num_votes"]
+
+
+# (step, rating or None to delete it, change of cumulative_rating, of num_votes)
+COUNTING_STEPS = [
+    ("first rating", 4.0, 4.0, 1),
+    ("re-rating", 2.5, 2.5, 1),
+    ("delete", None, 0.0, 0),
+    ("rating after delete", 3.0, 3.0, 1),
+]
+
+
+async def check_counting(
+    write: Callable[[str, str, float], Awaitable[None]],
+    movie_id: str,
+    deleted_movie_id: Optional[str],
+) -> List[str]:
+    """Rates a movie as a temporary user step by step, and a soft-deleted movie if
+    there is one. Returns the steps after which the counters were off."""
+    (user_id,) = await create_users(1)
+    errors = []
+    try:
+        cumulative_rating, num_votes = await read_counters(movie_id)
+        for step, rating, rating_change, votes_change in COUNTING_STEPS:
+            if rating is None:
+                await delete_rating(user_id, movie_id)
+            else:
+                await write(user_id, movie_id, rating)
+            counters = await read_counters(movie_id)
+            expected = (cumulative_rating + rating_change, num_votes + votes_change)
+            if abs(counters[0] - expected[0]) > 1e-6 or counters[1] != expected[1]:
+                errors.append("{}: {} instead of {}".format(step, counters, expected))
+        if deleted_movie_id:
+            before = await read_counters(deleted_movie_id)
+            await write(user_id, deleted_movie_id, 4.0)
+            counters = await read_counters(deleted_movie_id)
+            if counters != before:
+                errors.append(
+                    "deleted movie: {} instead of {}".format(counters, before)
+                )
+                await tortoise.Tortoise.get_connection("default").execute_query(
+                    "UPDATE movies SET cumulative_rating = $1, num_votes = $2 "
+                    "WHERE movie_id = $3",
+                    [before[0], before[1], deleted_movie_id],
+                )
+    finally:
+        await clean_up([user_id], [movie_id])
+    return errors
+
+
+async def run_writers(
+    write: Callable[[str, str, float], Awaitable[None]],
+    users: List[str],
+    movies: List[str],
+    writes: int,
+    seed: int,
+) -> Tuple[float, List[float]]:
+    """Runs one writer per user, each rating random movies. Returns the wall time
+    and the latency of every write."""
+    samples: List[float] = []
+
+    async def writer(user_id: str, rng: random.Random) -> None:
+        for _ in range(writes):
+            movie_id = rng.choice(movies)
+            rating = rng.randint(1, 10) / 2
+            start = time.perf_counter()
+            await write(user_id, movie_id, rating)
+            samples.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(writer(user_id, random.Random(seed + i)) for i, user_id in enumerate(users))
+    )
+    return time.perf_counter() - start, samples
+
+
+async def benchmark(
+    paths: List[str], writers: int, writes: int, movie_count: int, seed: int
+) -> None:
+    await tortoise.Tortoise.init(
+        db_url=settings.DATABASE_URI, modules={"models": ["app.models.db"]}
+    )
+    conn = tortoise.Tortoise.get_connection("default")
+    movies = [
+        str(row["movie_id"])
+        for row in await conn.execute_query_dict(
+            "SELECT movie_id FROM movies WHERE delete_date IS NULL "
+            "ORDER BY num_votes DESC LIMIT $1",
+            [movie_count],
+        )
+    ]
+    deleted_movie_ids = [
+        str(row["movie_id"])
+        for row in await conn.execute_query_dict(
+            "SELECT movie_id FROM movies WHERE delete_date IS NOT NULL LIMIT 1"
+        )
+    ]
+    write_behind = settings.RATING_COUNTERS_WRITE_BEHIND
+    calls = {
+        "orm": orm_rating,
+        "upsert": upsert,
+        "upsert write-behind": upsert_write_behind,
+    }
+
+    rows: Dict[str, Dict[str, float]] = {}
+    errors: List[str] = []
+    for path in paths:
+        try:
+            errors += [
+                path + ", " + error
+                for error in await check_counting(
+                    calls[path], movies[0], (deleted_movie_ids or [None])[0]
+                )
+            ]
+        finally:
+            settings.RATING_COUNTERS_WRITE_BEHIND = write_behind
+        users = await create_users(writers)
+        try:
+            wall, samples = await run_writers(calls[path], users, movies, writes, seed)
+            if path == "upsert write-behind":
+                start = time.perf_counter()
+                await rating_counters.flush()
+                flushed = time.perf_counter() - start
+            else:
+                flushed = 0.0
+        finally:
+            settings.RATING_COUNTERS_WRITE_BEHIND = write_behind
+            await clean_up(users, movies)
+        row = summarize(samples)
+        row["writes/s"] = len(samples) / wall
+        row["flush ms"] = flushed * 1000
+        rows[path] = row
+
+    print_report(
+        "{} writers x {} writes on {} movies (ms)".format(writers, writes, len(movies)),
+        rows,
+    )
+    await close_redis()
+    await tortoise.Tortoise.close_connections()
+    if errors:
+        raise RuntimeError("Ratings were not counted once:\n" + "\n".join(errors))
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="benchmark rating_writes")
+    parser.add_argument(
+        "--paths",
+        nargs="+",
+        choices=["orm", "upsert", "upsert write-behind"],
+        default=["orm", "upsert", "upsert write-behind"],
+    )
+    parser.add_argument("--writers", type=int, default=16)
+    parser.add_argument("--writes", type=int, default=100)
+    parser.add_argument("--movies", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    run(benchmark(args.paths, args.writers, args.writes, args.movies, args.seed))
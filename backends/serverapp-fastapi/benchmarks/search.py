@@ -0,0 +1,449 @@
+import argparse
+import hashlib
+import json
+import random
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from elasticsearch import Connection, Elasticsearch
+
+from app.api.v1.routers import movies
+from app.core.config import settings
+from app.utils.dict_storage.memory import MemoryDictStorageDriver
+from app.utils.lru import LRUCache
+from app.utils.search_engines.elasticsearch import ElasticsearchSearchEngine
+
+from .common import percentile, print_report, run, summarize
+
+"""
+Replays a query log against the search and recommendation code paths with a local
+stand-in for Elasticsearch, so search regressions can be measured without any of the
+services in `.env`.
+
+The stand-in is an Elasticsearch connection class that answers `_search` requests with
+canned hits drawn from a fixture of movie documents (as indexed by pgsync). Movie
+tiles are served from a pre-filled per-worker cache and the search cache lives in
+memory, so only the application code is measured.
+
+    poetry run benchmark search --catalog 5000 --hits 500 --queries 2000
+    poetry run benchmark search --fixture movies.json --log queries.jsonl
+
+The fixture is a JSON list of movie documents. The query log has one JSON object per
+line, either a search:
+
+    {"endpoint": "search", "keywords": "star", "field": "all", "sort": "rating",
+     "desc": true, "page": 2, "per_page": 20, "session": "a"}
+
+(add `"cursor": ""` for cursor pagination), or the output of the recommender to be
+hydrated as done by get_recommendation():
+
+    {"endpoint": "recommendation", "movies": ["<movie_id>", ...], "per_page": 20}
+
+Entries with the same `session` share a session, and therefore the search cache.
+"""
+
+GENRES = [
+    "Action",
+    "Adventure",
+    "Animation",
+    "Comedy",
+    "Crime",
+    "Documentary",
+    "Drama",
+    "Family",
+    "Fantasy",
+    "Horror",
+    "Mystery",
+    "Romance",
+    "Science Fiction",
+    "Thriller",
+    "War",
+    "Western",
+]
+WORDS = [
+    "night",
+    "star",
+    "love",
+    "war",
+    "city",
+    "last",
+    "dark",
+    "king",
+    "house",
+    "river",
+    "ghost",
+    "summer",
+    "road",
+    "blood",
+    "secret",
+    "island",
+    "storm",
+    "girl",
+    "man",
+    "return",
+]
+
+
+def synthesize_catalog(size: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """Generates movie documents in the shape of the Elasticsearch movie index."""
+    rng = random.Random(seed)
+    directors = ["Director {}".format(i) for i in range(max(1, size // 8))]
+    catalog = []
+    for i in range(size):
+        num_votes = rng.randint(0, 500)
+        catalog.append(
+            {
+                "movie_id": str(10**17 + i),
+                "title": " ".join(rng.sample(WORDS, rng.randint(1, 4))).title(),
+                "release_date": "{}-{:02d}-{:02d}".format(
+                    rng.randint(1950, 2020), rng.randint(1, 12), rng.randint(1, 28)
+                ),
+                "image": "https://example.com/{}.jpg".format(i),
+                "genres": [{"name": name} for name in rng.sample(GENRES, 3)],
+                "positions": [
+                    {"position": "director", "people": {"name": name}}
+                    for name in rng.sample(directors, rng.randint(1, 2))
+                ],
+                "num_votes": num_votes,
+                "cumulative_rating": float(
+                    sum(rng.randint(1, 10) / 2 for _ in range(num_votes))
+                ),
+            }
+        )
+    return catalog
+
+
+def synthesize_query_log(
+    catalog: List[Dict[str, Any]], size: int, seed: int = 0
+) -> List[Dict[str, Any]]:
+    """Generates a query log with a skewed keyword distribution, so that some
+    searches are repeated within a session and hit the search cache."""
+    rng = random.Random(seed)
+    log = []
+    for _ in range(size):
+        session = "session-{}".format(rng.randint(0, max(1, size // 20)))
+        if rng.random() < 0.25:
+            log.append(
+                {
+                    "endpoint": "recommendation",
+                    "movies": [movie["movie_id"] for movie in rng.sample(catalog, 20)],
+                    "per_page": 20,
+                    "session": session,
+                }
+            )
+            continue
+        entry = {
+            "endpoint": "search",
+            "keywords": " ".join(
+                rng.choices(
+                    WORDS, weights=range(len(WORDS), 0, -1), k=rng.randint(1, 2)
+                )
+            ),
+            "field": rng.choice(["all", "all", "all", "title", "people"]),
+            "sort": rng.choice(["relevance", "relevance", "rating", "name", "year"]),
+            "desc": rng.random() < 0.8,
+            "page": rng.choice([1, 1, 1, 2, 3]),
+            "per_page": 20,
+            "session": session,
+        }
+        if rng.random() < 0.1:
+            entry["genres"] = [rng.choice(GENRES)]
+        if rng.random() < 0.1:
+            entry["cursor"] = ""
+        log.append(entry)
+    return log
+
+
+def average_rating(document: Dict[str, Any]) -> List[float]:
+    # Same values as the calculate_rating_field script for a viewer without a banlist
+    num_votes = document["num_votes"]
+    cumulative_rating = document["cumulative_rating"]
+    return [
+        cumulative_rating / num_votes if num_votes else 0.0,
+        num_votes,
+        cumulative_rating,
+    ]
+
+
+class FixtureConnection(Connection):
+    """
+    An Elasticsearch connection that never leaves the process: `_search` requests are
+    answered with hits drawn from the fixture, `hits` at most. The hit set is a
+    deterministic function of the query, so a replayed query gets the same hits.
+    """
+
+    def __init__(
+        self,
+        catalog: Optional[List[Dict[str, Any]]] = None,
+        hits: int = 500,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(**kwargs)
+        self.catalog = catalog or []
+        self.by_id = {document["movie_id"]: document for document in self.catalog}
+        self.hits = hits
+
+    def perform_request(
+        self,
+        method: str,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        body: Optional[bytes] = None,
+        timeout: Optional[float] = None,
+        ignore: Tuple[int, ...] = (),
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, Dict[str, str], str]:
+        response_headers = {
+            "content-type": "application/json",
+            "x-elastic-product": "Elasticsearch",
+        }
+        if url.rstrip("/").endswith("_search"):
+            query = json.loads(body or b"{}")
+            return 200, response_headers, json.dumps(self.search(query))
+        return (
+            200,
+            response_headers,
+            json.dumps(
+                {
+                    "version": {"number": "7.17.0", "build_flavor": "default"},
+                    "tagline": "You Know, for Search",
+                }
+            ),
+        )
+
+    def search(self, query: Dict[str, Any]) -> Dict[str, Any]:
+        filters = query.get("query", {}).get("bool", {}).get("filter", [])
+        lookup = [
+            clause["terms"]["movie_id"]
+            for clause in filters
+            if "movie_id" in clause.get("terms", {})
+        ]
+        if lookup:
+            # Hydration lookups return exactly the requested movies
+            documents = [
+                self.by_id[movie_id] for movie_id in lookup[0] if movie_id in self.by_id
+            ]
+            total = len(documents)
+        else:
+            digest = hashlib.sha1(
+                json.dumps(query.get("query"), sort_keys=True).encode("utf-8")
+            ).digest()
+            rng = random.Random(digest)
+            total = min(self.hits, len(self.catalog))
+            documents = rng.sample(self.catalog, total)
+        offset = 0
+        if "search_after" in query:
+            offset = int(query["search_after"][0]) + 1
+        documents = documents[offset : offset + query.get("size", 10)]
+
+        hits = []
+        for position, document in enumerate(documents, offset):
+            hit = {
+                "_index": "movies",
+                "_id": document["movie_id"],
+                "_score": float(total - position),
+                "_source": {"movie_id": document["movie_id"]}
+                if "_source" in query
+                else document,
+                # Opaque to the app, only ever sent back as `search_after`
+                "sort": [position, document["movie_id"]],
+            }
+            if "script_fields" in query:
+                hit["fields"] = {"average_rating": average_rating(document)}
+            hits.append(hit)
+
+        response = {
+            "took": 0,
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {
+                "total": {"value": total, "relation": "eq"},
+                "max_score": hits[0]["_score"] if hits else None,
+                "hits": hits,
+            },
+        }
+        if "aggs" in query:
+            response["aggregations"] = {
+                "genres": {
+                    "buckets": count_buckets(
+                        genre["name"]
+                        for document in documents
+                        for genre in document["genres"]
+                    )
+                },
+                "years": {
+                    "buckets": [
+                        {"key_as_string": key, "key": key, "doc_count": count}
+                        for key, count in sorted(
+                            count_pairs(
+                                document["release_date"][0:4] for document in documents
+                            )
+                        )
+                    ]
+                },
+            }
+        return response
+
+
+def count_pairs(values: Iterable[str]) -> List[Tuple[str, int]]:
+    counts = {}
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    return list(counts.items())
+
+
+def count_buckets(values: Iterable[str]) -> List[Dict[str, Any]]:
+    return [
+        {"key": key, "doc_count": count}
+        for key, count in sorted(count_pairs(values), key=lambda pair: -pair[1])
+    ]
+
+
+def search_cache_driver() -> MemoryDictStorageDriver:
+    """Keeps the search cache in memory, with the expiry of the Redis one."""
+    return MemoryDictStorageDriver(
+        key_prefix="search:",
+        ttl=settings.REDIS_SEARCH_TTL,
+        renew_on_ttl=settings.REDIS_SEARCH_TTL,
+    )
+
+
+def tile(document: Dict[str, Any]) -> Dict[str, Any]:
+    """Converts a fixture document to a movie tile, see load_movie_tiles()."""
+    return {
+        "movie_id": document["movie_id"],
+        "title": document["title"],
+        "release_date": document["release_date"],
+        "image": document["image"],
+        "genres": [genre["name"] for genre in document["genres"]],
+        "directors": [
+            position["people"]["name"]
+            for position in document["positions"]
+            if position["position"] == "director"
+        ],
+        "num_reviews": 0,
+        "num_votes": document["num_votes"],
+        "cumulative_rating": document["cumulative_rating"],
+    }
+
+
+def install_fixture(catalog: List[Dict[str, Any]], hits: int) -> None:
+    movies.search_engine = ElasticsearchSearchEngine(
+        client=Elasticsearch(
+            connection_class=FixtureConnection, catalog=catalog, hits=hits
+        )
+    )
+    movies.search_cache_driver = search_cache_driver()
+    # Every movie the stand-in can return is cached, so Redis and Postgres are never hit
+    movies.movie_tiles.lru = LRUCache(maxsize=len(catalog) + 1)
+    for document in catalog:
+        movies.movie_tiles.lru.set(document["movie_id"], tile(document))
+
+
+def replay_call(entry: Dict[str, Any], request: SimpleNamespace):
+    if entry["endpoint"] == "recommendation":
+        return movies.hydrate_movies(
+            request=request,
+            movies=entry["movies"],
+            genres=entry.get("genres"),
+            years=entry.get("years"),
+            directors=entry.get("directors"),
+            per_page=entry.get("per_page", 20),
+            page=entry.get("page", 1),
+            sort=entry.get("sort", "relevance"),
+            desc=entry.get("desc", True),
+        )
+    return movies.search_movies(
+        request=request,
+        keywords=entry.get("keywords", ""),
+        genres=entry.get("genres"),
+        years=entry.get("years"),
+        directors=entry.get("directors"),
+        per_page=entry.get("per_page", 20),
+        page=entry.get("page", 1),
+        sort=entry.get("sort", "relevance"),
+        desc=entry.get("desc", True),
+        field=entry.get("field", "all"),
+        cursor=entry.get("cursor"),
+    )
+
+
+def endpoint_name(entry: Dict[str, Any]) -> str:
+    if entry["endpoint"] == "recommendation":
+        return "recommendation"
+    return "search (cursor)" if entry.get("cursor") is not None else "search"
+
+
+async def replay(
+    log: List[Dict[str, Any]], trace_allocations: bool
+) -> Tuple[Dict[str, List[float]], Dict[str, List[float]]]:
+    """Replays the log once. Returns the latency samples (in seconds) and, when
+    tracing, the peak memory allocated by each request (in bytes) by endpoint."""
+    sessions = {}
+    latencies = {}
+    allocations = {}
+    for entry in log:
+        request = sessions.setdefault(
+            entry.get("session", ""), SimpleNamespace(session={})
+        )
+        name = endpoint_name(entry)
+        if trace_allocations:
+            tracemalloc.start()
+        start = time.perf_counter()
+        await replay_call(entry, request)
+        latencies.setdefault(name, []).append(time.perf_counter() - start)
+        if trace_allocations:
+            allocations.setdefault(name, []).append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    return latencies, allocations
+
+
+async def benchmark(
+    catalog: List[Dict[str, Any]], log: List[Dict[str, Any]], hits: int, rounds: int
+) -> None:
+    install_fixture(catalog, hits)
+
+    # Warm up once, then measure latency and allocations in separate passes, since
+    # tracing allocations slows every request down
+    await replay(log[: min(len(log), 50)], False)
+    latencies = {}
+    for _ in range(rounds):
+        for name, samples in (await replay(log, False))[0].items():
+            latencies.setdefault(name, []).extend(samples)
+    movies.search_cache_driver = search_cache_driver()
+    _, allocations = await replay(log, True)
+
+    rows = {}
+    for name in sorted(latencies):
+        row = summarize(latencies[name])
+        peaks = allocations.get(name, [0])
+        row["alloc KiB"] = sum(peaks) / len(peaks) / 1024
+        row["alloc p99"] = percentile(peaks, 99) / 1024
+        rows[name] = row
+    print_report("endpoint (ms) - {} movies, {} hits".format(len(catalog), hits), rows)
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="benchmark search")
+    parser.add_argument("--fixture", help="JSON list of movie documents")
+    parser.add_argument("--catalog", type=int, default=5000)
+    parser.add_argument("--hits", type=int, default=settings.ELASTICSEARCH_RESPONSESIZE)
+    parser.add_argument("--log", help="query log, one JSON object per line")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.fixture:
+        with open(args.fixture, encoding="utf-8") as file:
+            catalog = json.load(file)
+    else:
+        catalog = synthesize_catalog(args.catalog, args.seed)
+    if args.log:
+        with open(args.log, encoding="utf-8") as file:
+            log = [json.loads(line) for line in file if line.strip()]
+    else:
+        log = synthesize_query_log(catalog, args.queries, args.seed)
+    run(benchmark(catalog, log, args.hits, args.rounds))
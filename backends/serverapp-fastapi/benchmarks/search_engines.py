@@ -0,0 +1,139 @@
+import argparse
+import random
+import time
+from typing import Awaitable, Callable, Dict, List
+
+import tortoise
+
+from app.core.config import settings
+from app.utils.search_engines import SEARCH_ENGINES, SearchEngineBase, get_search_engine
+
+from .common import print_report, run, summarize
+
+"""
+Compares the search engines on the catalog in the database configured in `.env`:
+keyword search, the first and a deeper page of cursor search sorted by relevance and
+by rating, and suggestions for partially typed titles. Needs Postgres set up with
+`poetry run setup` and, for the Elasticsearch engine, the cluster in `.env`.
+
+    poetry run benchmark search_engines --queries 200
+    poetry run benchmark search_engines --engines postgres --queries 500
+
+Also reports how many of the top 10 movies of a keyword search the engines agree on,
+as a sanity check of the relevance of the Postgres engine.
+"""
+
+
+async def sample_keywords(count: int, seed: int) -> List[str]:
+    """Picks words and word pairs from random titles and people's names."""
+    conn = tortoise.Tortoise.get_connection("default")
+    rows = await conn.execute_query_dict(
+        "(SELECT title AS text FROM movies WHERE delete_date IS NULL "
+        "ORDER BY random() LIMIT $1) UNION ALL "
+        "(SELECT name FROM people ORDER BY random() LIMIT $2)",
+        [count, max(1, count // 4)],
+    )
+    rng = random.Random(seed)
+    keywords = []
+    for row in rows:
+        words = [word for word in row["text"].split() if len(word) > 2]
+        if words:
+            start = rng.randrange(len(words))
+            keywords.append(" ".join(words[start : start + rng.randint(1, 2)]))
+    rng.shuffle(keywords)
+    return keywords[:count]
+
+
+async def time_each(
+    keywords: List[str], call: Callable[[str], Awaitable[object]]
+) -> List[float]:
+    samples = []
+    for keyword in keywords:
+        start = time.perf_counter()
+        await call(keyword)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def deep_page(engine: SearchEngineBase, keyword: str, sort: str) -> None:
+    page = await engine.search_page(keywords=keyword, per_page=20, sort=sort)
+    if page.after is not None:
+        await engine.search_page(
+            keywords=keyword, per_page=20, sort=sort, after=page.after
+        )
+
+
+async def benchmark(engine_names: List[str], queries: int, seed: int) -> None:
+    await tortoise.Tortoise.init(
+        db_url=settings.DATABASE_URI, modules={"models": ["app.models.db"]}
+    )
+    conn = tortoise.Tortoise.get_connection("default")
+    catalog = (
+        await conn.execute_query_dict(
+            "SELECT count(*) AS count FROM movies WHERE delete_date IS NULL"
+        )
+    )[0]["count"]
+    keywords = await sample_keywords(queries, seed)
+
+    engines: Dict[str, SearchEngineBase] = {}
+    for name in engine_names:
+        engines[name] = get_search_engine(name)
+        await engines[name].initialize_engine()
+
+    rows = {}
+    top: Dict[str, List[List[str]]] = {}
+    for name, engine in engines.items():
+        # Warm up caches and connections
+        for keyword in keywords[:10]:
+            await engine.search(keyword)
+
+        async def search(keyword: str) -> None:
+            hits = await engine.search(
+                keyword, size=settings.ELASTICSEARCH_RESPONSESIZE
+            )
+            top.setdefault(name, []).append([hit.movie_id for hit in hits[:10]])
+
+        calls = {
+            "search": search,
+            "page 1 relevance": lambda keyword: engine.search_page(
+                keywords=keyword, per_page=20, facets=True
+            ),
+            "page 2 relevance": lambda keyword: deep_page(engine, keyword, "relevance"),
+            "page 2 rating": lambda keyword: deep_page(engine, keyword, "rating"),
+            "suggest": lambda keyword: engine.suggest(keyword[:4], 8),
+        }
+        for call_name, call in calls.items():
+            rows["{} {}".format(name, call_name)] = summarize(
+                await time_each(keywords, call)
+            )
+        await engine.terminate_engine()
+
+    print_report("{} movies, {} queries (ms)".format(catalog, len(keywords)), rows)
+
+    if len(top) == 2:
+        first, second = top.values()
+        overlap = [
+            len(set(a) & set(b)) / max(1, len(set(a) | set(b)))
+            for a, b in zip(first, second)
+        ]
+        print()
+        print(
+            "Top 10 overlap (Jaccard) of {}: {:.2f}".format(
+                " and ".join(top), sum(overlap) / max(1, len(overlap))
+            )
+        )
+    await tortoise.Tortoise.close_connections()
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="benchmark search_engines")
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=sorted(SEARCH_ENGINES),
+        default=["elasticsearch", "postgres"],
+    )
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    run(benchmark(args.engines, args.queries, args.seed))
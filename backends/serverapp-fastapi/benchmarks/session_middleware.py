@@ -0,0 +1,202 @@
+import argparse
+import json
+from http.cookies import SimpleCookie
+from typing import Any, Dict, List, Tuple
+
+from app.core.config import settings
+from app.core.session import AdvancedSessionMiddleware
+from app.utils.dict_storage import DictStorageDriverBase
+from app.utils.dict_storage.cached import CachedDictStorageDriver
+from app.utils.dict_storage.memory import MemoryDictStorageDriver
+from app.utils.dict_storage.redis import RedisDictStorageDriver
+from app.utils.dict_storage.redis_hash import RedisHashDictStorageDriver
+
+from .common import print_report, run, summarize, time_async
+
+"""
+Measures the per-request overhead of the session middleware with each of the given
+session storages (SESSION_STORAGE), by default the Redis configured in `.env` and
+the in-memory one: a request without a session cookie, one that starts a session,
+and ones that only read or also change an existing session, next to the same
+request without the middleware. It also times the session read alone, and for the
+json storage the GET, TTL and EXPIRE round trips it used to make.
+`--cache-size` puts the in-process session cache in front of the driver.
+
+The sessions it creates are deleted afterwards.
+
+    poetry run benchmark session_middleware --requests 2000
+    poetry run benchmark session_middleware --storages json hash memory
+    poetry run benchmark session_middleware --cache-size 1024
+"""
+
+
+async def legacy_get(
+    driver: RedisDictStorageDriver, key: str
+) -> Tuple[Dict[str, Any], int]:
+    """The session read of the driver before it was made a single script call."""
+    full_key = driver.key_prefix + driver.key_filter(key.strip().upper())
+    result_s = await driver.redis.get(full_key, encoding="utf-8")
+    if not result_s:
+        return {}, 0
+    ttl = 0
+    if driver.ttl:
+        ttl = await driver.redis.ttl(full_key)
+        if -1 <= ttl <= driver.renew_on_ttl:
+            await driver.redis.expire(full_key, driver.renew_on_ttl)
+        ttl = max(0, ttl)
+    return json.loads(result_s), ttl
+
+
+def make_app(write: bool):
+    async def app(scope, receive, send) -> None:
+        if write:
+            scope["session"]["requests"] = scope["session"].get("requests", 0) + 1
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/json")],
+            }
+        )
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    return app
+
+
+def make_scope(cookie: str = "") -> Dict[str, Any]:
+    headers = [(b"host", b"localhost")]
+    if cookie:
+        headers.append((b"cookie", cookie.encode("latin-1")))
+    return {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/",
+        "raw_path": b"/",
+        "query_string": b"",
+        "root_path": "",
+        "headers": headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("localhost", 80),
+    }
+
+
+async def receive() -> Dict[str, Any]:
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+def make_driver(storage: str) -> DictStorageDriverBase:
+    kwargs: Dict[str, Any] = {
+        "key_prefix": settings.SESSION_STORAGE_KEY_PREFIX,
+        "ttl": int(max(60, settings.SESSION_TTL + 20)),
+        "renew_on_ttl": int(max(60, settings.SESSION_TTL + 20))
+        - settings.SESSION_RENEW_TIME,
+    }
+    if storage == "memory":
+        return MemoryDictStorageDriver(
+            max_entries=settings.SESSION_MEMORY_MAX_ENTRIES,
+            max_bytes=settings.SESSION_MEMORY_MAX_BYTES,
+            **kwargs,
+        )
+    kwargs.update(
+        redis_uri=settings.REDIS_URI,
+        redis_pool_min=settings.REDIS_POOL_MIN,
+        redis_pool_max=settings.REDIS_POOL_MAX,
+    )
+    if storage == "hash":
+        return RedisHashDictStorageDriver(
+            lazy_fields=settings.SESSION_LAZY_FIELDS, **kwargs
+        )
+    return RedisDictStorageDriver(**kwargs)
+
+
+async def benchmark_storage(requests: int, storage: str, cache_size: int) -> None:
+    driver = make_driver(storage)
+    inner = driver
+    if cache_size:
+        driver = CachedDictStorageDriver(
+            driver,
+            redis_uri=settings.REDIS_URI,
+            channel=settings.SESSION_STORAGE_KEY_PREFIX + "invalidate",
+            size=cache_size,
+            ttl=settings.SESSION_CACHE_TTL,
+            metrics_prefix="session_cache",
+        )
+    await driver.initialize_driver()
+    created: List[str] = []
+
+    async def send(message: Dict[str, Any]) -> None:
+        # Collects the sessions the middleware starts, to delete them afterwards
+        for name, value in message.get("headers", []):
+            if name.lower() == b"set-cookie":
+                cookie = SimpleCookie(value.decode("latin-1"))
+                morsel = cookie.get(settings.SESSION_COOKIE_NAME)
+                if morsel is not None and morsel.value:
+                    created.append(morsel.value)
+
+    def middleware(write: bool) -> AdvancedSessionMiddleware:
+        return AdvancedSessionMiddleware(
+            make_app(write),
+            driver=driver,
+            separate_https=False,
+            cookie_secret=None,
+            cache_size=0,
+        )
+
+    session_id = await driver.create()
+    created.append(session_id)
+    await driver.update(
+        session_id,
+        {
+            "user_id": "benchmark",
+            **{field: {} for field in settings.SESSION_LAZY_FIELDS},
+        },
+    )
+    cookie = "{}={}".format(settings.SESSION_COOKIE_NAME, session_id)
+
+    bare, reader, writer = make_app(False), middleware(False), middleware(True)
+    calls = {
+        "no middleware": lambda: bare(make_scope(), receive, send),
+        "no session": lambda: reader(make_scope(), receive, send),
+        "new session": lambda: writer(make_scope(), receive, send),
+        "existing session, read": lambda: reader(make_scope(cookie), receive, send),
+        "existing session, write": lambda: writer(make_scope(cookie), receive, send),
+        "get": lambda: driver.get(session_id),
+    }
+    if storage == "json":
+        calls["get (GET, TTL, EXPIRE)"] = lambda: legacy_get(inner, session_id)
+    rows: Dict[str, Dict[str, float]] = {}
+    try:
+        for name, call in calls.items():
+            rows[name] = summarize(await time_async(call, requests))
+    finally:
+        for key in created:
+            await driver.destroy(key)
+        await driver.terminate_driver()
+
+    print_report(
+        "{} requests, {} storage, cache size {} (ms)".format(
+            requests, storage, cache_size
+        ),
+        rows,
+    )
+
+
+async def benchmark(requests: int, storages: List[str], cache_size: int) -> None:
+    for storage in storages:
+        await benchmark_storage(requests, storage, cache_size)
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="benchmark session_middleware")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument(
+        "--storages",
+        nargs="+",
+        choices=["json", "hash", "memory"],
+        default=["json", "memory"],
+    )
+    parser.add_argument("--cache-size", type=int, default=0)
+    args = parser.parse_args(argv)
+    run(benchmark(args.requests, args.storages, args.cache_size))
@@ -7,6 +7,7 @@ import tortoise
 from dotenv import dotenv_values, find_dotenv
 
 from app.core.config import settings
+from app.utils.review_rank import rank_score_sql
 
 
 async def init_database(drop_all: bool = False, if_not_exists: bool = True):
@@ -169,3 +170,140 @@ async def add_constraints(conn):
         SET DEFAULT gen_random_uuid()
         """
     )
+    await add_search_indexes(conn)
+    await add_review_indexes(conn)
+    await add_crew_order(conn)
+
+
+async def add_search_indexes(conn):
+    # Used by the postgres search engine, see app/utils/search_engines/postgres.py
+    await conn.execute_query("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    await conn.execute_query(
+        """
+        ALTER TABLE public.movies
+        ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(title, '')), 'A')
+            || setweight(to_tsvector('english', coalesce(description, '')), 'B')
+        ) STORED
+        """
+    )
+    await conn.execute_query(
+        """
+        ALTER TABLE public.people
+        ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', coalesce(name, ''))) STORED
+        """
+    )
+    await conn.execute_query(
+        """
+        CREATE INDEX IF NOT EXISTS movies_search_vector_idx
+        ON public.movies USING GIN (search_vector)
+        """
+    )
+    await conn.execute_query(
+        """
+        CREATE INDEX IF NOT EXISTS movies_title_trgm_idx
+        ON public.movies USING GIN (title gin_trgm_ops)
+        """
+    )
+    await conn.execute_query(
+        """
+        CREATE INDEX IF NOT EXISTS people_search_vector_idx
+        ON public.people USING GIN (search_vector)
+        """
+    )
+    await conn.execute_query(
+        """
+        CREATE INDEX IF NOT EXISTS people_name_trgm_idx
+        ON public.people USING GIN (name gin_trgm_ops)
+        """
+    )
+    await conn.execute_query(
+        """
+        CREATE INDEX IF NOT EXISTS positions_person_id_idx
+        ON public.positions (person_id)
+        """
+    )
+    await conn.execute_query(
+        """
+        CREATE INDEX IF NOT EXISTS movie_genres_genre_id_idx
+        ON public.movie_genres (genre_id)
+        """
+    )
+
+
+async def add_review_indexes(conn):
+    # Used by the cursor pagination of review listings, which walks the live
+    # reviews of a movie or a user on (create_date, review_id), or of a movie
+    # on (rank_score, create_date, review_id) for sort=top, see
+    # page_reviews() in app/api/v1/routers/review.py
+    await conn.execute_query(
+        """
+        ALTER TABLE public.reviews
+        ADD COLUMN IF NOT EXISTS rank_score double precision NOT NULL DEFAULT 0
+        """
+    )
+    await conn.execute_query(
+        """
+        UPDATE public.reviews SET rank_score = {}
+        WHERE rank_score = 0 AND num_helpful > 0
+        """.format(
+            rank_score_sql("num_helpful", "num_spoiler")
+        )
+    )
+    await conn.execute_query(
+        """
+        CREATE INDEX IF NOT EXISTS reviews_movie_id_create_date_idx
+        ON public.reviews (movie_id, create_date DESC, review_id DESC)
+        WHERE delete_date IS NULL
+        """
+    )
+    await conn.execute_query(
+        """
+        CREATE INDEX IF NOT EXISTS reviews_user_id_create_date_idx
+        ON public.reviews (user_id, create_date DESC, review_id DESC)
+        WHERE delete_date IS NULL
+        """
+    )
+    await conn.execute_query(
+        """
+        CREATE INDEX IF NOT EXISTS reviews_movie_id_rank_score_idx
+        ON public.reviews (movie_id, rank_score DESC, create_date DESC, review_id DESC)
+        WHERE delete_date IS NULL
+        """
+    )
+
+
+async def add_crew_order(conn):
+    # The crew of a movie is listed in billing order, which the import takes from
+    # the credits (see storages/database/exports). Positions imported without it
+    # are numbered after the credited ones, in the order they were added
+    await conn.execute_query(
+        """
+        ALTER TABLE public.positions
+        ADD COLUMN IF NOT EXISTS billing_order integer
+        """
+    )
+    await conn.execute_query(
+        """
+        UPDATE public.positions AS p SET billing_order = o.billing_order
+        FROM (
+            SELECT position_id, row_number() OVER (
+                PARTITION BY movie_id
+                ORDER BY billing_order NULLS LAST, create_date, position_id
+            ) AS billing_order
+            FROM public.positions
+            WHERE movie_id IN (
+                SELECT movie_id FROM public.positions WHERE billing_order IS NULL
+            )
+        ) AS o
+        WHERE p.position_id = o.position_id
+        """
+    )
+    await conn.execute_query(
+        """
+        CREATE INDEX IF NOT EXISTS positions_movie_id_billing_order_idx
+        ON public.positions (movie_id, billing_order, position_id)
+        """
+    )
@@ -0,0 +1,153 @@
+import asyncio
+from typing import Any, List, Optional
+
+import aioredis
+import fakeredis
+import redis
+
+"""
+An in-process stand-in for the aioredis 1.x pool returned by app.core.redis, backed
+by fakeredis, which also runs Lua scripts. Only the commands the app uses are
+wrapped; tests patch it in for `get_redis` of the module under test.
+"""
+
+
+def decode(value: Any, encoding: Optional[str]) -> Any:
+    if encoding is None:
+        return value
+    if isinstance(value, bytes):
+        return value.decode(encoding)
+    if isinstance(value, list):
+        return [decode(item, encoding) for item in value]
+    return value
+
+
+class FakeRedis:
+    SET_IF_NOT_EXIST = "SET_IF_NOT_EXIST"
+    SET_IF_EXIST = "SET_IF_EXIST"
+
+    server: fakeredis.FakeRedis
+    # The encoding set in REDIS_URI, which aioredis applies to every reply
+    encoding: Optional[str]
+
+    def __init__(self, encoding: Optional[str] = None) -> None:
+        self.server = fakeredis.FakeRedis()
+        self.encoding = encoding
+
+    async def __call__(self) -> "FakeRedis":
+        # Patched in for get_redis()
+        return self
+
+    def reply(self, value: Any, encoding: Optional[str] = None) -> Any:
+        return decode(value, encoding or self.encoding)
+
+    async def get(self, key: str, encoding: Optional[str] = None) -> Any:
+        return self.reply(self.server.get(key), encoding)
+
+    async def mget(self, *keys: str, encoding: Optional[str] = None) -> List:
+        return self.reply(self.server.mget(keys), encoding)
+
+    async def set(
+        self,
+        key: str,
+        value: Any,
+        expire: int = 0,
+        exist: Optional[str] = None,
+    ) -> bool:
+        return bool(
+            self.server.set(
+                key,
+                value,
+                ex=expire or None,
+                nx=exist == self.SET_IF_NOT_EXIST,
+                xx=exist == self.SET_IF_EXIST,
+            )
+        )
+
+    async def delete(self, *keys: str) -> int:
+        return self.server.delete(*keys)
+
+    async def unlink(self, *keys: str) -> int:
+        return self.server.unlink(*keys)
+
+    async def exists(self, *keys: str) -> int:
+        return self.server.exists(*keys)
+
+    async def expire(self, key: str, timeout: int) -> bool:
+        return self.server.expire(key, timeout)
+
+    async def ttl(self, key: str) -> int:
+        return self.server.ttl(key)
+
+    async def incr(self, key: str) -> int:
+        return self.server.incr(key)
+
+    async def hget(self, key: str, field: str, encoding: Optional[str] = None) -> Any:
+        return self.reply(self.server.hget(key, field), encoding)
+
+    async def hmget(self, key: str, *fields: str, encoding: Optional[str] = None):
+        return self.reply(self.server.hmget(key, fields), encoding)
+
+    async def hgetall(self, key: str, encoding: Optional[str] = None) -> dict:
+        return {
+            self.reply(name, encoding): self.reply(value, encoding)
+            for name, value in self.server.hgetall(key).items()
+        }
+
+    async def hmset_dict(self, key: str, value: dict) -> bool:
+        return self.server.hset(key, mapping=value) >= 0
+
+    async def hdel(self, key: str, *fields: str) -> int:
+        return self.server.hdel(key, *fields)
+
+    async def hincrby(self, key: str, field: str, increment: int = 1) -> int:
+        return self.server.hincrby(key, field, increment)
+
+    async def hincrbyfloat(self, key: str, field: str, increment: float) -> float:
+        return self.server.hincrbyfloat(key, field, increment)
+
+    async def eval(
+        self, script: str, keys: Optional[List] = None, args: Optional[List] = None
+    ) -> Any:
+        keys, args = keys or [], args or []
+        return self.reply(self.server.eval(script, len(keys), *keys, *args))
+
+    async def script_load(self, script: str) -> str:
+        return self.server.script_load(script)
+
+    async def evalsha(
+        self, sha: str, keys: Optional[List] = None, args: Optional[List] = None
+    ) -> Any:
+        keys, args = keys or [], args or []
+        try:
+            return self.reply(self.server.evalsha(sha, len(keys), *keys, *args))
+        except redis.exceptions.NoScriptError as error:
+            raise aioredis.errors.ReplyError("NOSCRIPT " + str(error))
+
+    def multi_exec(self) -> "FakeTransaction":
+        return FakeTransaction(self)
+
+
+class FakeTransaction:
+    """Queues commands like aioredis' MULTI/EXEC, each call returns a future that
+    is resolved by execute()."""
+
+    def __init__(self, redis: FakeRedis) -> None:
+        self.redis = redis
+        self.commands: List = []
+
+    def __getattr__(self, name: str):
+        def queue(*args, **kwargs) -> asyncio.Future:
+            future = asyncio.get_event_loop().create_future()
+            self.commands.append((future, getattr(self.redis, name), args, kwargs))
+            return future
+
+        return queue
+
+    async def execute(self) -> List:
+        results = []
+        for future, command, args, kwargs in self.commands:
+            result = await command(*args, **kwargs)
+            future.set_result(result)
+            results.append(result)
+        return results
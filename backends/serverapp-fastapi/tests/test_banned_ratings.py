@@ -0,0 +1,215 @@
+import asyncio
+
+import pytest
+
+from app.utils import banned_ratings as module
+from app.utils.banned_ratings import BannedRatings
+from tests.fake_redis import FakeRedis
+
+VIEWER = "viewer"
+RATER = "rater"
+MOVIE = "movie"
+
+
+class FakeDatabase:
+    """The banlists and ratings tables, with hooks that run other requests in the
+    middle of a build's reads."""
+
+    def __init__(self) -> None:
+        self.banlists = {VIEWER: {RATER}}
+        self.ratings = {}
+        self.before_ratings_read = None
+        self.after_ratings_read = None
+
+    async def load_banlist(self, user_id):
+        return frozenset(self.banlists.get(user_id, ()))
+
+    async def load_banned_ratings(self, banned_user_ids):
+        if self.before_ratings_read:
+            hook, self.before_ratings_read = self.before_ratings_read, None
+            await hook()
+        deltas = {}
+        for (user_id, movie_id), rating in self.ratings.items():
+            if user_id in banned_user_ids:
+                cumulative_rating, num_votes = deltas.get(movie_id, (0.0, 0))
+                deltas[movie_id] = (cumulative_rating + rating, num_votes + 1)
+        if self.after_ratings_read:
+            hook, self.after_ratings_read = self.after_ratings_read, None
+            await hook()
+        return deltas
+
+    def viewers_of(self, banned_user_id):
+        return [
+            {"user_id": user_id}
+            for user_id, banned in self.banlists.items()
+            if banned_user_id in banned
+        ]
+
+
+class FakeBanlists:
+    database: FakeDatabase
+
+    @classmethod
+    def filter(cls, banned_user_id, delete_date):
+        database = cls.database
+
+        class Query:
+            async def values(self, *fields):
+                return database.viewers_of(banned_user_id)
+
+        return Query()
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+    FakeBanlists.database = database
+    monkeypatch.setattr(module, "get_redis", FakeRedis(encoding="utf-8"))
+    monkeypatch.setattr(module, "load_banlist", database.load_banlist)
+    monkeypatch.setattr(module, "load_banned_ratings", database.load_banned_ratings)
+    monkeypatch.setattr(module, "Banlists", FakeBanlists)
+    return database
+
+
+async def rate(cache: BannedRatings, database: FakeDatabase, rating, hook=None):
+    """Saves a rating of the rater the way the movie router does, running the hook
+    between saving it and applying it."""
+    await cache.rating_changing(RATER)
+    old_rating = database.ratings.get((RATER, MOVIE))
+    if rating is None:
+        database.ratings.pop((RATER, MOVIE), None)
+    else:
+        database.ratings[(RATER, MOVIE)] = rating
+    if hook:
+        await hook()
+    await cache.rating_changed(RATER, MOVIE, old_rating, rating)
+
+
+async def is_built(cache: BannedRatings) -> bool:
+    redis = await module.get_redis()
+    return bool(await redis.exists(cache.prefix + VIEWER))
+
+
+def test_build_then_apply(database):
+    async def scenario():
+        cache = BannedRatings()
+        database.ratings[(RATER, MOVIE)] = 4.0
+        assert await cache.get_many(VIEWER, [MOVIE, "other"]) == {MOVIE: (4.0, 1)}
+        assert await is_built(cache)
+        await rate(cache, database, 2.5)
+        # Served from the hash, which has the change applied, not rebuilt
+        database.ratings[(RATER, MOVIE)] = 0.0
+        assert await cache.get_many(VIEWER, [MOVIE]) == {MOVIE: (2.5, 1)}
+        database.ratings[(RATER, MOVIE)] = 2.5
+        await rate(cache, database, None)
+        assert await is_built(cache)
+        assert await cache.get_many(VIEWER, [MOVIE]) == {}
+
+    asyncio.run(scenario())
+
+
+def test_apply_skips_hashes_not_built(database):
+    async def scenario():
+        cache = BannedRatings()
+        await rate(cache, database, 3.0)
+        assert not await is_built(cache)
+        assert await cache.get_many(VIEWER, [MOVIE]) == {MOVIE: (3.0, 1)}
+
+    asyncio.run(scenario())
+
+
+def test_rating_saved_during_build_and_applied_after_is_not_counted_twice(database):
+    async def scenario():
+        cache = BannedRatings()
+        saved = asyncio.Event()
+        built = asyncio.Event()
+
+        async def build():
+            database.before_ratings_read = saved.wait
+            deltas = await cache.build(VIEWER)
+            built.set()
+            return deltas
+
+        async def after_save():
+            saved.set()
+            # The build reads the rating and tries to store it before it is applied
+            await built.wait()
+
+        deltas, _ = await asyncio.gather(
+            build(), rate(cache, database, 4.0, after_save)
+        )
+        assert deltas == {MOVIE: (4.0, 1)}
+        # The build was refused, so the rating is only counted by the next one
+        assert not await is_built(cache)
+        assert await cache.get_many(VIEWER, [MOVIE]) == {MOVIE: (4.0, 1)}
+        assert await cache.get_many(VIEWER, [MOVIE]) == {MOVIE: (4.0, 1)}
+        assert await is_built(cache)
+
+    asyncio.run(scenario())
+
+
+def test_rating_applied_before_a_stale_build_stores_is_not_lost(database):
+    async def scenario():
+        cache = BannedRatings()
+        database.ratings[(RATER, MOVIE)] = 1.0
+
+        async def write():
+            await rate(cache, database, 5.0)
+
+        # The build reads the old rating, then the new one is saved and applied
+        # before the build stores what it read
+        database.after_ratings_read = write
+        deltas = await cache.build(VIEWER)
+        assert deltas == {MOVIE: (1.0, 1)}
+        assert not await is_built(cache)
+        assert await cache.get_many(VIEWER, [MOVIE]) == {MOVIE: (5.0, 1)}
+
+    asyncio.run(scenario())
+
+
+def test_write_in_flight_when_the_build_starts(database):
+    async def scenario():
+        cache = BannedRatings()
+
+        async def during_write():
+            # The write is saved but not applied when the build runs
+            await cache.build(VIEWER)
+            assert not await is_built(cache)
+
+        await rate(cache, database, 2.0, during_write)
+        assert await cache.get_many(VIEWER, [MOVIE]) == {MOVIE: (2.0, 1)}
+        assert await is_built(cache)
+
+    asyncio.run(scenario())
+
+
+def test_failed_write_ends_without_a_change(database):
+    async def scenario():
+        cache = BannedRatings()
+        await cache.rating_changing(RATER)
+        # The rating could not be saved
+        await cache.rating_changed(RATER, MOVIE, None, None)
+        database.ratings[(RATER, MOVIE)] = 3.5
+        await cache.build(VIEWER)
+        assert await is_built(cache)
+        assert await cache.get_many(VIEWER, [MOVIE]) == {MOVIE: (3.5, 1)}
+
+    asyncio.run(scenario())
+
+
+def test_ban_during_build_is_not_stored(database):
+    async def scenario():
+        cache = BannedRatings()
+        database.ratings[(RATER, MOVIE)] = 2.0
+        database.banlists[VIEWER] = set()
+
+        async def ban():
+            database.banlists[VIEWER] = {RATER}
+            await cache.ban_changed(VIEWER)
+
+        database.before_ratings_read = ban
+        assert await cache.build(VIEWER) == {}
+        assert not await is_built(cache)
+        assert await cache.get_many(VIEWER, [MOVIE]) == {MOVIE: (2.0, 1)}
+
+    asyncio.run(scenario())
@@ -0,0 +1,228 @@
+import asyncio
+import itertools
+import json
+
+import pytest
+
+from app.utils.dict_storage import cached as module
+from app.utils.dict_storage.cached import CachedDictStorageDriver
+from app.utils.dict_storage.memory import MemoryDictStorageDriver
+from app.utils.metrics import metrics
+
+CHANNEL = "session:invalidate"
+prefixes = itertools.count()
+
+
+class FakeChannel:
+    def __init__(self) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.message = None
+
+    async def wait_message(self) -> bool:
+        # None stands for the connection being closed
+        self.message = await self.queue.get()
+        return self.message is not None
+
+    async def get(self) -> bytes:
+        return self.message
+
+
+class FakeBroker:
+    """The Redis pub/sub channels of the workers of a test, patched in for
+    aioredis."""
+
+    def __init__(self) -> None:
+        self.channels = {}
+        self.published = []
+
+    async def create_redis_pool(self, redis_uri, maxsize=10):
+        return self
+
+    async def create_redis(self, redis_uri):
+        broker = self
+
+        class Subscriber:
+            async def subscribe(self, name):
+                self.name, self.channel = name, FakeChannel()
+                broker.channels.setdefault(name, []).append(self.channel)
+                return [self.channel]
+
+            def close(self):
+                broker.channels[self.name].remove(self.channel)
+
+            async def wait_closed(self):
+                pass
+
+        return Subscriber()
+
+    async def publish(self, name, message):
+        self.published.append(json.loads(message))
+        for channel in self.channels.get(name, []):
+            channel.queue.put_nowait(message.encode("utf-8"))
+        return len(self.channels.get(name, []))
+
+    def disconnect(self) -> None:
+        for channels in self.channels.values():
+            for channel in channels:
+                channel.queue.put_nowait(None)
+
+    def close(self) -> None:
+        pass
+
+    async def wait_closed(self) -> None:
+        pass
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    broker = FakeBroker()
+    monkeypatch.setattr(module, "aioredis", broker)
+    return broker
+
+
+def make_worker(storage: MemoryDictStorageDriver) -> CachedDictStorageDriver:
+    return CachedDictStorageDriver(
+        storage,
+        channel=CHANNEL,
+        size=16,
+        ttl=60,
+        metrics_prefix="test_session_cache_{}".format(next(prefixes)),
+    )
+
+
+def make_storage() -> MemoryDictStorageDriver:
+    return MemoryDictStorageDriver(
+        key_prefix="session:", ttl=100, metrics_prefix="test_session_storage"
+    )
+
+
+def counts(worker: CachedDictStorageDriver):
+    snapshot = metrics.snapshot()
+    return (
+        snapshot.get(worker.metrics_prefix + ".hits", 0),
+        snapshot.get(worker.metrics_prefix + ".misses", 0),
+    )
+
+
+async def settle() -> None:
+    # Lets the listeners subscribe and handle what was published
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_hits_and_misses(broker):
+    async def scenario():
+        storage = make_storage()
+        worker = make_worker(storage)
+        await worker.initialize_driver()
+        await settle()
+        await storage.update("k1", {"user_id": "A"})
+        assert await worker.lookup("k1") == ({"user_id": "A"}, 100)
+        assert counts(worker) == (0, 1)
+        # Served from the cache, also under another spelling of the key
+        await storage.destroy("k1")
+        assert await worker.lookup(" K1") == ({"user_id": "A"}, 100)
+        assert counts(worker) == (1, 1)
+        assert await worker.lookup("missing") == (None, 0)
+        assert await worker.lookup("missing") == (None, 0)
+        assert counts(worker) == (1, 3)
+        await worker.terminate_driver()
+
+    asyncio.run(scenario())
+
+
+def test_changes_of_other_workers_are_dropped(broker):
+    async def scenario():
+        storage = make_storage()
+        first, second = make_worker(storage), make_worker(storage)
+        await first.initialize_driver()
+        await second.initialize_driver()
+        await settle()
+        await second.update("k1", {"user_id": "A"})
+        assert await first.lookup("k1") == ({"user_id": "A"}, 100)
+
+        await second.update("k1", {"user_id": "B"})
+        await settle()
+        assert await first.lookup("k1") == ({"user_id": "B"}, 100)
+        assert counts(first) == (0, 2)
+        await second.destroy("k1")
+        await settle()
+        assert await first.lookup("k1") == (None, 0)
+        await first.terminate_driver()
+        await second.terminate_driver()
+
+    asyncio.run(scenario())
+
+
+def test_own_changes_are_kept(broker):
+    async def scenario():
+        storage = make_storage()
+        worker = make_worker(storage)
+        await worker.initialize_driver()
+        await settle()
+        await worker.update("k1", {"user_id": "A"})
+        await worker.update_fields("k1", {"user_id": "B"}, ["user_id"])
+        await settle()
+        assert [message[0] for message in broker.published] == [worker._origin] * 2
+        assert await worker.lookup("k1") == ({"user_id": "B"}, 100)
+        assert counts(worker) == (1, 0)
+        await worker.terminate_driver()
+
+    asyncio.run(scenario())
+
+
+def test_nothing_is_cached_while_not_listening(broker):
+    async def scenario():
+        storage = make_storage()
+        worker = make_worker(storage)
+        await storage.update("k1", {"user_id": "A"})
+        # Not subscribed yet
+        assert await worker.lookup("k1") == ({"user_id": "A"}, 100)
+        assert await worker.lookup("k1") == ({"user_id": "A"}, 100)
+        assert counts(worker) == (0, 2)
+        assert len(worker.lru) == 0
+
+        await worker.initialize_driver()
+        await settle()
+        assert worker.listening
+        await worker.lookup("k1")
+        assert len(worker.lru) == 1
+        # The subscription is lost, changes could be missed from now on
+        broker.disconnect()
+        await settle()
+        assert not worker.listening
+        assert len(worker.lru) == 0
+        await worker.update("k1", {"user_id": "B"})
+        assert len(worker.lru) == 0
+        assert await worker.lookup("k1") == ({"user_id": "B"}, 100)
+        assert counts(worker) == (0, 4)
+        await worker.terminate_driver()
+
+    asyncio.run(scenario())
+
+
+def test_keys_are_cached_per_key_prefix(broker):
+    async def scenario():
+        storage = make_storage()
+        worker = make_worker(storage)
+        await worker.initialize_driver()
+        await settle()
+        # As the session middleware does with SESSION_SEPARATE_HTTPS
+        await worker.set_key_prefix("session:http-")
+        await worker.update("k1", {"scheme": "http"})
+        await worker.set_key_prefix("session:https-")
+        assert await worker.lookup("k1") == (None, 0)
+        await worker.update("k1", {"scheme": "https"})
+
+        # Another worker changes the https session
+        await broker.publish(
+            CHANNEL, json.dumps(["another worker", "session:https-", "K1"])
+        )
+        await settle()
+        assert worker.lru.get(("session:https-", "K1")) is None
+        await worker.set_key_prefix("session:http-")
+        assert await worker.lookup("k1") == ({"scheme": "http"}, 100)
+        assert counts(worker) == (1, 1)
+        await worker.terminate_driver()
+
+    asyncio.run(scenario())
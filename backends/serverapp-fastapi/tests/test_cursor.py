@@ -0,0 +1,47 @@
+import pytest
+
+from app.utils.cursor import decode_cursor, encode_cursor, query_fingerprint
+
+
+def test_round_trip():
+    after = [4.5, "2020-01-01T00:00:00+00:00", "b7d5a9f0-0000-0000-0000-000000000000"]
+    fingerprint = query_fingerprint("matrix", ["Action"], [], 20, "rating", True)
+    cursor = encode_cursor(after, fingerprint)
+    assert decode_cursor(cursor, fingerprint) == after
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor(["??>>", "ü"], "f")
+    assert "=" not in cursor
+    assert "+" not in cursor
+    assert "/" not in cursor
+    assert decode_cursor(cursor, "f") == ["??>>", "ü"]
+
+
+def test_fingerprint_is_stable():
+    assert query_fingerprint("a", [1, 2], True) == query_fingerprint("a", [1, 2], True)
+    assert query_fingerprint("a", [1, 2], True) != query_fingerprint("a", [2, 1], True)
+    assert len(query_fingerprint()) == 16
+
+
+def test_cursor_of_another_query():
+    cursor = encode_cursor([1, "id"], query_fingerprint("matrix"))
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, query_fingerprint("alien"))
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "not a cursor",
+        "e30",  # {}
+        "WzFd",  # [1]
+        "eyJhIjoxLCJxIjoiIn0",  # {"a":1,"q":""}
+        "_w",  # invalid UTF-8
+    ],
+)
+def test_malformed_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
@@ -0,0 +1,377 @@
+import asyncio
+import math
+import os
+from datetime import datetime
+from uuid import UUID
+
+import numpy as np
+import pytest
+
+from app.utils.search_engines import inverted_index as module
+from app.utils.search_engines.inverted_index import (
+    K1,
+    B,
+    InvertedIndex,
+    InvertedIndexSearchEngine,
+)
+
+MOVIES = [
+    {
+        "movie_id": "00000000-0000-0000-0000-000000000001",
+        "title": "The Matrix",
+        "description": "A hacker learns the world is a simulation.",
+        "release_date": datetime(1999, 3, 31),
+        "image": "matrix.jpg",
+        "num_votes": 4,
+        "cumulative_rating": 18.0,
+    },
+    {
+        "movie_id": "00000000-0000-0000-0000-000000000002",
+        "title": "Simulacra",
+        "description": "A documentary about the matrix of the matrix films.",
+        "release_date": datetime(2003, 5, 15),
+        "image": None,
+        "num_votes": 2,
+        "cumulative_rating": 9.0,
+    },
+    {
+        "movie_id": "00000000-0000-0000-0000-000000000003",
+        "title": "Speed Racer",
+        "description": "A young driver races for his family.",
+        "release_date": datetime(2008, 5, 9),
+        "image": None,
+        "num_votes": 2,
+        "cumulative_rating": 6.0,
+    },
+    {
+        "movie_id": "00000000-0000-0000-0000-000000000004",
+        "title": "Cloud Atlas",
+        "description": "Six stories across five centuries.",
+        "release_date": datetime(2012, 10, 26),
+        "image": None,
+        "num_votes": 0,
+        "cumulative_rating": 0.0,
+    },
+    {
+        "movie_id": "00000000-0000-0000-0000-000000000005",
+        "title": "Bound",
+        "description": "A heist between two neighbours.",
+        "release_date": datetime(1996, 9, 13),
+        "image": None,
+        "num_votes": 4,
+        "cumulative_rating": 18.0,
+    },
+]
+
+POSITIONS = [
+    {"movie_id": movie["movie_id"], "name": "Lana Wachowski", "position": "director"}
+    for movie in MOVIES
+    if movie["title"] != "Simulacra"
+] + [
+    {"movie_id": MOVIES[1]["movie_id"], "name": "Jane Doe", "position": "director"},
+    {"movie_id": MOVIES[0]["movie_id"], "name": "Keanu Reeves", "position": "actor"},
+    {"movie_id": MOVIES[3]["movie_id"], "name": "Tom Tykwer", "position": "director"},
+]
+
+GENRES = [
+    {"movie_id": MOVIES[0]["movie_id"], "name": "Action"},
+    {"movie_id": MOVIES[0]["movie_id"], "name": "Science Fiction"},
+    {"movie_id": MOVIES[1]["movie_id"], "name": "Documentary"},
+    {"movie_id": MOVIES[2]["movie_id"], "name": "Action"},
+    {"movie_id": MOVIES[3]["movie_id"], "name": "Science Fiction"},
+    {"movie_id": MOVIES[4]["movie_id"], "name": "Crime"},
+]
+
+BANNED = "00000000-0000-0000-0000-0000000000bb"
+
+
+class FakeConnection:
+    """The movies and ratings tables the engine reads the rating counters from."""
+
+    def __init__(self) -> None:
+        self.movies = {
+            movie["movie_id"]: (movie["num_votes"], movie["cumulative_rating"])
+            for movie in MOVIES
+        }
+        # (user_id, movie_id, rating)
+        self.ratings = []
+
+    async def execute_query_dict(self, sql, params):
+        if sql.startswith("SELECT movie_id, num_votes"):
+            return [
+                {
+                    "movie_id": UUID(movie_id),
+                    "num_votes": self.movies[movie_id][0],
+                    "cumulative_rating": self.movies[movie_id][1],
+                }
+                for movie_id in params[0]
+                if movie_id in self.movies
+            ]
+        banned = {}
+        for user_id, movie_id, rating in self.ratings:
+            if user_id in params[0] and (len(params) == 1 or movie_id in params[1]):
+                num_votes, cumulative_rating = banned.get(movie_id, (0, 0.0))
+                banned[movie_id] = (num_votes + 1, cumulative_rating + rating)
+        return [
+            {
+                "movie_id": UUID(movie_id),
+                "num_votes": num_votes,
+                "cumulative_rating": cumulative_rating,
+            }
+            for movie_id, (num_votes, cumulative_rating) in banned.items()
+        ]
+
+
+class FakeTortoise:
+    connection: FakeConnection
+
+    @classmethod
+    def get_connection(cls, name):
+        return cls.connection
+
+
+class FakeRatingCounters:
+    def __init__(self) -> None:
+        self.deltas = {}
+
+    async def pending(self, movie_ids):
+        return {
+            movie_id: self.deltas[movie_id]
+            for movie_id in movie_ids
+            if movie_id in self.deltas
+        }
+
+
+@pytest.fixture(autouse=True)
+def connection(monkeypatch):
+    FakeTortoise.connection = FakeConnection()
+    monkeypatch.setattr(module, "Tortoise", FakeTortoise)
+    return FakeTortoise.connection
+
+
+@pytest.fixture(autouse=True)
+def counters(monkeypatch):
+    counters = FakeRatingCounters()
+    monkeypatch.setattr(module, "rating_counters", counters)
+    return counters
+
+
+def make_engine(index=None) -> InvertedIndexSearchEngine:
+    return InvertedIndexSearchEngine(
+        index or InvertedIndex.build(MOVIES, POSITIONS, GENRES)
+    )
+
+
+def titles(hits):
+    titles_of = {movie["movie_id"]: movie["title"] for movie in MOVIES}
+    return [titles_of[hit.movie_id] for hit in hits]
+
+
+def test_title_score_is_bm25():
+    index = InvertedIndex.build(MOVIES, POSITIONS, GENRES)
+    scores = index.score("matrix", {"title": 1.0})
+    # "matrix" is in one of five titles, which have 2, 1, 2, 2 and 1 terms
+    idf = math.log(1 + (5 - 1 + 0.5) / (1 + 0.5))
+    impact = (K1 + 1) / (1 + K1 * (1 - B + B * 2 / 1.6))
+    assert scores[0] == pytest.approx(idf * impact, rel=1e-5)
+    assert not scores[1:].any()
+
+
+def test_titles_are_boosted_ten_times():
+    engine = make_engine()
+    index = engine.index
+    title_scores = index.score("matrix", {"title": 1.0})
+    description_scores = index.score("matrix", {"description": 1.0})
+    # The description of Simulacra scores more than the title of The Matrix,
+    # until the title is boosted
+    assert description_scores[1] > title_scores[0]
+    hits = asyncio.run(engine.search("matrix"))
+    assert titles(hits) == ["The Matrix", "Simulacra"]
+    assert hits[0].score == pytest.approx(10 * title_scores[0])
+    assert hits[1].score == pytest.approx(description_scores[1])
+
+
+def test_years_in_keywords_must_match():
+    engine = make_engine()
+    assert titles(asyncio.run(engine.search("matrix 2003"))) == ["Simulacra"]
+    assert asyncio.run(engine.search("matrix 2020")) == []
+
+
+def test_facets():
+    engine = make_engine()
+    page = asyncio.run(engine.search_page(keywords="", per_page=2, facets=True))
+    assert page.total == 5
+    assert page.genres == [
+        ("Action", 2),
+        ("Science Fiction", 2),
+        ("Crime", 1),
+        ("Documentary", 1),
+    ]
+    assert page.directors == [
+        ("Lana Wachowski", 4),
+        ("Jane Doe", 1),
+        ("Tom Tykwer", 1),
+    ]
+    assert page.years == [
+        ("1996", 1),
+        ("1999", 1),
+        ("2003", 1),
+        ("2008", 1),
+        ("2012", 1),
+    ]
+
+
+def test_facets_count_the_filtered_movies():
+    engine = make_engine()
+    page = asyncio.run(
+        engine.search_page(keywords="", genres=["Action"], per_page=5, facets=True)
+    )
+    assert titles(page.hits) == ["The Matrix", "Speed Racer"]
+    assert page.directors == [("Lana Wachowski", 2)]
+    assert page.genres == [("Action", 2), ("Science Fiction", 1)]
+
+
+def test_director_filter():
+    engine = make_engine()
+    page = asyncio.run(
+        engine.search_page(keywords="", directors=["tom  TYKWER"], per_page=5)
+    )
+    assert titles(page.hits) == ["Cloud Atlas"]
+
+
+def walk(engine: InvertedIndexSearchEngine, **kwargs):
+    hits, after = [], None
+    while True:
+        page = asyncio.run(engine.search_page(per_page=2, after=after, **kwargs))
+        hits.extend(page.hits)
+        assert page.total == 5
+        if page.after is None:
+            return hits
+        after = page.after
+
+
+@pytest.mark.parametrize("desc", [True, False])
+@pytest.mark.parametrize("sort", ["rating", "name", "year"])
+def test_keyset_paging(sort, desc):
+    engine = make_engine()
+    whole = asyncio.run(
+        engine.search_page(keywords="", per_page=10, sort=sort, desc=desc)
+    )
+    assert whole.after is None
+    assert walk(engine, keywords="", sort=sort, desc=desc) == whole.hits
+
+
+def test_keyset_paging_breaks_ties_on_movie_id():
+    engine = make_engine()
+    hits = walk(engine, keywords="", sort="rating")
+    # The Matrix, Simulacra and Bound are all rated 4.5, so the second page
+    # starts in the middle of the tie
+    assert titles(hits) == [
+        "The Matrix",
+        "Simulacra",
+        "Bound",
+        "Speed Racer",
+        "Cloud Atlas",
+    ]
+    assert hits[1].sort == [4.5, MOVIES[1]["movie_id"]]
+    assert hits[2].sort == [4.5, MOVIES[4]["movie_id"]]
+
+
+def test_snapshot_is_memory_mapped(tmp_path):
+    index = InvertedIndex.build(MOVIES, POSITIONS, GENRES)
+    path = tmp_path / "search_index"
+    index.save(path)
+    loaded = InvertedIndex.load(path)
+    assert set(loaded.arrays) == set(index.arrays)
+    for name, array in index.arrays.items():
+        assert isinstance(loaded.arrays[name], np.memmap)
+        assert np.array_equal(loaded.arrays[name], array)
+    engine, loaded_engine = make_engine(index), make_engine(loaded)
+    assert asyncio.run(loaded_engine.search("matrix")) == asyncio.run(
+        engine.search("matrix")
+    )
+    assert asyncio.run(
+        loaded_engine.search_page(keywords="", per_page=5, facets=True)
+    ) == asyncio.run(engine.search_page(keywords="", per_page=5, facets=True))
+
+
+def test_snapshot_is_swapped_in(tmp_path):
+    path = tmp_path / "search_index"
+    old = InvertedIndex.build(MOVIES[:2], POSITIONS, GENRES)
+    old.save(path)
+    mapped = InvertedIndex.load(path)
+    # A staging directory left behind by a crashed save is replaced
+    staging = path.with_name(path.name + ".new-" + str(os.getpid()))
+    staging.mkdir()
+    (staging / "meta.json").write_text("{}")
+
+    InvertedIndex.build(MOVIES, POSITIONS, GENRES).save(path)
+    assert sorted(entry.name for entry in tmp_path.iterdir()) == ["search_index"]
+    assert InvertedIndex.load(path).size == 5
+    # The previous snapshot stays readable where it was mapped
+    assert mapped.size == 2
+    assert titles(asyncio.run(make_engine(mapped).search("matrix"))) == [
+        "The Matrix",
+        "Simulacra",
+    ]
+
+
+def test_snapshot_of_another_version_is_rejected(tmp_path):
+    path = tmp_path / "search_index"
+    InvertedIndex.build(MOVIES, POSITIONS, GENRES).save(path)
+    (path / "meta.json").write_text('{"version": 0, "arrays": []}')
+    with pytest.raises(ValueError):
+        InvertedIndex.load(path)
+
+
+def test_ratings_are_read_from_the_database(connection, counters):
+    engine = make_engine()
+    matrix = MOVIES[0]["movie_id"]
+    connection.movies[matrix] = (5, 23.0)
+    counters.deltas[matrix] = (-3.0, 1)
+    hits = asyncio.run(engine.search("matrix"))
+    assert hits[0].average_rating == [20.0 / 6, 6, 20.0]
+    # The snapshot is left as it was
+    assert engine.index.arrays["num_votes"][0] == 4
+
+
+def test_banned_ratings_are_taken_off_the_current_counters(connection):
+    engine = make_engine()
+    speed_racer = MOVIES[2]["movie_id"]
+    # A banned user rated Speed Racer after the snapshot
+    connection.movies[speed_racer] = (3, 10.0)
+    connection.ratings.append((BANNED, speed_racer, 4.0))
+    assert asyncio.run(engine.ratings([speed_racer], [BANNED])) == {
+        speed_racer: [3.0, 2, 6.0]
+    }
+    page = asyncio.run(
+        engine.search_page(keywords="speed", sort="rating", list_ban=[BANNED])
+    )
+    assert page.hits[0].average_rating == [3.0, 2, 6.0]
+    assert page.hits[0].sort == [3.0, speed_racer]
+
+
+def test_rating_sort_uses_the_counters_read(connection):
+    engine = make_engine()
+    cloud_atlas = MOVIES[3]["movie_id"]
+    connection.movies[cloud_atlas] = (1, 5.0)
+    page = asyncio.run(engine.search_page(keywords="", sort="rating", per_page=5))
+    # Not read since the snapshot, where it has no votes
+    assert titles(page.hits)[-1] == "Cloud Atlas"
+    assert page.hits[-1].average_rating == [5.0, 1, 5.0]
+    page = asyncio.run(engine.search_page(keywords="", sort="rating", per_page=5))
+    assert titles(page.hits)[0] == "Cloud Atlas"
+
+
+def test_ratings_of_movies_added_after_the_snapshot(connection):
+    engine = make_engine()
+    added = "00000000-0000-0000-0000-000000000006"
+    connection.movies[added] = (2, 7.0)
+    connection.ratings.append((BANNED, added, 3.0))
+    deleted = "00000000-0000-0000-0000-000000000007"
+    assert asyncio.run(
+        engine.ratings([added, deleted, MOVIES[0]["movie_id"]], [BANNED])
+    ) == {
+        added: [4.0, 1, 4.0],
+        MOVIES[0]["movie_id"]: [4.5, 4, 18.0],
+    }
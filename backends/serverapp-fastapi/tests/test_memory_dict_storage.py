@@ -0,0 +1,149 @@
+import asyncio
+
+from app.utils.dict_storage.memory import MemoryDictStorageDriver
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_driver(clock: FakeClock, **kwargs) -> MemoryDictStorageDriver:
+    return MemoryDictStorageDriver(clock=clock, metrics_prefix="test_memory", **kwargs)
+
+
+def test_get_returns_a_copy():
+    driver = make_driver(FakeClock())
+    value = {"user_id": "A", "searches": {"matrix": "S1"}}
+    asyncio.run(driver.update("key", value))
+    value["searches"]["matrix"] = "S2"
+    result, ttl = asyncio.run(driver.get("key"))
+    assert result == {"user_id": "A", "searches": {"matrix": "S1"}}
+    assert ttl == 0
+    result["user_id"] = "B"
+    assert asyncio.run(driver.get("key"))[0]["user_id"] == "A"
+
+
+def test_keys_are_normalized():
+    driver = make_driver(FakeClock())
+    asyncio.run(driver.update(" abc ", {"user_id": "A"}))
+    assert asyncio.run(driver.get("ABC"))[0] == {"user_id": "A"}
+    asyncio.run(driver.destroy("abc"))
+    assert asyncio.run(driver.get("ABC")) == ({}, 0)
+    assert len(driver) == 0
+
+
+def test_expiry():
+    clock = FakeClock()
+    driver = make_driver(clock, ttl=10)
+    asyncio.run(driver.update("key", {"user_id": "A"}))
+    clock.now += 9
+    assert asyncio.run(driver.get("key")) == ({"user_id": "A"}, 1)
+    clock.now += 1
+    assert asyncio.run(driver.get("key")) == ({}, 0)
+    assert len(driver) == 0
+    assert driver.memory_usage == 0
+
+
+def test_expiry_without_reads():
+    clock = FakeClock()
+    driver = make_driver(clock, ttl=10)
+    asyncio.run(driver.update("old", {"user_id": "A"}))
+    clock.now += 5
+    asyncio.run(driver.update("new", {"user_id": "B"}))
+    clock.now += 5
+    # Any call removes what has expired, not only reads of the expired key
+    asyncio.run(driver.destroy("other"))
+    assert len(driver) == 1
+    assert asyncio.run(driver.get("new"))[0] == {"user_id": "B"}
+
+
+def test_expiry_after_turns_of_the_wheel():
+    clock = FakeClock(0)
+    driver = make_driver(clock, ttl=10, wheel_size=4)
+    asyncio.run(driver.update("key", {"user_id": "A"}))
+    # The slot of the key is passed at seconds 2 and 6 before it is due at 10
+    for second in range(1, 10):
+        clock.now = second
+        asyncio.run(driver.destroy("other"))
+        assert len(driver) == 1
+    clock.now = 10
+    asyncio.run(driver.destroy("other"))
+    assert len(driver) == 0
+
+
+def test_expiry_after_a_long_pause():
+    clock = FakeClock(0)
+    driver = make_driver(clock, ttl=10, wheel_size=4)
+    asyncio.run(driver.update("key", {"user_id": "A"}))
+    clock.now = 1000
+    assert asyncio.run(driver.get("key")) == ({}, 0)
+
+
+def test_renewal():
+    clock = FakeClock(0)
+    driver = make_driver(clock, ttl=10, renew_on_ttl=5)
+    asyncio.run(driver.update("key", {"user_id": "A"}))
+    clock.now = 4
+    # Above renew_on_ttl, the expiry is left alone
+    assert asyncio.run(driver.get("key")) == ({"user_id": "A"}, 6)
+    clock.now = 6
+    # At or below it, the key is renewed to the full ttl
+    assert asyncio.run(driver.get("key")) == ({"user_id": "A"}, 4)
+    clock.now = 15
+    assert asyncio.run(driver.get("key")) == ({"user_id": "A"}, 1)
+    clock.now = 25
+    assert asyncio.run(driver.get("key")) == ({}, 0)
+
+
+def test_update_resets_the_expiry():
+    clock = FakeClock(0)
+    driver = make_driver(clock, ttl=10)
+    asyncio.run(driver.update("key", {"user_id": "A"}))
+    clock.now = 8
+    asyncio.run(driver.update("key", {"user_id": "B"}))
+    clock.now = 12
+    assert asyncio.run(driver.get("key")) == ({"user_id": "B"}, 6)
+
+
+def test_empty_dicts_are_dropped():
+    driver = make_driver(FakeClock())
+    asyncio.run(driver.update("key", {}))
+    assert asyncio.run(driver.get("key")) == ({}, 0)
+    assert len(driver) == 0
+
+
+def test_eviction_by_entries():
+    driver = make_driver(FakeClock(), max_entries=2)
+    asyncio.run(driver.update("a", {"n": 1}))
+    asyncio.run(driver.update("b", {"n": 2}))
+    # Reading "a" makes "b" the least recently used
+    asyncio.run(driver.get("a"))
+    asyncio.run(driver.update("c", {"n": 3}))
+    assert len(driver) == 2
+    assert asyncio.run(driver.get("a"))[0] == {"n": 1}
+    assert asyncio.run(driver.get("b")) == ({}, 0)
+    assert asyncio.run(driver.get("c"))[0] == {"n": 3}
+
+
+def test_eviction_by_bytes():
+    driver = make_driver(FakeClock(), max_bytes=100)
+    asyncio.run(driver.update("a", {"text": "x" * 40}))
+    asyncio.run(driver.update("b", {"text": "y" * 40}))
+    assert len(driver) == 1
+    assert asyncio.run(driver.get("b"))[0] == {"text": "y" * 40}
+    assert driver.memory_usage <= 100
+
+
+def test_memory_usage():
+    driver = make_driver(FakeClock())
+    asyncio.run(driver.update("a", {"text": "x"}))
+    usage = driver.memory_usage
+    assert usage > 0
+    asyncio.run(driver.update("a", {"text": "xxxx"}))
+    assert driver.memory_usage == usage + 3
+    asyncio.run(driver.destroy("a"))
+    assert driver.memory_usage == 0
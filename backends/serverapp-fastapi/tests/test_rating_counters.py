@@ -0,0 +1,225 @@
+import asyncio
+
+import pytest
+
+from app.core import rating_counters as module
+from app.core.rating_counters import (
+    FINISH_SCRIPT,
+    RESTORE_SCRIPT,
+    TAKE_SCRIPT,
+    RatingCounters,
+    parse_deltas,
+)
+from tests.fake_redis import FakeRedis
+
+
+class FakeConnection:
+    def __init__(self, database: "FakeDatabase") -> None:
+        self.database = database
+
+    async def execute_query(self, sql, params):
+        if self.database.fail:
+            raise ConnectionError("The database is down")
+        for movie_id, cumulative, votes in zip(*params):
+            cumulative_rating, num_votes = self.database.movies.get(movie_id, (0.0, 0))
+            self.database.movies[movie_id] = (
+                cumulative_rating + cumulative,
+                num_votes + votes,
+            )
+
+
+class FakeDatabase:
+    def __init__(self) -> None:
+        self.movies = {}
+        self.fail = False
+
+    def in_transaction(self):
+        database = self
+
+        class Transaction:
+            async def __aenter__(self):
+                return FakeConnection(database)
+
+            async def __aexit__(self, *args):
+                return False
+
+        return Transaction()
+
+
+@pytest.fixture(params=[None, "utf-8"], ids=["bytes", "str"])
+def redis(request, monkeypatch):
+    # REDIS_URI may or may not set an encoding, which decodes every reply
+    redis = FakeRedis(encoding=request.param)
+    monkeypatch.setattr(module, "get_redis", redis)
+    return redis
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(module, "in_transaction", database.in_transaction)
+    return database
+
+
+def make_counters() -> RatingCounters:
+    return RatingCounters(key="test_counters", interval=60, lock_timeout=60)
+
+
+def keys(counters: RatingCounters):
+    return [
+        counters.key,
+        counters.flushing_key,
+        counters.lock_key,
+        counters.generation_key,
+    ]
+
+
+def test_parse_deltas_accepts_bytes_and_str():
+    fields = [b"m1:s", b"4.5", b"m1:n", b"1", b"m2:n", b"-1", b"m2:s", b"-3"]
+    expected = {"m1": (4.5, 1), "m2": (-3.0, -1)}
+    assert parse_deltas(fields) == expected
+    assert parse_deltas([field.decode() for field in fields]) == expected
+    assert parse_deltas([]) == {}
+
+
+def test_record_and_pending(redis):
+    async def scenario():
+        counters = make_counters()
+        await counters.record("m1", 4.0, 1)
+        await counters.record("m1", 0.5, 0)
+        await counters.record("m2", 0, 0)
+        assert await counters.pending(["m1", "m2"]) == {"m1": (4.5, 1)}
+        assert await counters.merge("m1", 10.0, 3) == (14.5, 4)
+
+    asyncio.run(scenario())
+
+
+def test_flush(redis, database):
+    async def scenario():
+        counters = make_counters()
+        database.movies["m1"] = (10.0, 3)
+        await counters.record("m1", 4.0, 1)
+        await counters.record("m2", 3.0, 1)
+        await counters.record("m2", -3.0, -1)
+        generation = await counters.generation()
+        # m2 has no net change, so only m1 is updated
+        assert await counters.flush() == 1
+        assert database.movies == {"m1": (14.0, 4)}
+        assert await counters.pending(["m1", "m2"]) == {}
+        assert not await redis.exists(*keys(counters)[:3])
+        assert not await counters.unchanged_since(generation)
+        assert await counters.generation() % 2 == 0
+        assert await counters.flush() == 0
+
+    asyncio.run(scenario())
+
+
+def test_failed_flush_restores_the_changes(redis, database):
+    async def scenario():
+        counters = make_counters()
+        await counters.record("m1", 4.0, 1)
+        database.fail = True
+        with pytest.raises(ConnectionError):
+            await counters.flush()
+        await counters.record("m1", 1.0, 1)
+        assert await counters.pending(["m1"]) == {"m1": (5.0, 2)}
+        assert await counters.generation() % 2 == 0
+        database.fail = False
+        assert await counters.flush() == 1
+        assert database.movies == {"m1": (5.0, 2)}
+
+    asyncio.run(scenario())
+
+
+def test_flush_waits_for_the_lock(redis, database):
+    async def scenario():
+        counters = make_counters()
+        await counters.record("m1", 4.0, 1)
+        await redis.set(counters.lock_key, "another flusher")
+        assert await counters.flush() == 0
+        assert database.movies == {}
+        assert await counters.pending(["m1"]) == {"m1": (4.0, 1)}
+
+    asyncio.run(scenario())
+
+
+def test_scripts_are_fenced_by_the_lock(redis):
+    async def scenario():
+        counters = make_counters()
+        await counters.record("m1", 4.0, 1)
+        await redis.set(counters.lock_key, "token")
+        for script in (TAKE_SCRIPT, RESTORE_SCRIPT, FINISH_SCRIPT):
+            assert await redis.eval(script, keys=keys(counters), args=["other"]) is None
+        assert await redis.exists(counters.key)
+        assert not await redis.exists(counters.flushing_key)
+        assert await counters.generation() == 0
+
+    asyncio.run(scenario())
+
+
+def test_take_moves_the_pending_changes(redis):
+    async def scenario():
+        counters = make_counters()
+        await counters.record("m1", 4.0, 1)
+        await redis.set(counters.lock_key, "token")
+        fields = await redis.eval(TAKE_SCRIPT, keys=keys(counters), args=["token"])
+        assert parse_deltas(fields) == {"m1": (4.0, 1)}
+        assert not await redis.exists(counters.key)
+        # Still pending for readers, and the generation is odd while flushing
+        assert await counters.pending(["m1"]) == {"m1": (4.0, 1)}
+        generation = await counters.generation()
+        assert generation % 2 == 1
+        assert not await counters.unchanged_since(generation)
+
+        await counters.record("m1", 1.0, 1)
+        assert await redis.eval(RESTORE_SCRIPT, keys=keys(counters), args=["token"])
+        assert not await redis.exists(counters.flushing_key)
+        assert await counters.pending(["m1"]) == {"m1": (5.0, 2)}
+        assert await counters.generation() == generation + 1
+
+    asyncio.run(scenario())
+
+
+def test_take_restores_the_changes_of_a_dead_flusher(redis):
+    async def scenario():
+        counters = make_counters()
+        await counters.record("m1", 4.0, 1)
+        await redis.set(counters.lock_key, "dead")
+        await redis.eval(TAKE_SCRIPT, keys=keys(counters), args=["dead"])
+        # The flusher died, its lock expired and another flusher takes over
+        await redis.set(counters.lock_key, "token")
+        await counters.record("m1", 1.0, 1)
+        fields = await redis.eval(TAKE_SCRIPT, keys=keys(counters), args=["token"])
+        assert parse_deltas(fields) == {"m1": (5.0, 2)}
+        assert await counters.generation() % 2 == 1
+        assert await redis.eval(FINISH_SCRIPT, keys=keys(counters), args=["token"])
+        assert await counters.pending(["m1"]) == {}
+        assert await counters.generation() % 2 == 0
+
+    asyncio.run(scenario())
+
+
+def test_take_with_nothing_pending(redis):
+    async def scenario():
+        counters = make_counters()
+        await redis.set(counters.lock_key, "token")
+        assert await redis.eval(TAKE_SCRIPT, keys=keys(counters), args=["token"]) == []
+        assert await counters.generation() == 0
+
+    asyncio.run(scenario())
+
+
+def test_finish_after_losing_the_lock(redis):
+    async def scenario():
+        counters = make_counters()
+        await counters.record("m1", 4.0, 1)
+        await redis.set(counters.lock_key, "token")
+        await redis.eval(TAKE_SCRIPT, keys=keys(counters), args=["token"])
+        await redis.set(counters.lock_key, "other")
+        assert (
+            await redis.eval(FINISH_SCRIPT, keys=keys(counters), args=["token"]) is None
+        )
+        # The changes are left for the flusher holding the lock
+        assert await counters.pending(["m1"]) == {"m1": (4.0, 1)}
+
+    asyncio.run(scenario())
@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import pytest
+
+from app.utils.dict_storage.redis import RedisDictStorageDriver
+from tests.fake_redis import FakeRedis
+
+KEY = "k1"
+FULL_KEY = "session:K1"
+
+
+@pytest.fixture(params=[None, "utf-8"], ids=["bytes", "str"])
+def redis(request):
+    # REDIS_URI may or may not set an encoding, which decodes every reply
+    return FakeRedis(encoding=request.param)
+
+
+async def make_driver(redis: FakeRedis, ttl: int = 100) -> RedisDictStorageDriver:
+    driver = RedisDictStorageDriver(key_prefix="session:", ttl=ttl, renew_on_ttl=50)
+    driver.redis = redis
+    driver.get_script_sha = await redis.script_load(driver.get_script)
+    driver.initialized = True
+    return driver
+
+
+def test_missing_key(redis):
+    async def scenario():
+        driver = await make_driver(redis)
+        assert await driver.get_and_renew(FULL_KEY) == []
+        assert await driver.get(KEY) == ({}, 0)
+
+    asyncio.run(scenario())
+
+
+def test_renewed_only_at_the_threshold(redis):
+    async def scenario():
+        driver = await make_driver(redis)
+        await driver.update(KEY, {"user_id": "A"})
+        redis.server.expire(FULL_KEY, 51)
+        assert await driver.get(KEY) == ({"user_id": "A"}, 51)
+        assert redis.server.ttl(FULL_KEY) == 51
+        redis.server.expire(FULL_KEY, 50)
+        # The ttl before renewal is returned, the key is renewed to the full ttl
+        assert await driver.get(KEY) == ({"user_id": "A"}, 50)
+        assert redis.server.ttl(FULL_KEY) == 100
+
+    asyncio.run(scenario())
+
+
+def test_key_without_expiry_is_renewed(redis):
+    async def scenario():
+        driver = await make_driver(redis)
+        redis.server.set(FULL_KEY, json.dumps({"user_id": "A"}))
+        assert await driver.get(KEY) == ({"user_id": "A"}, 0)
+        assert redis.server.ttl(FULL_KEY) == 100
+
+    asyncio.run(scenario())
+
+
+def test_no_expiry_without_a_ttl(redis):
+    async def scenario():
+        driver = await make_driver(redis, ttl=0)
+        await driver.update(KEY, {"user_id": "A"})
+        reply = await driver.get_and_renew(FULL_KEY)
+        assert json.loads(reply[0]) == {"user_id": "A"} and reply[1] == 0
+        assert await driver.get(KEY) == ({"user_id": "A"}, 0)
+        assert redis.server.ttl(FULL_KEY) == -1
+
+    asyncio.run(scenario())
+
+
+def test_script_is_loaded_again(redis):
+    async def scenario():
+        driver = await make_driver(redis)
+        await driver.update(KEY, {"user_id": "A"})
+        # Redis restarted, or SCRIPT FLUSH was run
+        redis.server.script_flush()
+        assert await driver.get(KEY) == ({"user_id": "A"}, 100)
+        assert await driver.get(KEY) == ({"user_id": "A"}, 100)
+
+    asyncio.run(scenario())
+
+
+def test_broken_value_is_removed(redis):
+    async def scenario():
+        driver = await make_driver(redis)
+        for value in ("{broken", "[]", "{}"):
+            redis.server.set(FULL_KEY, value)
+            assert await driver.get(KEY) == ({}, 0)
+            assert not redis.server.exists(FULL_KEY)
+
+    asyncio.run(scenario())
@@ -0,0 +1,144 @@
+import asyncio
+import json
+
+import pytest
+
+from app.utils.dict_storage.redis_hash import RedisHashDictStorageDriver
+from tests.fake_redis import FakeRedis
+
+KEY = "k1"
+FULL_KEY = "session:K1"
+
+
+@pytest.fixture(params=[None, "utf-8"], ids=["bytes", "str"])
+def redis(request):
+    # REDIS_URI may or may not set an encoding, which decodes every reply
+    return FakeRedis(encoding=request.param)
+
+
+async def make_driver(redis: FakeRedis) -> RedisHashDictStorageDriver:
+    driver = RedisHashDictStorageDriver(
+        key_prefix="session:",
+        ttl=100,
+        renew_on_ttl=50,
+        lazy_fields=["searches", "recommendations"],
+    )
+    driver.redis = redis
+    driver.get_script_sha = await redis.script_load(driver.get_script)
+    driver.initialized = True
+    return driver
+
+
+def stored(redis: FakeRedis) -> dict:
+    return {
+        name.decode(): json.loads(value)
+        for name, value in redis.server.hgetall(FULL_KEY).items()
+    }
+
+
+def test_lookup_leaves_the_lazy_fields_out(redis):
+    async def scenario():
+        driver = await make_driver(redis)
+        await driver.update(KEY, {"user_id": "A", "searches": {"matrix": "S1"}})
+        assert stored(redis) == {"user_id": "A", "searches": {"matrix": "S1"}}
+        assert await driver.lookup(KEY) == ({"user_id": "A"}, 100)
+        assert await driver.get(KEY) == ({"user_id": "A"}, 100)
+        assert await driver.get_fields(KEY, ["searches", "recommendations"]) == {
+            "searches": {"matrix": "S1"}
+        }
+
+    asyncio.run(scenario())
+
+
+def test_hash_of_lazy_fields_only_is_not_missing(redis):
+    async def scenario():
+        driver = await make_driver(redis)
+        await driver.update(KEY, {"searches": {"matrix": "S1"}})
+        assert await driver.lookup(KEY) == ({}, 100)
+        assert await driver.get(KEY) == ({}, 100)
+        assert await driver.lookup("missing") == (None, 0)
+        assert await driver.get("missing") == ({}, 0)
+
+    asyncio.run(scenario())
+
+
+def test_lookup_renews_at_the_threshold(redis):
+    async def scenario():
+        driver = await make_driver(redis)
+        await driver.update(KEY, {"user_id": "A"})
+        redis.server.expire(FULL_KEY, 60)
+        assert await driver.lookup(KEY) == ({"user_id": "A"}, 60)
+        assert redis.server.ttl(FULL_KEY) == 60
+        redis.server.expire(FULL_KEY, 50)
+        assert await driver.lookup(KEY) == ({"user_id": "A"}, 50)
+        assert redis.server.ttl(FULL_KEY) == 100
+
+    asyncio.run(scenario())
+
+
+def test_update_fields_writes_only_the_given_fields(redis):
+    async def scenario():
+        driver = await make_driver(redis)
+        await driver.update(
+            KEY, {"user_id": "A", "theme": "dark", "searches": {"matrix": "S1"}}
+        )
+        redis.server.expire(FULL_KEY, 10)
+        await driver.update_fields(
+            KEY,
+            {"user_id": "B", "searches": {"alien": "S2"}},
+            ["user_id", "theme"],
+        )
+        # user_id is set, theme removed and searches, not given, is left alone
+        assert stored(redis) == {"user_id": "B", "searches": {"matrix": "S1"}}
+        assert redis.server.ttl(FULL_KEY) == 100
+
+        await driver.update_fields(KEY, {}, [])
+        assert stored(redis) == {"user_id": "B", "searches": {"matrix": "S1"}}
+        await driver.update_fields("other", {}, ["theme"])
+        assert not redis.server.exists("session:OTHER")
+
+    asyncio.run(scenario())
+
+
+def test_update_replaces_the_hash(redis):
+    async def scenario():
+        driver = await make_driver(redis)
+        await driver.update(KEY, {"user_id": "A", "theme": "dark"})
+        await driver.update(KEY, {"user_id": "B"})
+        assert stored(redis) == {"user_id": "B"}
+        await driver.update(KEY, {})
+        assert not redis.server.exists(FULL_KEY)
+
+    asyncio.run(scenario())
+
+
+def test_get_fields_drops_a_broken_field(redis):
+    async def scenario():
+        driver = await make_driver(redis)
+        await driver.update(
+            KEY,
+            {
+                "user_id": "A",
+                "searches": {"matrix": "S1"},
+                "recommendations": ["M1"],
+            },
+        )
+        redis.server.hset(FULL_KEY, "searches", "{broken")
+        assert await driver.get_fields(KEY, ["searches", "recommendations"]) == {
+            "recommendations": ["M1"]
+        }
+        assert stored(redis) == {"user_id": "A", "recommendations": ["M1"]}
+        assert await driver.lookup(KEY) == ({"user_id": "A"}, 100)
+
+    asyncio.run(scenario())
+
+
+def test_broken_hash_is_removed(redis):
+    async def scenario():
+        driver = await make_driver(redis)
+        await driver.update(KEY, {"user_id": "A"})
+        redis.server.hset(FULL_KEY, "theme", "{broken")
+        assert await driver.lookup(KEY) == (None, 0)
+        assert not redis.server.exists(FULL_KEY)
+
+    asyncio.run(scenario())
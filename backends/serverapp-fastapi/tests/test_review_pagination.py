@@ -0,0 +1,50 @@
+import itertools
+import operator
+
+from tortoise.query_utils import Q
+
+from app.api.v1.routers.review import REVIEW_SORTS, after_filter
+
+LOOKUPS = {"lt": operator.lt, "lte": operator.le}
+
+
+def matches(q: Q, row: dict) -> bool:
+    """Evaluates a filter built of Q objects against a row, like the database."""
+    results = [matches(child, row) for child in q.children]
+    for key, value in q.filters.items():
+        field, _, lookup = key.partition("__")
+        results.append(LOOKUPS.get(lookup, operator.eq)(row[field], value))
+    result = all(results) if q.join_type == Q.AND else any(results)
+    return not result if q._is_negated else result
+
+
+def sort_key(fields, row):
+    return tuple(row[field] for field in fields)
+
+
+def test_after_filter_matches_the_rows_after_the_values():
+    fields = REVIEW_SORTS["top"]
+    rows = [
+        {"rank_score": score, "create_date": date, "review_id": review_id}
+        for score, date, review_id in itertools.product(
+            [0.0, 0.5, 0.9], [1, 2, 3], ["a", "b"]
+        )
+    ]
+    rows.sort(key=lambda row: sort_key(fields, row), reverse=True)
+    for i, last in enumerate(rows):
+        after = after_filter(fields, [last[field] for field in fields])
+        assert [row for row in rows if matches(after, row)] == rows[i + 1 :]
+
+
+def test_after_filter_bounds_the_first_field():
+    # The range on the first field is what lets the index skip the pages before
+    after = after_filter(("create_date", "review_id"), [5, "m"])
+    assert after.join_type == Q.AND
+    assert any(child.filters == {"create_date__lte": 5} for child in after.children)
+
+
+def test_after_filter_on_one_field():
+    after = after_filter(("review_id",), ["m"])
+    assert matches(after, {"review_id": "a"})
+    assert not matches(after, {"review_id": "m"})
+    assert not matches(after, {"review_id": "z"})
@@ -0,0 +1,54 @@
+import math
+import sqlite3
+
+import pytest
+
+from app.utils.review_rank import Z, rank_score_sql
+
+
+def wilson_lower_bound(helpful: int, spoiler: int) -> float:
+    n = helpful + spoiler
+    if n <= 0:
+        return 0.0
+    p = helpful / n
+    return (
+        p + Z * Z / (2 * n) - Z * math.sqrt(p * (1 - p) / n + Z * Z / (4 * n * n))
+    ) / (1 + Z * Z / n)
+
+
+def rank_score(helpful: int, spoiler: int) -> float:
+    """Evaluates the expression of rank_score_sql() with SQLite."""
+    connection = sqlite3.connect(":memory:")
+    connection.create_function("sqrt", 1, math.sqrt)
+    expression = rank_score_sql("h", "s").replace("::float8", " * 1.0")
+    ((score,),) = connection.execute(
+        "SELECT {} FROM (SELECT ? AS h, ? AS s)".format(expression),
+        (helpful, spoiler),
+    ).fetchall()
+    connection.close()
+    return score
+
+
+@pytest.mark.parametrize(
+    "helpful, spoiler", [(1, 0), (0, 1), (5, 5), (10, 0), (100, 3), (3, 100)]
+)
+def test_rank_score_is_the_wilson_lower_bound(helpful, spoiler):
+    assert rank_score(helpful, spoiler) == pytest.approx(
+        wilson_lower_bound(helpful, spoiler), abs=1e-4
+    )
+
+
+def test_reviews_without_votes_score_zero():
+    assert rank_score(0, 0) == 0
+    assert rank_score(-1, 0) == 0
+
+
+def test_more_helpful_votes_rank_higher():
+    assert rank_score(1, 0) < rank_score(10, 0) < rank_score(100, 0) < 1
+    assert rank_score(10, 0) > rank_score(10, 1) > rank_score(10, 10)
+
+
+def test_counts_are_parenthesized():
+    sql = rank_score_sql("num_helpful + 1", "num_spoiler")
+    assert "(num_helpful + 1)" in sql
+    assert "(num_spoiler)" in sql
@@ -0,0 +1,167 @@
+import asyncio
+
+from app.core.session import AdvancedSessionMiddleware, _UncopyableDict
+from app.utils.dict_storage.cached import CachedDictStorageDriver
+from app.utils.dict_storage.memory import MemoryDictStorageDriver
+from app.utils.dict_storage.redis import RedisDictStorageDriver
+
+
+def make_session(data=None, loader=None):
+    return _UncopyableDict(data or {}, loader=loader, partial=loader is not None)
+
+
+def test_initial_data_is_not_a_change():
+    session = make_session({"user_id": "A", "searches": {"matrix": "S1"}})
+    assert session == {"user_id": "A", "searches": {"matrix": "S1"}}
+    assert not session.modified
+
+
+def test_nested_assignment_marks_the_top_level_key():
+    session = make_session({"user_id": "A", "searches": {"matrix": "S1"}})
+    session["searches"]["alien"] = "S2"
+    assert session.changed == {"searches"}
+    assert session["searches"] == {"matrix": "S1", "alien": "S2"}
+
+
+def test_dicts_assigned_later_are_tracked_too():
+    session = make_session()
+    session["searches"] = {}
+    session.changed.clear()
+    session["searches"]["matrix"] = {"page": 1}
+    session.changed.clear()
+    session["searches"]["matrix"]["page"] = 2
+    assert session.changed == {"searches"}
+
+
+def test_equal_scalars_are_not_changes():
+    session = make_session({"user_id": "A", "count": 3, "flag": True, "ratio": 0.5})
+    session["user_id"] = "A"
+    session["count"] = 3
+    session["flag"] = True
+    session["ratio"] = 0.5
+    # Assigning back a nested dict after changing it in place is not a new change
+    searches = {"matrix": "S1"}
+    session["searches"] = searches
+    session.changed.clear()
+    session["searches"] = session["searches"]
+    session["searches"]["matrix"] = "S1"
+    assert not session.modified
+
+
+def test_different_values_are_changes():
+    session = make_session({"user_id": "A", "count": 1})
+    session["user_id"] = "B"
+    # True == 1, but it is stored differently
+    session["count"] = True
+    session["role"] = "user"
+    assert session.changed == {"user_id", "count", "role"}
+
+
+def test_pop_is_tracked():
+    session = make_session({"user_id": "A", "searches": {"matrix": "S1"}})
+    assert session.pop("missing", None) is None
+    assert not session.modified
+    assert session.pop("user_id") == "A"
+    assert session["searches"].pop("matrix") == "S1"
+    assert session.changed == {"user_id", "searches"}
+
+
+def test_clear_is_tracked():
+    session = make_session({"user_id": "A", "searches": {"matrix": "S1"}})
+    session.clear()
+    assert session == {}
+    assert session.changed == {"user_id", "searches"}
+
+
+def test_nested_clear_is_tracked():
+    session = make_session({"user_id": "A", "searches": {"matrix": "S1"}})
+    session["searches"].clear()
+    assert session.changed == {"searches"}
+
+
+def test_setdefault_is_tracked():
+    session = make_session({"user_id": "A"})
+    assert session.setdefault("user_id", "B") == "A"
+    assert not session.modified
+    session.setdefault("searches", {})["matrix"] = "S1"
+    assert session["searches"] == {"matrix": "S1"}
+    assert session.changed == {"searches"}
+
+
+def test_del_popitem_and_update_are_tracked():
+    session = make_session({"user_id": "A", "role": "user", "count": 1})
+    del session["role"]
+    key, _ = session.popitem()
+    session.update({"user_id": "A", "theme": "dark"})
+    session |= {"lang": "en"}
+    assert session.changed == {"role", key, "theme", "lang"}
+
+
+def test_load_is_not_a_change():
+    loaded = []
+
+    async def loader(keys):
+        loaded.append(keys)
+        return {
+            key: value
+            for key, value in {"searches": {"matrix": "S1"}, "theme": "dark"}.items()
+            if key in keys
+        }
+
+    async def scenario():
+        session = make_session({"user_id": "A"}, loader)
+        assert session.partial
+        await session.load("searches", "theme", "user_id", "missing")
+        assert loaded == [["searches", "theme", "missing"]]
+        assert session == {
+            "user_id": "A",
+            "searches": {"matrix": "S1"},
+            "theme": "dark",
+        }
+        assert not session.modified
+        # Keys are only read once
+        await session.load("searches", "missing")
+        assert len(loaded) == 1
+        # Loaded dicts are tracked
+        session["searches"]["alien"] = "S2"
+        assert session.changed == {"searches"}
+
+    asyncio.run(scenario())
+
+
+def test_load_keeps_keys_changed_before():
+    async def loader(keys):
+        return {key: "stored" for key in keys}
+
+    async def scenario():
+        session = make_session({}, loader)
+        session["theme"] = "light"
+        session["lang"] = "en"
+        del session["lang"]
+        await session.load("theme", "lang")
+        assert session == {"theme": "light"}
+        assert session.changed == {"theme", "lang"}
+
+    asyncio.run(scenario())
+
+
+async def app(scope, receive, send):
+    pass
+
+
+def test_memory_sessions_are_not_cached_again():
+    middleware = AdvancedSessionMiddleware(
+        app,
+        driver=MemoryDictStorageDriver,
+        driver_kwargs={"metrics_prefix": "test_session_memory"},
+        cache_size=16,
+    )
+    assert isinstance(middleware.driver, MemoryDictStorageDriver)
+
+
+def test_redis_sessions_are_cached():
+    middleware = AdvancedSessionMiddleware(
+        app, driver=RedisDictStorageDriver, cache_size=16
+    )
+    assert isinstance(middleware.driver, CachedDictStorageDriver)
+    assert isinstance(middleware.driver.driver, RedisDictStorageDriver)
@@ -0,0 +1,197 @@
+import asyncio
+
+import pytest
+
+from app.utils.dict_storage.memory import MemoryDictStorageDriver
+from app.utils.dict_storage.sharded import ShardedDictStorageDriver, shard_name
+
+KEYS = ["K{:05d}".format(i) for i in range(2000)]
+
+
+class FlakyShard(MemoryDictStorageDriver):
+    """An in-memory shard that fails like an unreachable Redis while `down`."""
+
+    down = False
+
+    async def initialize_driver(self):
+        if self.down:
+            raise ConnectionRefusedError()
+        await super().initialize_driver()
+
+    async def lookup(self, key):
+        if self.down:
+            # Fails after a round trip, like a connection that is reset
+            await asyncio.sleep(0)
+            raise ConnectionRefusedError()
+        return await super().lookup(key)
+
+    async def update(self, key, value):
+        if self.down:
+            raise ConnectionRefusedError()
+        await super().update(key, value)
+
+
+def make_sharded(names, shard_class=MemoryDictStorageDriver, **kwargs):
+    return ShardedDictStorageDriver(
+        shards={name: shard_class(metrics_prefix="test_shard") for name in names},
+        metrics_prefix="test_shards",
+        **kwargs,
+    )
+
+
+def test_shard_name():
+    assert shard_name("redis://:secret@redis-1:6380/2?encoding=utf-8") == (
+        "redis-1:6380/2"
+    )
+    assert shard_name("redis://redis-1") == "redis-1:6379/0"
+
+
+def test_needs_a_shard():
+    with pytest.raises(ValueError):
+        ShardedDictStorageDriver(shards={})
+
+
+def test_keys_spread_over_all_shards():
+    driver = make_sharded(["a", "b", "c", "d"])
+    counts = {name: 0 for name in driver.shards}
+    for key in KEYS:
+        counts[driver.shard_for(key)] += 1
+    for count in counts.values():
+        assert len(KEYS) / 4 * 0.7 < count < len(KEYS) / 4 * 1.3
+
+
+def test_placement_is_stable_and_normalized():
+    first = make_sharded(["a", "b", "c"])
+    second = make_sharded(["c", "b", "a"])
+    for key in KEYS[:100]:
+        assert first.shard_for(key) == second.shard_for(key)
+        assert first.shard_for(key) == first.shard_for(" " + key.lower())
+
+
+def test_removing_a_shard_only_moves_its_keys():
+    driver = make_sharded(["a", "b", "c", "d"])
+    owners = {key: driver.shard_for(key) for key in KEYS}
+    asyncio.run(driver.remove_shard("b"))
+    for key in KEYS:
+        if owners[key] != "b":
+            assert driver.shard_for(key) == owners[key]
+        else:
+            assert driver.shard_for(key) != "b"
+
+
+def test_adding_a_shard_only_takes_keys():
+    driver = make_sharded(["a", "b", "c"])
+    owners = {key: driver.shard_for(key) for key in KEYS}
+    asyncio.run(driver.add_shard("d", MemoryDictStorageDriver()))
+    moved = [key for key in KEYS if driver.shard_for(key) != owners[key]]
+    assert moved
+    assert all(driver.shard_for(key) == "d" for key in moved)
+
+
+def test_dicts_are_stored_on_their_shard():
+    driver = make_sharded(["a", "b"])
+    for key in KEYS[:50]:
+        asyncio.run(driver.update(key, {"key": key}))
+    for key in KEYS[:50]:
+        shard = driver.shards[driver.shard_for(key)]
+        assert asyncio.run(shard.get(key))[0] == {"key": key}
+        assert asyncio.run(driver.get(key))[0] == {"key": key}
+    assert sum(driver.operations.values()) == 100
+
+
+def test_failed_shard_is_removed_and_added_back():
+    async def scenario():
+        driver = make_sharded(["a", "b", "c"], FlakyShard)
+        owners = {key: driver.shard_for(key) for key in KEYS}
+        driver.shards["a"].down = True
+        key = next(key for key in KEYS if owners[key] == "a")
+        # The call moves on to the shard that takes the keys over
+        await driver.update(key, {"key": key})
+        assert "a" in driver.failed and "a" not in driver.shards
+        assert driver.shard_for(key) != "a"
+        assert (await driver.get(key))[0] == {"key": key}
+
+        # Still failing, so it is left out
+        assert await driver.check_failed() == []
+        driver.failed["a"].down = False
+        assert await driver.check_failed() == ["a"]
+        assert not driver.failed
+        assert all(driver.shard_for(key) == owners[key] for key in KEYS)
+
+    asyncio.run(scenario())
+
+
+def test_failed_shards_are_checked_in_the_background():
+    async def scenario():
+        driver = make_sharded(["a", "b"], FlakyShard, health_check_interval=0.01)
+        await driver.initialize_driver()
+        driver.shards["a"].down = True
+        for key in KEYS[:20]:
+            await driver.lookup(key)
+        assert "a" in driver.failed
+        driver.failed["a"].down = False
+        await asyncio.sleep(0.1)
+        assert "a" in driver.shards
+        await driver.terminate_driver()
+
+    asyncio.run(scenario())
+
+
+def test_last_shard_failure_is_raised():
+    driver = make_sharded(["a"], FlakyShard)
+    driver.shards["a"].down = True
+    with pytest.raises(ConnectionRefusedError):
+        asyncio.run(driver.lookup("key"))
+    assert "a" in driver.shards
+
+
+def test_concurrent_failures_of_a_shard():
+    async def scenario():
+        driver = make_sharded(["a", "b", "c"], FlakyShard)
+        key = next(key for key in KEYS if driver.shard_for(key) == "c")
+        driver.shards["c"].down = True
+        assert await asyncio.gather(driver.lookup(key), driver.lookup(key)) == [
+            (None, 0),
+            (None, 0),
+        ]
+        assert list(driver.failed) == ["c"]
+        assert sorted(driver.shards) == ["a", "b"]
+
+    asyncio.run(scenario())
+
+
+def test_unreachable_shards_start_out_failed():
+    async def scenario():
+        driver = make_sharded(["a", "b", "c"], FlakyShard, health_check_interval=0)
+        driver.shards["a"].down = True
+        await driver.initialize_driver()
+        assert driver.initialized
+        assert list(driver.failed) == ["a"]
+        assert all(driver.shard_for(key) != "a" for key in KEYS)
+        await driver.update("key", {"key": "key"})
+        assert (await driver.get("key"))[0] == {"key": "key"}
+
+        assert await driver.check_failed() == []
+        driver.failed["a"].down = False
+        assert await driver.check_failed() == ["a"]
+        assert driver.shards["a"].initialized
+        await driver.terminate_driver()
+
+    asyncio.run(scenario())
+
+
+def test_initialization_fails_without_a_reachable_shard():
+    async def scenario():
+        driver = make_sharded(["a", "b"], FlakyShard, health_check_interval=0)
+        for shard in driver.shards.values():
+            shard.down = True
+        with pytest.raises(ConnectionRefusedError):
+            await driver.initialize_driver()
+        assert not driver.initialized
+        assert sorted(driver.shards) == ["a", "b"]
+        # Tried again on the next initialization
+        driver.shards["b"].down = False
+        await driver.initialize_driver()
+        assert list(driver.failed) == ["a"]
+
+    asyncio.run(scenario())
@@ -78,13 +78,14 @@ ON a."tconst" = c."imdb_movie_id"
 WHERE a.genre != 'N' -- Exclude IMDB's genre value of 'N' which represents null
 
 -- Positions
-;INSERT INTO public.positions (position_id, movie_id, person_id, position, char_name)
+;INSERT INTO public.positions (position_id, movie_id, person_id, position, char_name, billing_order)
 SELECT
 	gen_random_uuid() as position_id,
 	b."movie_id" as movie_id,
 	c."person_id" as person_id,
 	a."category" as position,
-	CASE WHEN a."characters" = '\N' THEN NULL ELSE a.characters END as char_name
+	CASE WHEN a."characters" = '\N' THEN NULL ELSE a.characters END as char_name,
+	a."ordering"::int as billing_order -- The order of the person in the film's credits
 FROM imdbdata.imdb_principals a
 JOIN public.movies b
 ON a."tconst" = b."imdb_movie_id"